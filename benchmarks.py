@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import subprocess
+import time
+
+RUNS = 3
+
+def build(bench_name, args):
+    # Profile-guided builds are trained on one run with the same arguments
+    # and input, the --pgo-use build runs it once more
+    if os.path.exists('benchmarks/{}.pgo'.format(bench_name)):
+        subprocess.check_output('./infix.py --pgo-gen benchmarks/{}.ifx {}'.format(bench_name, args), shell=True, stderr=subprocess.DEVNULL)
+        subprocess.check_output('./infix.py --pgo-use benchmarks/{}.ifx {}'.format(bench_name, args), shell=True)
+        return
+
+    subprocess.check_output('./infix.py --build-only benchmarks/{}.ifx'.format(bench_name), shell=True)
+
+def run_bench(bench_name, max_file_name):
+    try:
+        with open('benchmarks/{}.args'.format(bench_name), 'r') as args_file:
+            args = args_file.read().strip()
+    except:
+        args = ''
+
+    # Large inputs are generated once by the script named in the .gen file
+    if os.path.exists('benchmarks/{}.gen'.format(bench_name)):
+        with open('benchmarks/{}.gen'.format(bench_name), 'r') as gen_file:
+            generator = gen_file.read().strip()
+        input_name = 'benchmarks/{}.in'.format(generator.replace('.py', ''))
+        if not os.path.exists(input_name):
+            subprocess.check_call('python3 benchmarks/{} > {}'.format(generator, input_name), shell=True)
+        args += ' < ' + input_name
+    elif os.path.exists('benchmarks/{}.in'.format(bench_name)):
+        args += ' < benchmarks/{}.in'.format(bench_name)
+
+    try:
+        build(bench_name, args)
+    except Exception as e:
+        print('{fname:{fill}} [FAILURE] Could not build'.format(fname=bench_name + ':', fill=max_file_name))
+        return
+
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.check_call('bin/{} {} > /dev/null'.format(bench_name, args), shell=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('{fname:{fill}} {time:8.3f}s'.format(fname=bench_name + ':', fill=max_file_name, time=best))
+
+if __name__ == '__main__':
+    os.makedirs('obj', exist_ok=True)
+    os.makedirs('bin', exist_ok=True)
+
+    if len(sys.argv) > 1:
+        for bench_name in sys.argv[1:]:
+            run_bench(bench_name, len(bench_name) + 1)
+    else:
+        max_file_name = 1 + max([ len(f) for f in os.listdir('benchmarks/') if f[-3:] == 'ifx' ])
+        for bench_file in sorted(os.listdir('benchmarks/')):
+            if bench_file[-3:] != 'ifx':
+                continue
+            run_bench(bench_file[:-4], max_file_name)
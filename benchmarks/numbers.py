@@ -0,0 +1,13 @@
+#!/usr/bin/python3
+
+# Input for the read_* benchmarks: a count followed by that many integers
+
+import random
+
+COUNT = 3000000
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    print(COUNT)
+    for _ in range(COUNT // 10):
+        print(' '.join(str(rng.randint(-100000, 100000)) for _ in range(10)))
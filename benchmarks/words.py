@@ -0,0 +1,15 @@
+#!/usr/bin/python3
+
+# Input for the map_words benchmark: words drawn from a vocabulary, with a
+# few of them much more frequent than the others
+
+import random
+
+COUNT      = 2000000
+VOCABULARY = 50000
+
+if __name__ == '__main__':
+    rng   = random.Random(0)
+    words = [ ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 12))) for _ in range(VOCABULARY) ]
+    for _ in range(COUNT // 10):
+        print(' '.join(words[int(VOCABULARY ** rng.random()) - 1] for _ in range(10)))
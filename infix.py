@@ -1,15 +1,23 @@
 #!/usr/bin/python3
 
-import re
+import os
 import sys
 
-from pathlib import Path
-
+from src           import driver
+from src.cache     import Cache
+from src.debug     import Debug
+from src.lean      import lean, write_symbols
+from src.profile   import Profile
+from src.pgo       import Training, Weights
 from src.tokenizer import Tokenizer
 from src.parser    import Parser, print_ast
 from src.generator import Generator
 
 if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--serve':
+        from src.server import Server, SOCKET
+        Server(sys.argv[2] if len(sys.argv) > 2 else SOCKET).serve_forever()
+
     if len(sys.argv) >= 2:
         if sys.argv[1][0] != '-':
             option = None
@@ -26,77 +34,93 @@ if __name__ == '__main__':
         print('    --ast          : Prints the AST')
         print('    --type-checker : Prints the tagged AST')
         print('    --code-gen     : Print IR (default)')
-#        print('    -o : Print Optimized IR')
+        print('    --interpret    : Run without compiling')
+        print('    -o             : Print optimized IR')
+        print('    -g             : Build with line tables and run')
+        print('    --instrument   : Build with call and loop counters and run')
+        print('    --pgo-gen      : Build with branch counters, run and add to the profile')
+        print('    --pgo-use      : Build optimized for the profile and run')
+        print('    --lto          : Build as one internalized, optimized unit and run')
+        print('    --lean         : Build from IR without comments, with short symbols, and run')
+        print('    --serve        : Run the compile server (./infixc.py)')
         sys.exit(1)
 
-    with open(fpath, 'r') as f:
-        full_text  = '#include std.ifx\n'
-        full_text += f.read()
-
-    included = set()
-    while includes := re.findall('\s*#include\s+(.*)', full_text):
-        for include in includes:
-            resolved = str(Path('include/' + include).resolve())
-            if resolved in included:
-                full_text = re.sub('\s*#include\s+' + include, '', full_text)
-            else:
-                with open(resolved, 'r') as f:
-                    full_text = re.sub('\s*#include\s+' + include, f.read(), full_text)
-                    included.add(resolved)
-
-    tokens = Tokenizer(full_text)
-
-    if option == '--tokens':
-        for token in tokens:
-            print(token)
-        sys.exit(0)
-
-    ast = Parser(tokens).parse()
-
-    if option == '--ast':
-        print_ast(ast)
-        sys.exit(0)
-
-    ir_repr = Generator().generate(ast)
-
-    if option == '--type-checker':
-        print_ast(ast)
-        sys.exit(0)
-
-    if option == '--code-gen':
-        print(ir_repr)
-        sys.exit(0)
-
-    import os
-    from subprocess import Popen, PIPE
-
-    if option == '--asm':
-        process = [ 'llc-9' ]
-    else:
-        oname   = 'obj/' + fpath.split('/')[-1].replace('.ifx', '.o')
-        process = [ 'llc-9', '-filetype=obj', '-o', oname ]
-
-    with Popen(process, stdin=PIPE, stdout=PIPE) as llc:
-        out, err = llc.communicate(bytes(ir_repr, 'utf-8'))
-        if err is not None:
-            print(str(err, 'utf-8'))
-            sys.exit(1)
-
-    if option == '--asm':
-        print(str(out, 'utf-8'))
-        sys.exit(0)
+    try:
+        lines  = []
+        text   = driver.read_source(fpath, lines=lines)
+        tokens = Tokenizer(text)
+
+        if option == '--tokens':
+            for token in tokens:
+                print(token)
+            sys.exit(0)
+
+        ast = Parser(tokens).parse()
+
+        if option == '--ast':
+            print_ast(ast)
+            sys.exit(0)
+
+        if option == '--interpret':
+            from src.interpreter import Interpreter
+            # argv[0] is what the compiled binary would get
+            sys.exit(Interpreter([ 'bin/' + driver.program_name(fpath) ] + args).run(ast))
+
+        cache   = Cache.from_environment()
+        debug   = Debug(lines)   if option == '-g'           else None
+        profile = Profile(lines) if option == '--instrument' else None
+
+        pgo = None
+        counts, ppath = driver.profile_paths(fpath)
+        if option == '--pgo-gen':
+            pgo = Training(counts)
+        elif option == '--pgo-use':
+            pgo = driver.load_profile(ppath, driver.program_hash(text))
+            if pgo is None:
+                print('No profile of {} from this compiler, train it with --pgo-gen first'.format(fpath))
+                sys.exit(1)
+            pgo = Weights(pgo['counts'], pgo['runs'])
+
+        ir_repr = Generator(cache, debug, profile, pgo).generate(ast)
+
+        if option == '--type-checker':
+            print_ast(ast)
+            sys.exit(0)
+
+        if option == '--code-gen':
+            print(ir_repr)
+            sys.exit(0)
+
+        if option == '-o':
+            print(driver.optimize(ir_repr))
+            sys.exit(0)
+
+        if option == '--asm':
+            print(driver.assemble(driver.optimize(ir_repr)))
+            sys.exit(0)
+
+        if option == '--lean':
+            ir_repr, symbols = lean(ir_repr)
+
+        if option == '--lto':
+            oname, bname = driver.build_lto(ir_repr, fpath)
+        else:
+            oname, bname = driver.build(ir_repr, fpath, cache)
 
-    bname = 'bin/' + fpath.split('/')[-1].replace('.ifx', '')
+        if option == '--lean':
+            write_symbols(os.path.splitext(oname)[0] + '.symbols', symbols)
+    except driver.BuildError as e:
+        print(e)
+        sys.exit(1)
 
-    with Popen(['clang', oname, '-o', bname ], stdin=PIPE, stdout=PIPE) as clang:
-        out, err = clang.communicate(out)
-        if err is not None:
-            print(str(err, 'utf-8'))
-            sys.exit(1)
+    if cache is not None:
+        print(cache.summary(), file=sys.stderr)
 
     if option == '--build-only':
         sys.exit(0)
 
     os.system(bname + ' ' + ' '.join(args))
-    
 
+    if option == '--pgo-gen' and os.path.exists(counts):
+        runs = driver.merge_profile(counts, ppath, driver.program_hash(text))['runs']
+        print('pgo: {} training run{} in {}'.format(runs, '' if runs == 1 else 's', ppath), file=sys.stderr)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Thin client of the compile server (./infix.py --serve). It takes the same
+# arguments as infix.py, after the socket of the server if it is not the
+# default one, and imports nothing of the compiler; the options the server
+# does not handle go to infix.py itself
+
+import json
+import os
+import socket
+import sys
+
+# Same default as src/server.py
+SOCKET = os.environ.get('INFIX_SOCKET', '/tmp/infix-{}.sock'.format(os.getuid()))
+
+SERVED = [ None, '--code-gen', '-o', '--asm', '--build-only' ]
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == '--socket':
+        SOCKET = sys.argv[2]
+        del sys.argv[1:3]
+
+    if len(sys.argv) < 2:
+        print(sys.argv[0] + ' [--socket <path>] [option] <file path>')
+        print('Same options as infix.py, compiled by a running ./infix.py --serve [path]')
+        sys.exit(1)
+
+    if sys.argv[1][0] != '-':
+        option = None
+        fpath  = sys.argv[1]
+        args   = sys.argv[2:]
+    else:
+        option = sys.argv[1]
+        fpath  = sys.argv[2]
+        args   = sys.argv[3:]
+
+    if option not in SERVED:
+        infix = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'infix.py')
+        os.execv(infix, [ infix ] + sys.argv[1:])
+
+    request = { 'file': os.path.abspath(fpath), 'option': option, 'directory': os.getcwd() }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(SOCKET)
+        with sock.makefile('rwb') as stream:
+            stream.write(bytes(json.dumps(request) + '\n', 'utf-8'))
+            stream.flush()
+            response = json.loads(stream.readline())
+
+    if 'error' in response:
+        print(response['error'], file=sys.stderr, end='')
+        sys.exit(1)
+
+    if 'cache' in response:
+        print(response['cache'], file=sys.stderr)
+
+    if option in [ '--code-gen', '-o' ]:
+        print(response['ir'])
+    elif option == '--asm':
+        print(response['asm'])
+    elif option == '--build-only':
+        print(response['binary'])
+    elif option is None:
+        os.execv(response['binary'], [ response['binary'] ] + args)
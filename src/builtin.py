@@ -1,152 +1,1979 @@
-from src.llvm import Function, Variable
-
-def _decl_fn(module, name, ltype='%void', rtype='%void', ftype='%void'):
-    self = Function(
-        name     = module.mangle_name(name, ltype, rtype),
-        args     = {},
-        rtype    = module.type(ftype),
-        internal = True,
-    )
-    module.current = self
-
-    if ltype != '%void':
-        self.args['%left'] = Variable(name='%left', type=module.type(ltype))
-
-    if rtype != '%void':
-        self.args['%right'] = Variable(name='%right', type=module.type(rtype))
-
-    return self
-
-
-def _printf(module, fn, pattern, value=None):
-    pattern = module.const_cstr(pattern)
-
-    if value is None:
-        rtype = fn.args['%right'].type.to_llvm_ir()
-        rreg  = '%right'
-    elif isinstance(value, Variable):
-        rtype = value.type.to_llvm_ir()
-        rreg  = value.name
-    else:
-        rtype = '%cstr'
-        rreg  = module.const_cstr(value).name
-
-    fn.llvm.call('i32(%cstr, ...)', '@printf', '%cstr', pattern.name, rtype, rreg)
-
-
-def i8_eq_i8(module):
-    fn  = _decl_fn(module, '==', '%i8', '%i8', '%bool')
-    reg = fn.llvm.icmp('eq', module.type('%i8').to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def ptr_eq_ptr(module):
-    fn  = _decl_fn(module, '==', '%ptr', '%ptr', '%bool')
-    reg = fn.llvm.icmp('eq', module.type('%ptr').to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_lt_i32(module):
-    fn  = _decl_fn(module, '<', '%i32', '%i32', '%bool')
-    reg = fn.llvm.icmp('slt', module.type('%i32').to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_gt_i32(module):
-    fn  = _decl_fn(module, '>', '%i32', '%i32', '%bool')
-    reg = fn.llvm.icmp('sgt', module.type('%i32').to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_add_i32(module):
-    fn  = _decl_fn(module, '+', '%i32', '%i32', '%i32')
-    reg = fn.llvm.add(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def f32_add_f32(module):
-    fn  = _decl_fn(module, '+', '%f32', '%f32', '%f32')
-    reg = fn.llvm.fadd(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_sub_i32(module):
-    fn  = _decl_fn(module, '-', '%i32', '%i32', '%i32')
-    reg = fn.llvm.sub(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def f32_sub_f32(module):
-    fn  = _decl_fn(module, '-', '%f32', '%f32', '%f32')
-    reg = fn.llvm.fsub(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_mul_i32(module):
-    fn  = _decl_fn(module, '*', '%i32', '%i32', '%i32')
-    reg = fn.llvm.mul(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def f32_mul_f32(module):
-    fn  = _decl_fn(module, '*', '%f32', '%f32', '%f32')
-    reg = fn.llvm.fmul(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def i32_div_i32(module):
-    fn  = _decl_fn(module, '/', '%i32', '%i32', '%i32')
-    reg = fn.llvm.sdiv(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def f32_div_f32(module):
-    fn  = _decl_fn(module, '/', '%f32', '%f32', '%f32')
-    reg = fn.llvm.fdiv(fn.rtype.to_llvm_ir(), '%left', '%right')
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def cstrptr_at_i32(module):
-    fn  = _decl_fn(module, '@', '%cstr.ptr', '%i32', '%cstr')
-    ptr = fn.llvm.get_element_ptr(
-        module.type('%cstr').to_llvm_ir(),
-        module.type('%cstr.ptr').to_llvm_ir(), '%left',
-        module.type('%i32').to_llvm_ir(),      '%right',
-    )
-    reg = fn.llvm.load(
-        module.type('%cstr').to_llvm_ir(),
-        module.type('%cstr.ptr').to_llvm_ir(),
-        ptr
-    )
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
-def cstr_at_i32(module):
-    fn  = _decl_fn(module, '@', '%cstr', '%i32', '%i8')
-    ptr = fn.llvm.get_element_ptr(
-        module.type('%i8').to_llvm_ir(),
-        module.type('%cstr').to_llvm_ir(), '%left',
-        module.type('%i32').to_llvm_ir(),  '%right',
-    )
-    reg = fn.llvm.load(
-        module.type('%i8').to_llvm_ir(),
-        module.type('%cstr').to_llvm_ir(),
-        ptr
-    )
-    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
-    return fn
-
-
+from src.llvm import Function, Variable, mangle_name
+
+# Every builtin is a factory that generates its IR on demand. Module.call
+# looks operators up here by mangled name the first time they are used.
+BUILTINS = {}
+FAMILIES = {}   # Builtins on types only known once a program makes them
+
+def _decl_fn(module, name, ltype='%void', rtype='%void', ftype='%void'):
+    self = Function(
+        name     = module.mangle_name(name, ltype, rtype),
+        args     = {},
+        rtype    = module.type(ftype),
+        internal = True,
+    )
+
+    if ltype != '%void':
+        self.args['%left'] = Variable(name='%left', type=module.type(ltype))
+
+    if rtype != '%void':
+        self.args['%right'] = Variable(name='%right', type=module.type(rtype))
+
+    return self
+
+
+def _decl_helper(module, name, ftype='%void', **args):
+    self = Function(
+        name     = name,
+        args     = {},
+        rtype    = module.type(ftype),
+        internal = True,
+    )
+
+    for aname, atype in args.items():
+        self.args['%' + aname] = Variable(name='%' + aname, type=module.type(atype))
+
+    return self
+
+
+def _operator(name, ltype='%void', rtype='%void', ftype='%void'):
+    def register(body):
+        def factory(module):
+            fn = _decl_fn(module, name, ltype, rtype, ftype)
+            with module.within(fn):
+                body(module, fn)
+            return fn
+        BUILTINS[mangle_name(name, ltype, rtype)] = factory
+        return body
+    return register
+
+
+def _runtime(name, ftype='%void', **args):
+    def register(body):
+        def factory(module):
+            fn = _decl_helper(module, name, ftype, **args)
+            with module.within(fn):
+                body(module, fn)
+            return fn
+        BUILTINS[name] = factory
+        return body
+    return register
+
+
+def _family(name, prefix, others=[ '%void' ], ftype=None):
+    """
+    Registers body for name on every type starting with prefix: the left
+    type, or the right one of unary operators, with any of others on the
+    other side. ftype gives the type of the result from that type.
+    """
+    def register(body):
+        def factory(module, ltype, rtype, type):
+            result = '%void' if ftype is None else ftype(type)
+            fn     = _decl_fn(module, name, ltype, rtype, result)
+            with module.within(fn):
+                body(module, fn)
+            return fn
+        FAMILIES.setdefault(name, []).append((prefix, others, factory))
+        return body
+    return register
+
+
+def family(module, name):
+    """ Factory of the builtin a mangled name asks for, if its type is of a family """
+    parts = name[2:-1].split(';') if name.startswith('@"') else []
+    if len(parts) != 3:
+        return None
+
+    ltype, fname, rtype = '%' + parts[0], parts[1], '%' + parts[2]
+    type, other = (rtype, ltype) if ltype == '%void' else (ltype, rtype)
+    if type not in module.types:
+        return None
+
+    for prefix, others, factory in FAMILIES.get(fname, []):
+        if type.startswith(prefix) and other in others:
+            return lambda module: factory(module, ltype, rtype, module.types[type])
+    return None
+
+
+def _require(module, fn, name):
+    fn.calls.add(name)
+    module.operation(name)
+    return name
+
+
+# Buffered standard output.
+#
+# Every write appends into @out.buf, which is handed to fwrite only when it
+# overflows, when a printf is about to be issued and at exit, through atexit.
+# Each thread has a buffer of its own, which workers of parallel loops flush
+# when they finish their share. An overflow only writes the complete lines,
+# as fwrite locks stdout, so lines from different threads never mix.
+
+OUT_BUFFER_SIZE = 65536
+
+
+def _out_globals(module):
+    if '@out.buf' in module.variables:
+        return
+
+    btype = module.type('%out.buf', '[ {} x i8 ]'.format(OUT_BUFFER_SIZE))
+    module.new_global_var('@out.buf', btype, 'zeroinitializer', constant=False, thread_local=True)
+    module.new_global_var('@out.len', module.type('%i64'), '0', constant=False, thread_local=True)
+    module.new_global_var('@stdout', module.type('%ptr'), None, constant=False)
+    module.add_external('@fwrite', '%i64', [ '%ptr', '%i64', '%i64', '%ptr' ])
+    module.add_external('@memrchr', '%ptr', [ '%ptr', '%i32', '%i64' ])
+    module.add_external('@llvm.memcpy.p0i8.p0i8.i64', '%void', [ '%ptr', '%ptr', '%i64', '%bool' ])
+    module.add_external('@llvm.memmove.p0i8.p0i8.i64', '%void', [ '%ptr', '%ptr', '%i64', '%bool' ])
+
+
+@_runtime('@out.flush')
+def _out_flush(module, fn):
+    _out_globals(module)
+    btype = module.type('%out.buf').to_llvm_ir()
+    done = fn.llvm.next_lbl()
+    go   = fn.llvm.next_lbl()
+
+    size  = fn.llvm.load('i64', 'i64*', '@out.len')
+    empty = fn.llvm.icmp('eq', 'i64', size, '0')
+    fn.llvm.br_if_else(empty, done, go)
+
+    fn.llvm.label(go)
+    stdout = fn.llvm.load('i8*', 'i8**', '@stdout')
+    data   = fn.llvm.get_element_ptr(btype, btype + '*', '@out.buf', 'i64', 0, 'i64', 0)
+    fn.llvm.call('i64', '@fwrite', 'i8*', data, 'i64', 1, 'i64', size, 'i8*', stdout)
+    fn.llvm.store('i64', 0, 'i64*', '@out.len')
+    fn.llvm.br(done)
+
+    fn.llvm.label(done)
+    fn.llvm.ret('void')
+
+
+@_runtime('@out.spill')
+def _out_spill(module, fn):
+    """ Writes the complete lines in the buffer and keeps the last one, or all of it without a newline """
+    _out_globals(module)
+    btype = module.type('%out.buf').to_llvm_ir()
+    lines = fn.llvm.next_lbl()
+    none  = fn.llvm.next_lbl()
+
+    size    = fn.llvm.load('i64', 'i64*', '@out.len')
+    data    = fn.llvm.get_element_ptr(btype, btype + '*', '@out.buf', 'i64', 0, 'i64', 0)
+    newline = fn.llvm.call('i8*', '@memrchr', 'i8*', data, 'i32', 10, 'i64', size)
+    found   = fn.llvm.icmp('ne', 'i8*', newline, 'null')
+    fn.llvm.br_if_else(found, lines, none)
+
+    fn.llvm.label(none)
+    fn.llvm.call('void', _require(module, fn, '@out.flush'))
+    fn.llvm.ret('void')
+
+    fn.llvm.label(lines)
+    start  = fn.llvm.ptrtoint('i8*', 'i64', data)
+    end    = fn.llvm.ptrtoint('i8*', 'i64', newline)
+    count  = fn.llvm.sub('i64', end, start)
+    count  = fn.llvm.add('i64', count, 1)
+    stdout = fn.llvm.load('i8*', 'i8**', '@stdout')
+    fn.llvm.call('i64', '@fwrite', 'i8*', data, 'i64', 1, 'i64', count, 'i8*', stdout)
+    rest   = fn.llvm.sub('i64', size, count)
+    tail   = fn.llvm.get_element_ptr('i8', 'i8*', data, 'i64', count)
+    fn.llvm.call('void', '@llvm.memmove.p0i8.p0i8.i64', 'i8*', data, 'i8*', tail, 'i64', rest, 'i1', 'false')
+    fn.llvm.store('i64', rest, 'i64*', '@out.len')
+    fn.llvm.ret('void')
+
+
+@_runtime('@out.write', data='%ptr', size='%i64')
+def _out_write(module, fn):
+    _out_globals(module)
+    btype = module.type('%out.buf').to_llvm_ir()
+    copy  = fn.llvm.next_lbl()
+    spill = fn.llvm.next_lbl()
+    full  = fn.llvm.next_lbl()
+    large = fn.llvm.next_lbl()
+
+    size = fn.llvm.load('i64', 'i64*', '@out.len')
+    free = fn.llvm.sub('i64', OUT_BUFFER_SIZE, size)
+    fits = fn.llvm.icmp('ule', 'i64', '%size', free)
+    fn.llvm.br_if_else(fits, copy, spill)
+
+    fn.llvm.label(spill)
+    fn.llvm.call('void', _require(module, fn, '@out.spill'))
+    size = fn.llvm.load('i64', 'i64*', '@out.len')
+    free = fn.llvm.sub('i64', OUT_BUFFER_SIZE, size)
+    fits = fn.llvm.icmp('ule', 'i64', '%size', free)
+    fn.llvm.br_if_else(fits, copy, full)
+
+    # A line longer than what is left: give up on keeping it whole
+    fn.llvm.label(full)
+    fn.llvm.call('void', _require(module, fn, '@out.flush'))
+    small = fn.llvm.icmp('ule', 'i64', '%size', OUT_BUFFER_SIZE)
+    fn.llvm.br_if_else(small, copy, large)
+
+    # Larger than the whole buffer: skip it entirely
+    fn.llvm.label(large)
+    stdout = fn.llvm.load('i8*', 'i8**', '@stdout')
+    fn.llvm.call('i64', '@fwrite', 'i8*', '%data', 'i64', 1, 'i64', '%size', 'i8*', stdout)
+    fn.llvm.ret('void')
+
+    fn.llvm.label(copy)
+    at  = fn.llvm.load('i64', 'i64*', '@out.len')
+    dst = fn.llvm.get_element_ptr(btype, btype + '*', '@out.buf', 'i64', 0, 'i64', at)
+    fn.llvm.call('void', '@llvm.memcpy.p0i8.p0i8.i64', 'i8*', dst, 'i8*', '%data', 'i64', '%size', 'i1', 'false')
+    end = fn.llvm.add('i64', at, '%size')
+    fn.llvm.store('i64', end, 'i64*', '@out.len')
+    fn.llvm.ret('void')
+
+
+@_runtime('@out.uint', value='%i64', base='%i64', width='%i64')
+def _out_uint(module, fn):
+    """ Writes an unsigned integer in the given base, zero padded to width digits. """
+    pre  = fn.llvm.next_lbl()
+    loop = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+
+    digits = fn.llvm.alloca('[ 24 x i8 ]')
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(loop)
+
+    quot = fn.llvm.next_reg()
+    npos = fn.llvm.next_reg()
+
+    fn.llvm.label(loop)
+    value = fn.llvm.phi('i64', '%value', pre, quot, loop)
+    pos   = fn.llvm.phi('i64', 24, pre, npos, loop)
+    quot  = fn.llvm.udiv('i64', value, '%base', reg=quot)
+    rem   = fn.llvm.urem('i64', value, '%base')
+    digit = fn.llvm.trunc('i64', 'i8', rem)
+    alpha = fn.llvm.icmp('uge', 'i8', digit, 10)
+    shift = fn.llvm.select(alpha, 'i8', 87, 48)   # 'a' - 10, '0'
+    char  = fn.llvm.add('i8', digit, shift)
+    npos  = fn.llvm.sub('i64', pos, 1, reg=npos)
+    dst   = fn.llvm.get_element_ptr('[ 24 x i8 ]', '[ 24 x i8 ]*', digits, 'i64', 0, 'i64', npos)
+    fn.llvm.store('i8', char, 'i8*', dst)
+    count = fn.llvm.sub('i64', 24, npos)
+    short = fn.llvm.icmp('ult', 'i64', count, '%width')
+    more  = fn.llvm.icmp('ne', 'i64', quot, 0)
+    cont  = fn.llvm.or_('i1', more, short)
+    fn.llvm.br_if_else(cont, loop, done)
+
+    fn.llvm.label(done)
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', dst, 'i64', count)
+    fn.llvm.ret('void')
+
+
+def _out_cstr(module, fn, value):
+    data = module.const_cstr(value)
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', data.name, 'i64', len(value))
+
+
+@_operator('flush')
+def void_flush_void(module, fn):
+    fn.llvm.call('void', _require(module, fn, '@out.flush'))
+    fn.llvm.ret('void')
+
+
+@_operator('write', rtype='%cstr')
+def void_write_cstr(module, fn):
+    size = fn.llvm.call('i64', '@strlen', 'i8*', '%right')
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', '%right', 'i64', size)
+    fn.llvm.ret('void')
+    module.add_external('@strlen', '%i64', [ '%ptr' ])
+
+
+@_operator('write', rtype='%str')
+def void_write_str(module, fn):
+    stype = module.type('%str').to_llvm_ir()
+    size  = fn.llvm.extract_value(stype, '%right', 0)
+    data  = fn.llvm.extract_value(stype, '%right', 1)
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', data, 'i64', size)
+    fn.llvm.ret('void')
+
+
+@_operator('write', rtype='%bool')
+def void_write_bool(module, fn):
+    true  = module.const_cstr('true')
+    false = module.const_cstr('false')
+    data  = fn.llvm.select('%right', 'i8*', true.name, false.name)
+    size  = fn.llvm.select('%right', 'i64', 4, 5)
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', data, 'i64', size)
+    fn.llvm.ret('void')
+
+
+@_operator('write', rtype='%ptr')
+def void_write_ptr(module, fn):
+    null  = fn.llvm.next_lbl()
+    other = fn.llvm.next_lbl()
+
+    isnull = fn.llvm.icmp('eq', 'i8*', '%right', 'null')
+    fn.llvm.br_if_else(isnull, null, other)
+
+    fn.llvm.label(null)
+    _out_cstr(module, fn, 'null')
+    fn.llvm.ret('void')
+
+    fn.llvm.label(other)
+    _out_cstr(module, fn, '0x')
+    value = fn.llvm.ptrtoint('i8*', 'i64', '%right')
+    fn.llvm.call('void', _require(module, fn, '@out.uint'), 'i64', value, 'i64', 16, 'i64', 1)
+    fn.llvm.ret('void')
+
+
+@_operator('write', rtype='%i64')
+def void_write_i64(module, fn):
+    sign = fn.llvm.next_lbl()
+    body = fn.llvm.next_lbl()
+
+    neg = fn.llvm.icmp('slt', 'i64', '%right', 0)
+    fn.llvm.br_if_else(neg, sign, body)
+
+    fn.llvm.label(sign)
+    _out_cstr(module, fn, '-')
+    fn.llvm.br(body)
+
+    fn.llvm.label(body)
+    inv = fn.llvm.sub('i64', 0, '%right')
+    abs = fn.llvm.select(neg, 'i64', inv, '%right')
+    fn.llvm.call('void', _require(module, fn, '@out.uint'), 'i64', abs, 'i64', 10, 'i64', 1)
+    fn.llvm.ret('void')
+
+
+def _write_sext(module, fn):
+    type  = fn.args['%right'].type.to_llvm_ir()
+    wide  = fn.llvm.sext(type, 'i64', '%right')
+    fname = _require(module, fn, mangle_name('write', '%void', '%i64'))
+    fn.llvm.call('void', fname, 'i64', wide)
+    fn.llvm.ret('void')
+
+
+for _type in [ '%i8', '%i16', '%i32' ]:
+    _operator('write', rtype=_type)(_write_sext)
+
+
+@_operator('write', rtype='%f64')
+def void_write_f64(module, fn):
+    """ Same output as printf's %f: values below 1e9 take the integer path. """
+    fast = fn.llvm.next_lbl()
+    slow = fn.llvm.next_lbl()
+    sign = fn.llvm.next_lbl()
+    body = fn.llvm.next_lbl()
+
+    bits  = fn.llvm.bitcast('double', 'i64', '%right')
+    neg   = fn.llvm.icmp('slt', 'i64', bits, 0)
+    inv   = fn.llvm.fsub('double', '-0.0', '%right')
+    abs   = fn.llvm.select(neg, 'double', inv, '%right')
+    small = fn.llvm.fcmp('olt', 'double', abs, '1.0e9')
+    fn.llvm.br_if_else(small, fast, slow)
+
+    # Huge, infinite or NaN: let libc do it, straight into the buffer
+    fn.llvm.label(slow)
+    text = fn.llvm.alloca('[ 320 x i8 ]')
+    data = fn.llvm.get_element_ptr('[ 320 x i8 ]', '[ 320 x i8 ]*', text, 'i64', 0, 'i64', 0)
+    pattern = module.const_cstr('%f')
+    size = fn.llvm.call('i32(i8*, i64, i8*, ...)', '@snprintf', 'i8*', data, 'i64', 320, 'i8*', pattern.name, 'double', '%right')
+    size = fn.llvm.sext('i32', 'i64', size)
+    fn.llvm.call('void', _require(module, fn, '@out.write'), 'i8*', data, 'i64', size)
+    fn.llvm.ret('void')
+
+    fn.llvm.label(fast)
+    fn.llvm.br_if_else(neg, sign, body)
+
+    fn.llvm.label(sign)
+    _out_cstr(module, fn, '-')
+    fn.llvm.br(body)
+
+    # printf rounds the exact value times 1e6 half to even. The product is
+    # scaled plus error, exactly, and scaled - floor(scaled) is exact too
+    fn.llvm.label(body)
+    scaled = fn.llvm.fmul('double', abs, '1.0e6')
+    minus  = fn.llvm.fsub('double', '-0.0', scaled)
+    error  = fn.llvm.call('double', '@llvm.fma.f64', 'double', abs, 'double', '1.0e6', 'double', minus)
+    floor  = fn.llvm.call('double', '@llvm.floor.f64', 'double', scaled)
+    rest   = fn.llvm.fsub('double', scaled, floor)
+    rest   = fn.llvm.fsub('double', rest, '0.5')
+    rest   = fn.llvm.fadd('double', rest, error)
+    fixed  = fn.llvm.fptoui('double', 'i64', floor)
+    above  = fn.llvm.fcmp('ogt', 'double', rest, '0.0')
+    half   = fn.llvm.fcmp('oeq', 'double', rest, '0.0')
+    odd    = fn.llvm.trunc('i64', 'i1', fixed)
+    even   = fn.llvm.and_('i1', half, odd)
+    up     = fn.llvm.or_('i1', above, even)
+    up     = fn.llvm.zext('i1', 'i64', up)
+    fixed  = fn.llvm.add('i64', fixed, up)
+    whole  = fn.llvm.udiv('i64', fixed, 1000000)
+    frac   = fn.llvm.urem('i64', fixed, 1000000)
+    uint   = _require(module, fn, '@out.uint')
+    fn.llvm.call('void', uint, 'i64', whole, 'i64', 10, 'i64', 1)
+    _out_cstr(module, fn, '.')
+    fn.llvm.call('void', uint, 'i64', frac, 'i64', 10, 'i64', 6)
+    fn.llvm.ret('void')
+
+    module.add_external('@snprintf', '%i32', [ '%ptr', '%i64', '%ptr', '%vararg' ])
+    module.add_external('@llvm.fma.f64', '%f64', [ '%f64', '%f64', '%f64' ])
+    module.add_external('@llvm.floor.f64', '%f64', [ '%f64' ])
+
+
+def _write_fpext(module, fn):
+    type  = fn.args['%right'].type.to_llvm_ir()
+    wide  = fn.llvm.fpext(type, 'double', '%right')
+    fname = _require(module, fn, mangle_name('write', '%void', '%f64'))
+    fn.llvm.call('void', fname, 'double', wide)
+    fn.llvm.ret('void')
+
+
+for _type in [ '%f16', '%f32' ]:
+    _operator('write', rtype=_type)(_write_fpext)
+
+
+# Buffered standard input.
+#
+# @in.buf holds the unread bytes between @in.pos and @in.len. Readers take
+# whitespace delimited tokens (or lines) straight out of it, terminated in
+# place, and read(2) is only called when it runs dry. The spare byte at the
+# end is for the terminator of a token that fills the whole buffer.
+
+IN_BUFFER_SIZE = 65536
+
+
+def _in_globals(module):
+    if '@in.buf' in module.variables:
+        return
+
+    btype = module.type('%in.buf', '[ {} x i8 ]'.format(IN_BUFFER_SIZE + 1))
+    module.new_global_var('@in.buf', btype, 'zeroinitializer', constant=False)
+    module.new_global_var('@in.pos', module.type('%i64'), '0', constant=False)
+    module.new_global_var('@in.len', module.type('%i64'), '0', constant=False)
+    module.add_external('@read', '%i64', [ '%i32', '%ptr', '%i64' ])
+    module.add_external('@llvm.memmove.p0i8.p0i8.i64', '%void', [ '%ptr', '%ptr', '%i64', '%bool' ])
+
+
+def _in_at(module, fn, index):
+    btype = module.type('%in.buf').to_llvm_ir()
+    return fn.llvm.get_element_ptr(btype, btype + '*', '@in.buf', 'i64', 0, 'i64', index)
+
+
+@_runtime('@in.fill', '%bool')
+def _in_fill(module, fn):
+    """ Moves the unread bytes to the front and reads more, false on EOF. """
+    _in_globals(module)
+
+    pos  = fn.llvm.load('i64', 'i64*', '@in.pos')
+    size = fn.llvm.load('i64', 'i64*', '@in.len')
+    left = fn.llvm.sub('i64', size, pos)
+    dst  = _in_at(module, fn, 0)
+    src  = _in_at(module, fn, pos)
+    fn.llvm.call('void', '@llvm.memmove.p0i8.p0i8.i64', 'i8*', dst, 'i8*', src, 'i64', left, 'i1', 'false')
+    fn.llvm.store('i64', 0, 'i64*', '@in.pos')
+
+    free = fn.llvm.sub('i64', IN_BUFFER_SIZE, left)
+    end  = _in_at(module, fn, left)
+    got  = fn.llvm.call('i64', '@read', 'i32', 0, 'i8*', end, 'i64', free)
+    more = fn.llvm.icmp('sgt', 'i64', got, 0)
+    got  = fn.llvm.select(more, 'i64', got, 0)
+    size = fn.llvm.add('i64', left, got)
+    fn.llvm.store('i64', size, 'i64*', '@in.len')
+    fn.llvm.ret('i1', more)
+
+
+@_runtime('@in.until', '%ptr', lines='%bool')
+def _in_until(module, fn):
+    """
+    Returns the text starting at @in.pos, up to the next whitespace (or only
+    newline, for lines), terminated in place. Null if there is nothing left.
+    """
+    _in_globals(module)
+    loop   = fn.llvm.next_lbl()
+    peek   = fn.llvm.next_lbl()
+    next   = fn.llvm.next_lbl()
+    refill = fn.llvm.next_lbl()
+    stop   = fn.llvm.next_lbl()
+    done   = fn.llvm.next_lbl()
+    none   = fn.llvm.next_lbl()
+
+    index = fn.llvm.alloca('i64')
+    start = fn.llvm.load('i64', 'i64*', '@in.pos')
+    fn.llvm.store('i64', start, 'i64*', index)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(loop)
+    at    = fn.llvm.load('i64', 'i64*', index)
+    size  = fn.llvm.load('i64', 'i64*', '@in.len')
+    empty = fn.llvm.icmp('eq', 'i64', at, size)
+    fn.llvm.br_if_else(empty, refill, peek)
+
+    # Keep the text contiguous: refilling shifts it to the front
+    fn.llvm.label(refill)
+    pos  = fn.llvm.load('i64', 'i64*', '@in.pos')
+    left = fn.llvm.sub('i64', size, pos)
+    full = fn.llvm.icmp('eq', 'i64', left, IN_BUFFER_SIZE)
+    fn.llvm.br_if_else(full, stop, refill + '.read')
+    fn.llvm.label(refill + '.read')
+    more = fn.llvm.call('i1', _require(module, fn, '@in.fill'))
+    fn.llvm.store('i64', left, 'i64*', index)
+    fn.llvm.br_if_else(more, loop, stop)
+
+    fn.llvm.label(peek)
+    char    = fn.llvm.load('i8', 'i8*', _in_at(module, fn, at))
+    newline = fn.llvm.icmp('eq', 'i8', char, 10)
+    space   = fn.llvm.icmp('ule', 'i8', char, 32)
+    delim   = fn.llvm.select('%lines', 'i1', newline, space)
+    fn.llvm.br_if_else(delim, stop, next)
+
+    fn.llvm.label(next)
+    at = fn.llvm.add('i64', at, 1)
+    fn.llvm.store('i64', at, 'i64*', index)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(stop)
+    at      = fn.llvm.load('i64', 'i64*', index)
+    pos     = fn.llvm.load('i64', 'i64*', '@in.pos')
+    size    = fn.llvm.load('i64', 'i64*', '@in.len')
+    blank   = fn.llvm.icmp('eq', 'i64', at, pos)
+    ateof   = fn.llvm.icmp('eq', 'i64', at, size)
+    nothing = fn.llvm.and_('i1', blank, ateof)
+    fn.llvm.br_if_else(nothing, none, done)
+
+    fn.llvm.label(done)
+    text = _in_at(module, fn, pos)
+    fn.llvm.store('i8', 0, 'i8*', _in_at(module, fn, at))
+    after = fn.llvm.add('i64', at, 1)
+    after = fn.llvm.select(ateof, 'i64', at, after)
+    fn.llvm.store('i64', after, 'i64*', '@in.pos')
+    fn.llvm.ret('i8*', text)
+
+    fn.llvm.label(none)
+    fn.llvm.ret('i8*', 'null')
+
+
+@_runtime('@in.token', '%ptr')
+def _in_token(module, fn):
+    """ Skips whitespace and returns the next token, null on EOF. """
+    _in_globals(module)
+    loop = fn.llvm.next_lbl()
+    peek = fn.llvm.next_lbl()
+    skip = fn.llvm.next_lbl()
+    next = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+    none = fn.llvm.next_lbl()
+
+    fn.llvm.br(loop)
+    fn.llvm.label(loop)
+    pos   = fn.llvm.load('i64', 'i64*', '@in.pos')
+    size  = fn.llvm.load('i64', 'i64*', '@in.len')
+    empty = fn.llvm.icmp('eq', 'i64', pos, size)
+    fn.llvm.br_if_else(empty, next, peek)
+
+    fn.llvm.label(next)
+    more = fn.llvm.call('i1', _require(module, fn, '@in.fill'))
+    fn.llvm.br_if_else(more, loop, none)
+
+    fn.llvm.label(peek)
+    char  = fn.llvm.load('i8', 'i8*', _in_at(module, fn, pos))
+    space = fn.llvm.icmp('ule', 'i8', char, 32)
+    fn.llvm.br_if_else(space, skip, done)
+
+    fn.llvm.label(skip)
+    pos = fn.llvm.add('i64', pos, 1)
+    fn.llvm.store('i64', pos, 'i64*', '@in.pos')
+    fn.llvm.br(loop)
+
+    fn.llvm.label(done)
+    text = fn.llvm.call('i8*', _require(module, fn, '@in.until'), 'i1', 0)
+    fn.llvm.ret('i8*', text)
+
+    fn.llvm.label(none)
+    fn.llvm.ret('i8*', 'null')
+
+
+@_operator('read', rtype='%i64.ptr', ftype='%bool')
+def void_read_i64ptr(module, fn):
+    sign = fn.llvm.next_lbl()
+    loop = fn.llvm.next_lbl()
+    next = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+    none = fn.llvm.next_lbl()
+
+    value = fn.llvm.alloca('i64')
+    index = fn.llvm.alloca('i64')
+    text  = fn.llvm.call('i8*', _require(module, fn, '@in.token'))
+    eof   = fn.llvm.icmp('eq', 'i8*', text, 'null')
+    fn.llvm.br_if_else(eof, none, sign)
+
+    fn.llvm.label(sign)
+    char  = fn.llvm.load('i8', 'i8*', text)
+    minus = fn.llvm.icmp('eq', 'i8', char, 45)
+    plus  = fn.llvm.icmp('eq', 'i8', char, 43)
+    skip  = fn.llvm.or_('i1', minus, plus)
+    first = fn.llvm.zext('i1', 'i64', skip)
+    fn.llvm.store('i64', 0, 'i64*', value)
+    fn.llvm.store('i64', first, 'i64*', index)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(loop)
+    at    = fn.llvm.load('i64', 'i64*', index)
+    char  = fn.llvm.load('i8', 'i8*', fn.llvm.get_element_ptr('i8', 'i8*', text, 'i64', at))
+    digit = fn.llvm.sub('i8', char, 48)
+    valid = fn.llvm.icmp('ult', 'i8', digit, 10)
+    fn.llvm.br_if_else(valid, next, done)
+
+    fn.llvm.label(next)
+    acc   = fn.llvm.load('i64', 'i64*', value)
+    acc   = fn.llvm.mul('i64', acc, 10)
+    digit = fn.llvm.zext('i8', 'i64', digit)
+    acc   = fn.llvm.add('i64', acc, digit)
+    fn.llvm.store('i64', acc, 'i64*', value)
+    after = fn.llvm.add('i64', at, 1)
+    fn.llvm.store('i64', after, 'i64*', index)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(done)
+    acc  = fn.llvm.load('i64', 'i64*', value)
+    inv  = fn.llvm.sub('i64', 0, acc)
+    acc  = fn.llvm.select(minus, 'i64', inv, acc)
+    fn.llvm.store('i64', acc, 'i64*', '%right')
+    read = fn.llvm.icmp('ugt', 'i64', at, first)
+    fn.llvm.ret('i1', read)
+
+    fn.llvm.label(none)
+    fn.llvm.ret('i1', 0)
+
+
+def _read_trunc(module, fn):
+    repr  = fn.args['%right'].type.to_llvm_ir()[:-1]
+    wide  = fn.llvm.alloca('i64')
+    fname = _require(module, fn, mangle_name('read', '%void', '%i64.ptr'))
+    read  = fn.llvm.call('i1', fname, 'i64*', wide)
+    value = fn.llvm.load('i64', 'i64*', wide)
+    value = fn.llvm.trunc('i64', repr, value)
+    fn.llvm.store(repr, value, repr + '*', '%right')
+    fn.llvm.ret('i1', read)
+
+
+for _type in [ '%i8.ptr', '%i16.ptr', '%i32.ptr' ]:
+    _operator('read', rtype=_type, ftype='%bool')(_read_trunc)
+
+
+@_operator('read', rtype='%f64.ptr', ftype='%bool')
+def void_read_f64ptr(module, fn):
+    body = fn.llvm.next_lbl()
+    none = fn.llvm.next_lbl()
+
+    end  = fn.llvm.alloca('i8*')
+    text = fn.llvm.call('i8*', _require(module, fn, '@in.token'))
+    eof  = fn.llvm.icmp('eq', 'i8*', text, 'null')
+    fn.llvm.br_if_else(eof, none, body)
+
+    fn.llvm.label(body)
+    value = fn.llvm.call('double', '@strtod', 'i8*', text, 'i8**', end)
+    fn.llvm.store('double', value, 'double*', '%right')
+    stop = fn.llvm.load('i8*', 'i8**', end)
+    read = fn.llvm.icmp('ne', 'i8*', stop, text)
+    fn.llvm.ret('i1', read)
+
+    fn.llvm.label(none)
+    fn.llvm.ret('i1', 0)
+
+    module.add_external('@strtod', '%f64', [ '%ptr', '%cstr.ptr' ])
+
+
+@_operator('read', rtype='%f32.ptr', ftype='%bool')
+def void_read_f32ptr(module, fn):
+    wide  = fn.llvm.alloca('double')
+    fname = _require(module, fn, mangle_name('read', '%void', '%f64.ptr'))
+    read  = fn.llvm.call('i1', fname, 'double*', wide)
+    value = fn.llvm.load('double', 'double*', wide)
+    value = fn.llvm.fptrunc('double', 'float', value)
+    fn.llvm.store('float', value, 'float*', '%right')
+    fn.llvm.ret('i1', read)
+
+
+@_operator('read', rtype='%cstr.ptr', ftype='%bool')
+def void_read_cstrptr(module, fn):
+    """ Tokens point into the input buffer: they are valid until the next read. """
+    text = fn.llvm.call('i8*', _require(module, fn, '@in.token'))
+    fn.llvm.store('i8*', text, 'i8**', '%right')
+    read = fn.llvm.icmp('ne', 'i8*', text, 'null')
+    fn.llvm.ret('i1', read)
+
+
+@_operator('read_line', rtype='%cstr.ptr', ftype='%bool')
+def void_readline_cstrptr(module, fn):
+    """ Same as reading a token, but up to the end of the line. """
+    text = fn.llvm.call('i8*', _require(module, fn, '@in.until'), 'i1', 1)
+    fn.llvm.store('i8*', text, 'i8**', '%right')
+    read = fn.llvm.icmp('ne', 'i8*', text, 'null')
+    fn.llvm.ret('i1', read)
+
+
+# Memory mapped files.
+#
+# A mapping is a list.i8 view ({ length, data }) straight over the pages of
+# the file, read only. Failures give an empty view with null data.
+
+@_operator('mmap', rtype='%cstr', ftype='%list.i8')
+def void_mmap_cstr(module, fn):
+    ltype = fn.rtype.to_llvm_ir()
+    size  = fn.llvm.next_lbl()
+    map   = fn.llvm.next_lbl()
+    done  = fn.llvm.next_lbl()
+    fail  = fn.llvm.next_lbl()
+    shut  = fn.llvm.next_lbl()
+
+    fd  = fn.llvm.call('i32(i8*, i32, ...)', '@open', 'i8*', '%right', 'i32', 0)   # O_RDONLY
+    bad = fn.llvm.icmp('slt', 'i32', fd, 0)
+    fn.llvm.br_if_else(bad, fail, size)
+
+    fn.llvm.label(size)
+    length = fn.llvm.call('i64', '@lseek', 'i32', fd, 'i64', 0, 'i32', 2)   # SEEK_END
+    empty  = fn.llvm.icmp('sle', 'i64', length, 0)
+    fn.llvm.br_if_else(empty, shut, map)
+
+    fn.llvm.label(map)
+    data = fn.llvm.call('i8*', '@mmap', 'i8*', 'null', 'i64', length, 'i32', 1, 'i32', 2, 'i32', fd, 'i64', 0)   # PROT_READ, MAP_PRIVATE
+    fn.llvm.call('i32', '@close', 'i32', fd)
+    addr   = fn.llvm.ptrtoint('i8*', 'i64', data)
+    failed = fn.llvm.icmp('eq', 'i64', addr, -1)   # MAP_FAILED
+    fn.llvm.br_if_else(failed, fail, done)
+
+    fn.llvm.label(done)
+    view = fn.llvm.insert_value(ltype, 'undef', 'i64', length, 0)
+    view = fn.llvm.insert_value(ltype, view, 'i8*', data, 1)
+    fn.llvm.ret(ltype, view)
+
+    fn.llvm.label(shut)
+    fn.llvm.call('i32', '@close', 'i32', fd)
+    fn.llvm.br(fail)
+
+    fn.llvm.label(fail)
+    fn.llvm.ret(ltype, 'zeroinitializer')
+
+    module.add_external('@open',  '%i32', [ '%ptr', '%i32', '%vararg' ])
+    module.add_external('@lseek', '%i64', [ '%i32', '%i64', '%i32' ])
+    module.add_external('@mmap',  '%ptr', [ '%ptr', '%i64', '%i32', '%i32', '%i32', '%i64' ])
+    module.add_external('@close', '%i32', [ '%i32' ])
+
+
+@_operator('unmap', rtype='%list.i8', ftype='%bool')
+def void_unmap_listi8(module, fn):
+    ltype  = module.type('%list.i8').to_llvm_ir()
+    length = fn.llvm.extract_value(ltype, '%right', 0)
+    data   = fn.llvm.extract_value(ltype, '%right', 1)
+    result = fn.llvm.call('i32', '@munmap', 'i8*', data, 'i64', length)
+    done   = fn.llvm.icmp('eq', 'i32', result, 0)
+    fn.llvm.ret('i1', done)
+
+    module.add_external('@munmap', '%i32', [ '%ptr', '%i64' ])
+
+
+@_operator('length', rtype='%list.i8', ftype='%i64')
+def void_length_listi8(module, fn):
+    length = fn.llvm.extract_value(module.type('%list.i8').to_llvm_ir(), '%right', 0)
+    fn.llvm.ret('i64', length)
+
+
+@_operator('data', rtype='%list.i8', ftype='%cstr')
+def void_data_listi8(module, fn):
+    data = fn.llvm.extract_value(module.type('%list.i8').to_llvm_ir(), '%right', 1)
+    fn.llvm.ret('i8*', data)
+
+
+def _listi8_at(module, fn):
+    data = fn.llvm.extract_value(module.type('%list.i8').to_llvm_ir(), '%left', 1)
+    ptr  = fn.llvm.get_element_ptr('i8', 'i8*', data, fn.args['%right'].type.to_llvm_ir(), '%right')
+    reg  = fn.llvm.load('i8', 'i8*', ptr)
+    fn.llvm.ret('i8', reg)
+
+
+for _type in [ '%i32', '%i64' ]:
+    _operator('@', '%list.i8', _type, '%i8')(_listi8_at)
+
+
+def _printf(module, fn, pattern, value=None):
+    pattern = module.const_cstr(pattern)
+
+    if value is None:
+        rtype = fn.args['%right'].type.to_llvm_ir()
+        rreg  = '%right'
+    elif isinstance(value, Variable):
+        rtype = value.type.to_llvm_ir()
+        rreg  = value.name
+    else:
+        rtype = '%cstr'
+        rreg  = module.const_cstr(value).name
+
+    fn.llvm.call('i32(%cstr, ...)', '@printf', '%cstr', pattern.name, rtype, rreg)
+
+
+# Parallel loops.
+#
+# The first parallel loop starts a pool of threads, one per CPU or as many as
+# $INFIX_THREADS says, which wait for work until the program exits. @par.run
+# publishes the outlined body of a loop and its environment, wakes the pool,
+# runs its own share as worker 0 and waits for every other worker to be done.
+# What the calling thread wrote is flushed before the pool wakes, and every
+# other worker flushes its own output when its share is done (see @out.buf).
+# A loop that starts while another one runs, from its body or from anything
+# it calls, runs on the calling thread alone.
+
+# pthread_mutex_t and pthread_cond_t fit in 64 bytes, and all zeros is their
+# static initializer on glibc
+PTHREAD_OBJECT = '[ 8 x i64 ]'
+
+# sysconf(_SC_NPROCESSORS_ONLN) on Linux
+SC_NPROCESSORS_ONLN = 84
+
+# Outlined loop bodies are void (i8* env, i32 worker, i32 workers)
+JOB_TYPE = 'void (i8*, i32, i32)*'
+
+
+def _par_globals(module):
+    if '@par.lock' in module.variables:
+        return
+
+    ptype = module.type('%par.pthread', PTHREAD_OBJECT)
+    module.new_global_var('@par.lock',    ptype, 'zeroinitializer', constant=False)
+    module.new_global_var('@par.wake',    ptype, 'zeroinitializer', constant=False)
+    module.new_global_var('@par.done',    ptype, 'zeroinitializer', constant=False)
+    module.new_global_var('@par.threads', module.type('%i32'),  '0',     constant=False)
+    module.new_global_var('@par.round',   module.type('%i64'),  '0',     constant=False)
+    module.new_global_var('@par.pending', module.type('%i32'),  '0',     constant=False)
+    module.new_global_var('@par.busy',    module.type('%bool'), 'false', constant=False)
+    module.new_global_var('@par.job',     module.type('%ptr'),  'null',  constant=False)
+    module.new_global_var('@par.env',     module.type('%ptr'),  'null',  constant=False)
+
+    module.add_external('@pthread_create',         '%i32', [ '%ptr', '%ptr', '%ptr', '%ptr' ])
+    module.add_external('@pthread_mutex_lock',     '%i32', [ '%ptr' ])
+    module.add_external('@pthread_mutex_unlock',   '%i32', [ '%ptr' ])
+    module.add_external('@pthread_cond_wait',      '%i32', [ '%ptr', '%ptr' ])
+    module.add_external('@pthread_cond_signal',    '%i32', [ '%ptr' ])
+    module.add_external('@pthread_cond_broadcast', '%i32', [ '%ptr' ])
+    module.add_external('@sysconf', '%i64', [ '%i32' ])
+    module.add_external('@getenv',  '%ptr', [ '%ptr' ])
+    module.add_external('@atoi',    '%i32', [ '%ptr' ])
+
+
+def _par_object(fn, name):
+    return fn.llvm.bitcast('%par.pthread*', 'i8*', name)
+
+
+def _par_lock(fn):
+    fn.llvm.call('i32', '@pthread_mutex_lock', 'i8*', _par_object(fn, '@par.lock'))
+
+
+def _par_unlock(fn):
+    fn.llvm.call('i32', '@pthread_mutex_unlock', 'i8*', _par_object(fn, '@par.lock'))
+
+
+def _par_wait(fn, cond):
+    fn.llvm.call('i32', '@pthread_cond_wait', 'i8*', _par_object(fn, cond), 'i8*', _par_object(fn, '@par.lock'))
+
+
+@_runtime('@par.start')
+def _par_start(module, fn):
+    _par_globals(module)
+    init  = fn.llvm.next_lbl()
+    cpus  = fn.llvm.next_lbl()
+    given = fn.llvm.next_lbl()
+    size  = fn.llvm.next_lbl()
+    head  = fn.llvm.next_lbl()
+    spawn = fn.llvm.next_lbl()
+    done  = fn.llvm.next_lbl()
+
+    threads = fn.llvm.load('i32', 'i32*', '@par.threads')
+    started = fn.llvm.icmp('ne', 'i32', threads, 0)
+    fn.llvm.br_if_else(started, done, init)
+
+    fn.llvm.label(init)
+    tid  = fn.llvm.alloca('i64')
+    name = module.const_cstr('INFIX_THREADS').name
+    env  = fn.llvm.call('i8*', '@getenv', 'i8*', name)
+    none = fn.llvm.icmp('eq', 'i8*', env, 'null')
+    fn.llvm.br_if_else(none, cpus, given)
+
+    fn.llvm.label(given)
+    asked = fn.llvm.call('i32', '@atoi', 'i8*', env)
+    fn.llvm.br(size)
+
+    fn.llvm.label(cpus)
+    online = fn.llvm.call('i64', '@sysconf', 'i32', SC_NPROCESSORS_ONLN)
+    online = fn.llvm.trunc('i64', 'i32', online)
+    fn.llvm.br(size)
+
+    fn.llvm.label(size)
+    count = fn.llvm.phi('i32', asked, given, online, cpus)
+    none  = fn.llvm.icmp('slt', 'i32', count, 1)
+    count = fn.llvm.select(none, 'i32', 1, count)
+    fn.llvm.store('i32', count, 'i32*', '@par.threads')
+    fn.llvm.br(head)
+
+    # The calling thread is worker 0
+    fn.llvm.label(head)
+    index = fn.llvm.next_reg()
+    after = fn.llvm.next_reg()
+    index = fn.llvm.phi('i32', 1, size, after, spawn)
+    more  = fn.llvm.icmp('slt', 'i32', index, count)
+    fn.llvm.br_if_else(more, spawn, done)
+
+    fn.llvm.label(spawn)
+    arg    = fn.llvm.inttoptr('i32', 'i8*', index)
+    worker = 'bitcast (i8* (i8*)* {} to i8*)'.format(_require(module, fn, '@par.worker'))
+    handle = fn.llvm.bitcast('i64*', 'i8*', tid)
+    fn.llvm.call('i32', '@pthread_create', 'i8*', handle, 'i8*', 'null', 'i8*', worker, 'i8*', arg)
+    fn.llvm.add('i32', index, 1, reg=after)
+    fn.llvm.br(head)
+
+    fn.llvm.label(done)
+    fn.llvm.ret('void')
+
+
+@_runtime('@par.worker', '%ptr', index='%ptr')
+def _par_worker(module, fn):
+    _par_globals(module)
+    loop  = fn.llvm.next_lbl()
+    check = fn.llvm.next_lbl()
+    sleep = fn.llvm.next_lbl()
+    work  = fn.llvm.next_lbl()
+    last  = fn.llvm.next_lbl()
+    next  = fn.llvm.next_lbl()
+
+    seen  = fn.llvm.alloca('i64')
+    fn.llvm.store('i64', 0, 'i64*', seen)
+    index = fn.llvm.ptrtoint('i8*', 'i32', '%index')
+    fn.llvm.br(loop)
+
+    fn.llvm.label(loop)
+    _par_lock(fn)
+    fn.llvm.br(check)
+
+    fn.llvm.label(check)
+    round = fn.llvm.load('i64', 'i64*', '@par.round')
+    known = fn.llvm.load('i64', 'i64*', seen)
+    same  = fn.llvm.icmp('eq', 'i64', round, known)
+    fn.llvm.br_if_else(same, sleep, work)
+
+    fn.llvm.label(sleep)
+    _par_wait(fn, '@par.wake')
+    fn.llvm.br(check)
+
+    fn.llvm.label(work)
+    fn.llvm.store('i64', round, 'i64*', seen)
+    job     = fn.llvm.load('i8*', 'i8**', '@par.job')
+    env     = fn.llvm.load('i8*', 'i8**', '@par.env')
+    workers = fn.llvm.load('i32', 'i32*', '@par.threads')
+    _par_unlock(fn)
+
+    job = fn.llvm.bitcast('i8*', JOB_TYPE, job)
+    fn.llvm.call('void', job, 'i8*', env, 'i32', index, 'i32', workers)
+    fn.llvm.call('void', _require(module, fn, '@out.flush'))
+
+    _par_lock(fn)
+    pending = fn.llvm.load('i32', 'i32*', '@par.pending')
+    pending = fn.llvm.sub('i32', pending, 1)
+    fn.llvm.store('i32', pending, 'i32*', '@par.pending')
+    all     = fn.llvm.icmp('eq', 'i32', pending, 0)
+    fn.llvm.br_if_else(all, last, next)
+
+    fn.llvm.label(last)
+    fn.llvm.call('i32', '@pthread_cond_signal', 'i8*', _par_object(fn, '@par.done'))
+    fn.llvm.br(next)
+
+    fn.llvm.label(next)
+    _par_unlock(fn)
+    fn.llvm.br(loop)
+
+
+@_runtime('@par.run', job='%ptr', env='%ptr')
+def _par_run(module, fn):
+    _par_globals(module)
+    alone  = fn.llvm.next_lbl()
+    spread = fn.llvm.next_lbl()
+    check  = fn.llvm.next_lbl()
+    sleep  = fn.llvm.next_lbl()
+    done   = fn.llvm.next_lbl()
+
+    fn.llvm.call('void', _require(module, fn, '@par.start'))
+    job  = fn.llvm.bitcast('i8*', JOB_TYPE, '%job')
+    busy = fn.llvm.load('i1', 'i1*', '@par.busy')
+    fn.llvm.br_if_else(busy, alone, spread)
+
+    fn.llvm.label(alone)
+    fn.llvm.call('void', job, 'i8*', '%env', 'i32', 0, 'i32', 1)
+    fn.llvm.ret('void')
+
+    fn.llvm.label(spread)
+    fn.llvm.call('void', _require(module, fn, '@out.flush'))
+    fn.llvm.store('i1', 'true', 'i1*', '@par.busy')
+    workers = fn.llvm.load('i32', 'i32*', '@par.threads')
+
+    _par_lock(fn)
+    fn.llvm.store('i8*', '%job', 'i8**', '@par.job')
+    fn.llvm.store('i8*', '%env', 'i8**', '@par.env')
+    others = fn.llvm.sub('i32', workers, 1)
+    fn.llvm.store('i32', others, 'i32*', '@par.pending')
+    round  = fn.llvm.load('i64', 'i64*', '@par.round')
+    round  = fn.llvm.add('i64', round, 1)
+    fn.llvm.store('i64', round, 'i64*', '@par.round')
+    fn.llvm.call('i32', '@pthread_cond_broadcast', 'i8*', _par_object(fn, '@par.wake'))
+    _par_unlock(fn)
+
+    fn.llvm.call('void', job, 'i8*', '%env', 'i32', 0, 'i32', workers)
+
+    _par_lock(fn)
+    fn.llvm.br(check)
+
+    fn.llvm.label(check)
+    pending = fn.llvm.load('i32', 'i32*', '@par.pending')
+    all     = fn.llvm.icmp('eq', 'i32', pending, 0)
+    fn.llvm.br_if_else(all, done, sleep)
+
+    fn.llvm.label(sleep)
+    _par_wait(fn, '@par.done')
+    fn.llvm.br(check)
+
+    fn.llvm.label(done)
+    _par_unlock(fn)
+    fn.llvm.store('i1', 'false', 'i1*', '@par.busy')
+    fn.llvm.ret('void')
+
+
+# Arithmetic and comparisons, for every integer and float width.
+#
+# Each entry maps the operator to the LLVM instruction for integers and for
+# floats. Comparisons always give a bool.
+
+INTEGER_TYPES = [ '%i8', '%i16', '%i32', '%i64' ]
+FLOAT_TYPES   = [ '%f16', '%f32', '%f64' ]
+
+ARITHMETIC = {
+    '+' : ('add',  'fadd'),
+    '-' : ('sub',  'fsub'),
+    '*' : ('mul',  'fmul'),
+    '/' : ('sdiv', 'fdiv'),
+    '%' : ('srem', 'frem'),
+}
+
+# Signed, unsigned (bool, where true is 1, and ptr) and float predicates
+COMPARISON = {
+    '==' : ('eq',  'eq',  'oeq'),
+    '!=' : ('ne',  'ne',  'une'),
+    '<'  : ('slt', 'ult', 'olt'),
+    '<=' : ('sle', 'ule', 'ole'),
+    '>'  : ('sgt', 'ugt', 'ogt'),
+    '>=' : ('sge', 'uge', 'oge'),
+}
+
+
+def _arithmetic(instr):
+    def body(module, fn):
+        reg = getattr(fn.llvm, instr)(fn.rtype.to_llvm_ir(), '%left', '%right')
+        fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
+    return body
+
+
+def _comparison(instr, cond):
+    def body(module, fn):
+        reg = getattr(fn.llvm, instr)(cond, fn.args['%left'].type.to_llvm_ir(), '%left', '%right')
+        fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
+    return body
+
+
+for _op, (_int, _float) in ARITHMETIC.items():
+    for _type in INTEGER_TYPES:
+        _operator(_op, _type, _type, _type)(_arithmetic(_int))
+    for _type in FLOAT_TYPES:
+        _operator(_op, _type, _type, _type)(_arithmetic(_float))
+
+for _op, (_int, _uint, _float) in COMPARISON.items():
+    for _type in INTEGER_TYPES:
+        _operator(_op, _type, _type, '%bool')(_comparison('icmp', _int))
+    for _type in [ '%bool', '%ptr' ]:
+        _operator(_op, _type, _type, '%bool')(_comparison('icmp', _uint))
+    for _type in FLOAT_TYPES:
+        _operator(_op, _type, _type, '%bool')(_comparison('fcmp', _float))
+
+
+@_operator('@', '%cstr.ptr', '%i32', '%cstr')
+def cstrptr_at_i32(module, fn):
+    ptr = fn.llvm.get_element_ptr(
+        module.type('%cstr').to_llvm_ir(),
+        module.type('%cstr.ptr').to_llvm_ir(), '%left',
+        module.type('%i32').to_llvm_ir(),      '%right',
+    )
+    reg = fn.llvm.load(
+        module.type('%cstr').to_llvm_ir(),
+        module.type('%cstr.ptr').to_llvm_ir(),
+        ptr
+    )
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
+
+
+@_operator('@', '%cstr', '%i32', '%i8')
+def cstr_at_i32(module, fn):
+    ptr = fn.llvm.get_element_ptr(
+        module.type('%i8').to_llvm_ir(),
+        module.type('%cstr').to_llvm_ir(), '%left',
+        module.type('%i32').to_llvm_ir(),  '%right',
+    )
+    reg = fn.llvm.load(
+        module.type('%i8').to_llvm_ir(),
+        module.type('%cstr').to_llvm_ir(),
+        ptr
+    )
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), reg)
+
+
+
+
+# Pointers written through, such as the value slots of maps.
+
+def _ptr_set(module, fn):
+    vtype = fn.rtype.to_llvm_ir()
+    fn.llvm.store(vtype, '%right', vtype + '*', '%left')
+    fn.llvm.ret(vtype, '%right')
+
+
+for _type in [ '%bool' ] + INTEGER_TYPES + FLOAT_TYPES:
+    _operator('set', _type + '.ptr', _type, _type)(_ptr_set)
+
+
+# Lists.
+#
+# A list is its length and a pointer to its elements, which are in the frame
+# of the operator that made it or on the heap (see src/escape.py). list.i8
+# also comes from mmap, with length and @ of its own.
+
+def _list_parts(module, fn, arg):
+    """ Element type, length and data of the list in arg """
+    ltype = fn.args[arg].type
+    etype = module.type('%' + ltype.name[len('%list.'):])
+    size  = fn.llvm.extract_value(ltype.to_llvm_ir(), arg, 0)
+    data  = fn.llvm.extract_value(ltype.to_llvm_ir(), arg, 1)
+    return etype, size, data
+
+
+@_family('write', '%list.')
+def _list_write(module, fn):
+    """ [a, b, c], each element with its own write """
+    etype, size, data = _list_parts(module, fn, '%right')
+    vtype = etype.to_llvm_ir()
+    write = _require(module, fn, mangle_name('write', '%void', etype.name))
+    pre   = fn.llvm.next_lbl()
+    head  = fn.llvm.next_lbl()
+    body  = fn.llvm.next_lbl()
+    comma = fn.llvm.next_lbl()
+    item  = fn.llvm.next_lbl()
+    done  = fn.llvm.next_lbl()
+
+    _out_cstr(module, fn, '[')
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(head)
+
+    after = fn.llvm.next_reg()
+
+    fn.llvm.label(head)
+    index = fn.llvm.phi('i64', 0, pre, after, item)
+    more  = fn.llvm.icmp('slt', 'i64', index, size)
+    fn.llvm.br_if_else(more, body, done)
+
+    fn.llvm.label(body)
+    first = fn.llvm.icmp('eq', 'i64', index, 0)
+    fn.llvm.br_if_else(first, item, comma)
+
+    fn.llvm.label(comma)
+    _out_cstr(module, fn, ', ')
+    fn.llvm.br(item)
+
+    fn.llvm.label(item)
+    ptr   = fn.llvm.get_element_ptr(vtype, vtype + '*', data, 'i64', index)
+    value = fn.llvm.load(vtype, vtype + '*', ptr)
+    fn.llvm.call('void', write, vtype, value)
+    fn.llvm.add('i64', index, 1, reg=after)
+    fn.llvm.br(head)
+
+    fn.llvm.label(done)
+    _out_cstr(module, fn, ']')
+    fn.llvm.ret('void')
+
+
+@_family('length', '%list.', ftype=lambda type: '%i64')
+def _list_length(module, fn):
+    _, size, _ = _list_parts(module, fn, '%right')
+    fn.llvm.ret('i64', size)
+
+
+@_family('@', '%list.', [ '%i32', '%i64' ], ftype=lambda type: '%' + type.name[len('%list.'):])
+def _list_at(module, fn):
+    etype, _, data = _list_parts(module, fn, '%left')
+    vtype = etype.to_llvm_ir()
+    ptr   = fn.llvm.get_element_ptr(vtype, vtype + '*', data, fn.args['%right'].type.to_llvm_ir(), '%right')
+    value = fn.llvm.load(vtype, vtype + '*', ptr)
+    fn.llvm.ret(vtype, value)
+
+
+# Structs.
+#
+# Heterogeneous lists are structs, held by value. Like lists, their types are
+# made as programs build them, so their builtins cover the whole family.
+
+@_family('write', '%struct.')
+def _struct_write(module, fn):
+    """ [a, b, c], each field with its own write """
+    stype = fn.args['%right'].type
+    _out_cstr(module, fn, '[')
+    for index, ftype in enumerate(stype.fields):
+        if index > 0:
+            _out_cstr(module, fn, ', ')
+        write = _require(module, fn, mangle_name('write', '%void', ftype.name))
+        value = fn.llvm.extract_value(stype.to_llvm_ir(), '%right', stype.layout[index])
+        fn.llvm.call('void', write, ftype.to_llvm_ir(), value)
+    _out_cstr(module, fn, ']')
+    fn.llvm.ret('void')
+
+
+# Hash maps.
+#
+# A map points to its header: the number of live keys, of used slots (live
+# or deleted), the mask of slot indices and the slots. Slots are { hash, key,
+# value } in one array, probed linearly from hash & mask. A hash of 0 marks
+# an empty slot and 1 a deleted one. Hashes of keys have the top bit set, so
+# they are never either. The array doubles when used slots would fill three
+# quarters of it. String keys are copied into the map.
+
+# Key and value types of every map type
+MAP_TYPES = {
+    '%map.i32'  : ('%i32',  '%i32'),
+    '%map.i64'  : ('%i64',  '%i64'),
+    '%map.cstr' : ('%cstr', '%i32'),
+}
+
+MAP_MIN_SLOTS = 8
+
+MAP_EMPTY   = 0
+MAP_DELETED = 1
+MAP_LIVE    = -2 ** 63   # Top bit of a hash
+
+# 2^64 / golden ratio, which integer keys are multiplied by, and the 64-bit
+# FNV-1a constants for string keys, all as signed i64
+MAP_GOLDEN = -7046029254386353131
+FNV_OFFSET = -3750763034362895579
+FNV_PRIME  = 1099511628211
+
+
+def _map_slot(module, mtype):
+    key, value = MAP_TYPES[mtype]
+    stype = module.type(mtype + '.slot', '{{ i64, {}, {} }}'.format(
+        module.type(key).to_llvm_ir(), module.type(value).to_llvm_ir()
+    ))
+    return stype.to_llvm_ir()
+
+
+def _sizeof(ltype):
+    return 'ptrtoint ({t}* getelementptr ({t}, {t}* null, i32 1) to i64)'.format(t=ltype)
+
+
+def _map_field(fn, map, index):
+    return fn.llvm.get_element_ptr('%map.head', '%map.head*', map, 'i32', 0, 'i32', index)
+
+
+def _map_at(module, fn, map, index):
+    """ Pointer to the slot at index """
+    stype = _map_slot(module, fn.args[map].type.name)
+    slots = fn.llvm.load('i8*', 'i8**', _map_field(fn, map, 3))
+    slots = fn.llvm.bitcast('i8*', stype + '*', slots)
+    return fn.llvm.get_element_ptr(stype, stype + '*', slots, 'i64', index)
+
+
+def _map_hash(module, fn, key):
+    ktype = fn.args[key].type.name
+    if ktype == '%cstr':
+        hash = fn.llvm.call('i64', _require(module, fn, '@map.hash.cstr'), 'i8*', key)
+    else:
+        wide = key if ktype == '%i64' else fn.llvm.sext(ktype[1:], 'i64', key)
+        hash = fn.llvm.mul('i64', wide, MAP_GOLDEN)
+        high = fn.llvm.lshr('i64', hash, 32)
+        hash = fn.llvm.xor('i64', hash, high)
+    return fn.llvm.or_('i64', hash, MAP_LIVE)
+
+
+def _map_probe(module, fn, map, key):
+    """ Hash of key and the index of its slot, see the probe runtime """
+    mtype = fn.args[map].type
+    hash  = _map_hash(module, fn, key)
+    probe = _require(module, fn, '@{}.probe'.format(mtype.name[1:]))
+    index = fn.llvm.call('i64', probe, mtype.to_llvm_ir(), map,
+                         fn.args[key].type.to_llvm_ir(), key, 'i64', hash)
+    return hash, index
+
+
+@_runtime('@map.hash.cstr', '%i64', text='%cstr')
+def _map_hash_cstr(module, fn):
+    """ 64-bit FNV-1a of the bytes of text, folded so the low bits see all of them """
+    pre  = fn.llvm.next_lbl()
+    loop = fn.llvm.next_lbl()
+    more = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(loop)
+
+    after = fn.llvm.next_reg()
+    next  = fn.llvm.next_reg()
+
+    fn.llvm.label(loop)
+    hash = fn.llvm.phi('i64', FNV_OFFSET, pre, next, more)
+    at   = fn.llvm.phi('i64', 0, pre, after, more)
+    ptr  = fn.llvm.get_element_ptr('i8', 'i8*', '%text', 'i64', at)
+    byte = fn.llvm.load('i8', 'i8*', ptr)
+    end  = fn.llvm.icmp('eq', 'i8', byte, 0)
+    fn.llvm.br_if_else(end, done, more)
+
+    fn.llvm.label(more)
+    byte = fn.llvm.zext('i8', 'i64', byte)
+    mix  = fn.llvm.xor('i64', hash, byte)
+    fn.llvm.mul('i64', mix, FNV_PRIME, reg=next)
+    fn.llvm.add('i64', at, 1, reg=after)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(done)
+    high = fn.llvm.lshr('i64', hash, 32)
+    hash = fn.llvm.xor('i64', hash, high)
+    fn.llvm.ret('i64', hash)
+
+
+def _map_probe_runtime(module, fn):
+    """
+    Index of the slot that holds key, or the complement (negative) of the
+    slot it would go into: the first deleted one on its way, or the empty
+    one it ended on.
+    """
+    stype = _map_slot(module, fn.args['%map'].type.name)
+    ktype = fn.args['%key'].type.to_llvm_ir()
+    pre    = fn.llvm.next_lbl()
+    loop   = fn.llvm.next_lbl()
+    check  = fn.llvm.next_lbl()
+    tomb   = fn.llvm.next_lbl()
+    live   = fn.llvm.next_lbl()
+    same   = fn.llvm.next_lbl()
+    step   = fn.llvm.next_lbl()
+    absent = fn.llvm.next_lbl()
+    found  = fn.llvm.next_lbl()
+
+    mask  = fn.llvm.load('i64', 'i64*', _map_field(fn, '%map', 2))
+    start = fn.llvm.and_('i64', '%hash', mask)
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(loop)
+
+    next  = fn.llvm.next_reg()
+    spare = fn.llvm.next_reg()
+
+    fn.llvm.label(loop)
+    index = fn.llvm.phi('i64', start, pre, next, step)
+    first = fn.llvm.phi('i64', -1, pre, spare, step)
+    slot  = _map_at(module, fn, '%map', index)
+    hash  = fn.llvm.load('i64', 'i64*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 0))
+    empty = fn.llvm.icmp('eq', 'i64', hash, MAP_EMPTY)
+    fn.llvm.br_if_else(empty, absent, check)
+
+    fn.llvm.label(check)
+    dead = fn.llvm.icmp('eq', 'i64', hash, MAP_DELETED)
+    fn.llvm.br_if_else(dead, tomb, live)
+
+    fn.llvm.label(tomb)
+    none  = fn.llvm.icmp('slt', 'i64', first, 0)
+    reuse = fn.llvm.select(none, 'i64', index, first)
+    fn.llvm.br(step)
+
+    # Hashes are compared first, keys only when those are equal
+    fn.llvm.label(live)
+    match = fn.llvm.icmp('eq', 'i64', hash, '%hash')
+    fn.llvm.br_if_else(match, same, step)
+
+    fn.llvm.label(same)
+    key = fn.llvm.load(ktype, ktype + '*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 1))
+    if fn.args['%key'].type.name == '%cstr':
+        order = fn.llvm.call('i32', '@strcmp', 'i8*', key, 'i8*', '%key')
+        equal = fn.llvm.icmp('eq', 'i32', order, 0)
+        module.add_external('@strcmp', '%i32', [ '%ptr', '%ptr' ])
+    else:
+        equal = fn.llvm.icmp('eq', ktype, key, '%key')
+    fn.llvm.br_if_else(equal, found, step)
+
+    fn.llvm.label(step)
+    fn.llvm.phi('i64', reuse, tomb, first, live, first, same, reg=spare)
+    after = fn.llvm.add('i64', index, 1)
+    fn.llvm.and_('i64', after, mask, reg=next)
+    fn.llvm.br(loop)
+
+    fn.llvm.label(absent)
+    none = fn.llvm.icmp('slt', 'i64', first, 0)
+    into = fn.llvm.select(none, 'i64', index, first)
+    into = fn.llvm.xor('i64', into, -1)
+    fn.llvm.ret('i64', into)
+
+    fn.llvm.label(found)
+    fn.llvm.ret('i64', index)
+
+
+def _map_grow(module, fn):
+    """ Moves the live slots into a new array, twice as large unless most used slots were deleted """
+    stype  = _map_slot(module, fn.args['%map'].type.name)
+    pre    = fn.llvm.next_lbl()
+    head   = fn.llvm.next_lbl()
+    body   = fn.llvm.next_lbl()
+    move   = fn.llvm.next_lbl()
+    seek   = fn.llvm.next_lbl()
+    place  = fn.llvm.next_lbl()
+    next   = fn.llvm.next_lbl()
+    done   = fn.llvm.next_lbl()
+
+    count = fn.llvm.load('i64', 'i64*', _map_field(fn, '%map', 0))
+    mask  = fn.llvm.load('i64', 'i64*', _map_field(fn, '%map', 2))
+    old   = fn.llvm.load('i8*', 'i8**', _map_field(fn, '%map', 3))
+    size  = fn.llvm.add('i64', mask, 1)
+    need  = fn.llvm.add('i64', count, 1)
+    need  = fn.llvm.mul('i64', need, 2)
+    crowd = fn.llvm.icmp('ugt', 'i64', need, size)
+    twice = fn.llvm.mul('i64', size, 2)
+    nsize = fn.llvm.select(crowd, 'i64', twice, size)
+    nmask = fn.llvm.sub('i64', nsize, 1)
+    raw   = fn.llvm.call('i8*', '@calloc', 'i64', nsize, 'i64', _sizeof(stype))
+    slots = fn.llvm.bitcast('i8*', stype + '*', raw)
+    olds  = fn.llvm.bitcast('i8*', stype + '*', old)
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(head)
+
+    after = fn.llvm.next_reg()
+
+    fn.llvm.label(head)
+    index = fn.llvm.phi('i64', 0, pre, after, next)
+    more  = fn.llvm.icmp('ult', 'i64', index, size)
+    fn.llvm.br_if_else(more, body, done)
+
+    fn.llvm.label(body)
+    slot = fn.llvm.get_element_ptr(stype, stype + '*', olds, 'i64', index)
+    hash = fn.llvm.load('i64', 'i64*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 0))
+    live = fn.llvm.icmp('slt', 'i64', hash, 0)
+    fn.llvm.br_if_else(live, move, next)
+
+    # Keys are all different, only a free slot is looked for
+    fn.llvm.label(move)
+    start = fn.llvm.and_('i64', hash, nmask)
+    fn.llvm.br(seek)
+
+    skip = fn.llvm.next_reg()
+
+    fn.llvm.label(seek)
+    at    = fn.llvm.phi('i64', start, move, skip, seek)
+    dst   = fn.llvm.get_element_ptr(stype, stype + '*', slots, 'i64', at)
+    taken = fn.llvm.load('i64', 'i64*', fn.llvm.get_element_ptr(stype, stype + '*', dst, 'i32', 0, 'i32', 0))
+    taken = fn.llvm.icmp('ne', 'i64', taken, MAP_EMPTY)
+    step  = fn.llvm.add('i64', at, 1)
+    fn.llvm.and_('i64', step, nmask, reg=skip)
+    fn.llvm.br_if_else(taken, seek, place)
+
+    fn.llvm.label(place)
+    value = fn.llvm.load(stype, stype + '*', slot)
+    fn.llvm.store(stype, value, stype + '*', dst)
+    fn.llvm.br(next)
+
+    fn.llvm.label(next)
+    fn.llvm.add('i64', index, 1, reg=after)
+    fn.llvm.br(head)
+
+    fn.llvm.label(done)
+    fn.llvm.call('void', '@free', 'i8*', old)
+    fn.llvm.store('i8*', raw, 'i8**', _map_field(fn, '%map', 3))
+    fn.llvm.store('i64', nmask, 'i64*', _map_field(fn, '%map', 2))
+    fn.llvm.store('i64', count, 'i64*', _map_field(fn, '%map', 1))
+    fn.llvm.ret('void')
+
+    module.add_external('@calloc', '%ptr',  [ '%i64', '%i64' ])
+    module.add_external('@free',   '%void', [ '%ptr' ])
+
+
+def _map_new(module, fn):
+    """ Empty map with room for right keys before it grows """
+    stype = _map_slot(module, fn.rtype.name)
+    pre   = fn.llvm.next_lbl()
+    loop  = fn.llvm.next_lbl()
+    done  = fn.llvm.next_lbl()
+
+    hint = fn.llvm.sext('i32', 'i64', '%right')
+    hint = fn.llvm.mul('i64', hint, 4)
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(loop)
+
+    twice = fn.llvm.next_reg()
+
+    fn.llvm.label(loop)
+    size  = fn.llvm.phi('i64', MAP_MIN_SLOTS, pre, twice, loop)
+    fn.llvm.mul('i64', size, 2, reg=twice)
+    room  = fn.llvm.mul('i64', size, 3)
+    short = fn.llvm.icmp('slt', 'i64', room, hint)
+    fn.llvm.br_if_else(short, loop, done)
+
+    fn.llvm.label(done)
+    raw   = fn.llvm.call('i8*', '@malloc', 'i64', _sizeof('%map.head'))
+    map   = fn.llvm.bitcast('i8*', '%map.head*', raw)
+    slots = fn.llvm.call('i8*', '@calloc', 'i64', size, 'i64', _sizeof(stype))
+    mask  = fn.llvm.sub('i64', size, 1)
+    fn.llvm.store('i64', 0, 'i64*', _map_field(fn, map, 0))
+    fn.llvm.store('i64', 0, 'i64*', _map_field(fn, map, 1))
+    fn.llvm.store('i64', mask, 'i64*', _map_field(fn, map, 2))
+    fn.llvm.store('i8*', slots, 'i8**', _map_field(fn, map, 3))
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), map)
+
+    module.add_external('@malloc', '%ptr', [ '%i64' ])
+    module.add_external('@calloc', '%ptr', [ '%i64', '%i64' ])
+
+
+def _map_put(module, fn):
+    """ Pointer to the value of key, added as 0 if it is not in the map yet """
+    mtype = fn.args['%left'].type
+    stype = _map_slot(module, mtype.name)
+    ktype = fn.args['%right'].type.to_llvm_ir()
+    vtype = fn.rtype.to_llvm_ir()[:-1]
+    miss  = fn.llvm.next_lbl()
+    grow  = fn.llvm.next_lbl()
+    fill  = fn.llvm.next_lbl()
+    hit   = fn.llvm.next_lbl()
+
+    hash, index = _map_probe(module, fn, '%left', '%right')
+    found = fn.llvm.icmp('sge', 'i64', index, 0)
+    fn.llvm.br_if_else(found, hit, miss)
+
+    fn.llvm.label(hit)
+    slot = _map_at(module, fn, '%left', index)
+    ptr  = fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 2)
+    fn.llvm.ret(vtype + '*', ptr)
+
+    fn.llvm.label(miss)
+    used = fn.llvm.load('i64', 'i64*', _map_field(fn, '%left', 1))
+    mask = fn.llvm.load('i64', 'i64*', _map_field(fn, '%left', 2))
+    used = fn.llvm.add('i64', used, 1)
+    used = fn.llvm.mul('i64', used, 4)
+    size = fn.llvm.add('i64', mask, 1)
+    size = fn.llvm.mul('i64', size, 3)
+    full = fn.llvm.icmp('ugt', 'i64', used, size)
+    fn.llvm.br_if_else(full, grow, fill)
+
+    fn.llvm.label(grow)
+    fn.llvm.call('void', _require(module, fn, '@{}.grow'.format(mtype.name[1:])), mtype.to_llvm_ir(), '%left')
+    again = fn.llvm.call('i64', '@{}.probe'.format(mtype.name[1:]), mtype.to_llvm_ir(), '%left', ktype, '%right', 'i64', hash)
+    fn.llvm.br(fill)
+
+    fn.llvm.label(fill)
+    index = fn.llvm.phi('i64', index, miss, again, grow)
+    index = fn.llvm.xor('i64', index, -1)
+    slot  = _map_at(module, fn, '%left', index)
+    hptr  = fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 0)
+    old   = fn.llvm.load('i64', 'i64*', hptr)
+    fresh = fn.llvm.icmp('eq', 'i64', old, MAP_EMPTY)
+    fresh = fn.llvm.zext('i1', 'i64', fresh)
+    for field, add in [ (0, '1'), (1, fresh) ]:
+        ptr = _map_field(fn, '%left', field)
+        num = fn.llvm.load('i64', 'i64*', ptr)
+        num = fn.llvm.add('i64', num, add)
+        fn.llvm.store('i64', num, 'i64*', ptr)
+
+    key = '%right'
+    if mtype.name == '%map.cstr':
+        key = fn.llvm.call('i8*', '@strdup', 'i8*', '%right')
+        module.add_external('@strdup', '%ptr', [ '%ptr' ])
+
+    fn.llvm.store('i64', hash, 'i64*', hptr)
+    fn.llvm.store(ktype, key, ktype + '*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 1))
+    ptr = fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 2)
+    fn.llvm.store(vtype, 0, vtype + '*', ptr)
+    fn.llvm.ret(vtype + '*', ptr)
+
+
+def _map_get(module, fn):
+    """ Value of key, 0 when it is not in the map """
+    stype = _map_slot(module, fn.args['%left'].type.name)
+    vtype = fn.rtype.to_llvm_ir()
+    hit   = fn.llvm.next_lbl()
+    miss  = fn.llvm.next_lbl()
+
+    _, index = _map_probe(module, fn, '%left', '%right')
+    found    = fn.llvm.icmp('sge', 'i64', index, 0)
+    fn.llvm.br_if_else(found, hit, miss)
+
+    fn.llvm.label(hit)
+    slot  = _map_at(module, fn, '%left', index)
+    value = fn.llvm.load(vtype, vtype + '*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 2))
+    fn.llvm.ret(vtype, value)
+
+    fn.llvm.label(miss)
+    fn.llvm.ret(vtype, 0)
+
+
+def _map_has(module, fn):
+    _, index = _map_probe(module, fn, '%left', '%right')
+    found    = fn.llvm.icmp('sge', 'i64', index, 0)
+    fn.llvm.ret('i1', found)
+
+
+def _map_remove(module, fn):
+    """ Deletes key, false when it was not in the map """
+    stype = _map_slot(module, fn.args['%left'].type.name)
+    hit   = fn.llvm.next_lbl()
+    miss  = fn.llvm.next_lbl()
+
+    _, index = _map_probe(module, fn, '%left', '%right')
+    found    = fn.llvm.icmp('sge', 'i64', index, 0)
+    fn.llvm.br_if_else(found, hit, miss)
+
+    # The slot stays used, so probes go on past it
+    fn.llvm.label(hit)
+    slot = _map_at(module, fn, '%left', index)
+    fn.llvm.store('i64', MAP_DELETED, 'i64*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 0))
+    if fn.args['%left'].type.name == '%map.cstr':
+        key = fn.llvm.load('i8*', 'i8**', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 1))
+        fn.llvm.call('void', '@free', 'i8*', key)
+        module.add_external('@free', '%void', [ '%ptr' ])
+    ptr   = _map_field(fn, '%left', 0)
+    count = fn.llvm.load('i64', 'i64*', ptr)
+    count = fn.llvm.sub('i64', count, 1)
+    fn.llvm.store('i64', count, 'i64*', ptr)
+    fn.llvm.ret('i1', 'true')
+
+    fn.llvm.label(miss)
+    fn.llvm.ret('i1', 'false')
+
+
+def _map_length(module, fn):
+    count = fn.llvm.load('i64', 'i64*', _map_field(fn, '%right', 0))
+    fn.llvm.ret('i64', count)
+
+
+def _map_free(module, fn):
+    """ Releases the map, and the copies of its string keys """
+    stype = _map_slot(module, fn.args['%right'].type.name)
+
+    if fn.args['%right'].type.name == '%map.cstr':
+        pre  = fn.llvm.next_lbl()
+        head = fn.llvm.next_lbl()
+        body = fn.llvm.next_lbl()
+        drop = fn.llvm.next_lbl()
+        next = fn.llvm.next_lbl()
+        done = fn.llvm.next_lbl()
+
+        mask = fn.llvm.load('i64', 'i64*', _map_field(fn, '%right', 2))
+        fn.llvm.br(pre)
+        fn.llvm.label(pre)
+        fn.llvm.br(head)
+
+        after = fn.llvm.next_reg()
+
+        fn.llvm.label(head)
+        index = fn.llvm.phi('i64', 0, pre, after, next)
+        more  = fn.llvm.icmp('ule', 'i64', index, mask)
+        fn.llvm.br_if_else(more, body, done)
+
+        fn.llvm.label(body)
+        slot = _map_at(module, fn, '%right', index)
+        hash = fn.llvm.load('i64', 'i64*', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 0))
+        live = fn.llvm.icmp('slt', 'i64', hash, 0)
+        fn.llvm.br_if_else(live, drop, next)
+
+        fn.llvm.label(drop)
+        key = fn.llvm.load('i8*', 'i8**', fn.llvm.get_element_ptr(stype, stype + '*', slot, 'i32', 0, 'i32', 1))
+        fn.llvm.call('void', '@free', 'i8*', key)
+        fn.llvm.br(next)
+
+        fn.llvm.label(next)
+        fn.llvm.add('i64', index, 1, reg=after)
+        fn.llvm.br(head)
+
+        fn.llvm.label(done)
+
+    slots = fn.llvm.load('i8*', 'i8**', _map_field(fn, '%right', 3))
+    fn.llvm.call('void', '@free', 'i8*', slots)
+    map = fn.llvm.bitcast('%map.head*', 'i8*', '%right')
+    fn.llvm.call('void', '@free', 'i8*', map)
+    fn.llvm.ret('void')
+
+    module.add_external('@free', '%void', [ '%ptr' ])
+
+
+for _map, (_key, _value) in MAP_TYPES.items():
+    _runtime('@{}.probe'.format(_map[1:]), '%i64', map=_map, key=_key, hash='%i64')(_map_probe_runtime)
+    _runtime('@{}.grow'.format(_map[1:]), map=_map)(_map_grow)
+    _operator(_map[1:],  '%void', '%i32', _map)(_map_new)
+    _operator('put',     _map, _key, _value + '.ptr')(_map_put)
+    _operator('@',       _map, _key, _value)(_map_get)
+    _operator('has',     _map, _key, '%bool')(_map_has)
+    _operator('remove',  _map, _key, '%bool')(_map_remove)
+    _operator('length',  rtype=_map, ftype='%i64')(_map_length)
+    _operator('free',    rtype=_map)(_map_free)
+
+
+# Strings.
+#
+# A str is { length, data }, with data NUL terminated so it can be handed to
+# C as it is. Literals get their length while compiling (see the evaluator),
+# other cstrs measure it once. A builder is a pointer to { length, capacity,
+# data } on the heap, whose data at least doubles whenever an append does not
+# fit. Strings taken from a builder are views of its data, valid until the
+# next append.
+
+BUILDER_MIN_CAPACITY = 16
+
+# Longest i64 in decimal, with its sign
+DECIMAL_SIZE = 20
+
+
+def _builder_field(fn, builder, index):
+    return fn.llvm.get_element_ptr('%str.buf', '%str.buf*', builder, 'i32', 0, 'i32', index)
+
+
+@_operator('str', rtype='%cstr', ftype='%str')
+def void_str_cstr(module, fn):
+    stype = fn.rtype.to_llvm_ir()
+    size  = fn.llvm.call('i64', '@strlen', 'i8*', '%right')
+    text  = fn.llvm.insert_value(stype, 'undef', 'i64', size, 0)
+    text  = fn.llvm.insert_value(stype, text, 'i8*', '%right', 1)
+    fn.llvm.ret(stype, text)
+    module.add_external('@strlen', '%i64', [ '%ptr' ])
+
+
+@_operator('cstr', rtype='%str', ftype='%cstr')
+def void_cstr_str(module, fn):
+    data = fn.llvm.extract_value(module.type('%str').to_llvm_ir(), '%right', 1)
+    fn.llvm.ret('i8*', data)
+
+
+@_operator('length', rtype='%str', ftype='%i64')
+def void_length_str(module, fn):
+    size = fn.llvm.extract_value(module.type('%str').to_llvm_ir(), '%right', 0)
+    fn.llvm.ret('i64', size)
+
+
+def _str_at(module, fn):
+    data = fn.llvm.extract_value(module.type('%str').to_llvm_ir(), '%left', 1)
+    ptr  = fn.llvm.get_element_ptr('i8', 'i8*', data, fn.args['%right'].type.to_llvm_ir(), '%right')
+    reg  = fn.llvm.load('i8', 'i8*', ptr)
+    fn.llvm.ret('i8', reg)
+
+
+for _type in [ '%i32', '%i64' ]:
+    _operator('@', '%str', _type, '%i8')(_str_at)
+
+
+def _str_equal(negate):
+    def body(module, fn):
+        """ Lengths first, bytes only when they match """
+        stype = module.type('%str').to_llvm_ir()
+        same  = fn.llvm.next_lbl()
+        done  = fn.llvm.next_lbl()
+        start = fn.llvm.next_lbl()
+
+        fn.llvm.br(start)
+        fn.llvm.label(start)
+        lsize = fn.llvm.extract_value(stype, '%left', 0)
+        rsize = fn.llvm.extract_value(stype, '%right', 0)
+        equal = fn.llvm.icmp('eq', 'i64', lsize, rsize)
+        fn.llvm.br_if_else(equal, same, done)
+
+        fn.llvm.label(same)
+        ldata = fn.llvm.extract_value(stype, '%left', 1)
+        rdata = fn.llvm.extract_value(stype, '%right', 1)
+        order = fn.llvm.call('i32', '@memcmp', 'i8*', ldata, 'i8*', rdata, 'i64', lsize)
+        bytes = fn.llvm.icmp('eq', 'i32', order, 0)
+        fn.llvm.br(done)
+
+        fn.llvm.label(done)
+        result = fn.llvm.phi('i1', 'false', start, bytes, same)
+        if negate:
+            result = fn.llvm.xor('i1', result, 'true')
+        fn.llvm.ret('i1', result)
+
+        module.add_external('@memcmp', '%i32', [ '%ptr', '%ptr', '%i64' ])
+    return body
+
+
+_operator('==', '%str', '%str', '%bool')(_str_equal(False))
+_operator('!=', '%str', '%str', '%bool')(_str_equal(True))
+
+
+@_operator('str.builder', rtype='%i32', ftype='%str.builder')
+def void_builder_i32(module, fn):
+    """ Empty builder with room for right bytes """
+    size  = fn.llvm.sext('i32', 'i64', '%right')
+    small = fn.llvm.icmp('slt', 'i64', size, BUILDER_MIN_CAPACITY)
+    size  = fn.llvm.select(small, 'i64', BUILDER_MIN_CAPACITY, size)
+    raw   = fn.llvm.call('i8*', '@malloc', 'i64', _sizeof('%str.buf'))
+    buf   = fn.llvm.bitcast('i8*', '%str.buf*', raw)
+    data  = fn.llvm.call('i8*', '@malloc', 'i64', size)
+    fn.llvm.store('i8', 0, 'i8*', data)
+    fn.llvm.store('i64', 0, 'i64*', _builder_field(fn, buf, 0))
+    fn.llvm.store('i64', size, 'i64*', _builder_field(fn, buf, 1))
+    fn.llvm.store('i8*', data, 'i8**', _builder_field(fn, buf, 2))
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), buf)
+
+    module.add_external('@malloc', '%ptr', [ '%i64' ])
+
+
+@_runtime('@str.reserve', '%ptr', builder='%str.builder', extra='%i64')
+def _str_reserve(module, fn):
+    """ End of the data of builder, with room for extra more bytes and a NUL after them """
+    grow = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+    pre  = fn.llvm.next_lbl()
+
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    size = fn.llvm.load('i64', 'i64*', _builder_field(fn, '%builder', 0))
+    room = fn.llvm.load('i64', 'i64*', _builder_field(fn, '%builder', 1))
+    old  = fn.llvm.load('i8*', 'i8**', _builder_field(fn, '%builder', 2))
+    need = fn.llvm.add('i64', size, '%extra')
+    need = fn.llvm.add('i64', need, 1)
+    full = fn.llvm.icmp('ugt', 'i64', need, room)
+    fn.llvm.br_if_else(full, grow, done)
+
+    fn.llvm.label(grow)
+    twice = fn.llvm.mul('i64', room, 2)
+    short = fn.llvm.icmp('ult', 'i64', twice, need)
+    room  = fn.llvm.select(short, 'i64', need, twice)
+    new   = fn.llvm.call('i8*', '@realloc', 'i8*', old, 'i64', room)
+    fn.llvm.store('i64', room, 'i64*', _builder_field(fn, '%builder', 1))
+    fn.llvm.store('i8*', new, 'i8**', _builder_field(fn, '%builder', 2))
+    fn.llvm.br(done)
+
+    fn.llvm.label(done)
+    data = fn.llvm.phi('i8*', old, pre, new, grow)
+    end  = fn.llvm.get_element_ptr('i8', 'i8*', data, 'i64', size)
+    fn.llvm.ret('i8*', end)
+
+    module.add_external('@realloc', '%ptr', [ '%ptr', '%i64' ])
+
+
+def _builder_grew(fn, end, size):
+    """ Counts size more bytes in the builder and ends its data after them """
+    ptr   = _builder_field(fn, '%left', 0)
+    total = fn.llvm.load('i64', 'i64*', ptr)
+    total = fn.llvm.add('i64', total, size)
+    fn.llvm.store('i64', total, 'i64*', ptr)
+    nul   = fn.llvm.get_element_ptr('i8', 'i8*', end, 'i64', size)
+    fn.llvm.store('i8', 0, 'i8*', nul)
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), '%left')
+
+
+def _builder_bytes(module, fn, data, size):
+    end = fn.llvm.call('i8*', _require(module, fn, '@str.reserve'), '%str.builder', '%left', 'i64', size)
+    fn.llvm.call('void', '@llvm.memcpy.p0i8.p0i8.i64', 'i8*', end, 'i8*', data, 'i64', size, 'i1', 'false')
+    module.add_external('@llvm.memcpy.p0i8.p0i8.i64', '%void', [ '%ptr', '%ptr', '%i64', '%bool' ])
+    _builder_grew(fn, end, size)
+
+
+@_operator('append', '%str.builder', '%str', '%str.builder')
+def builder_append_str(module, fn):
+    stype = module.type('%str').to_llvm_ir()
+    size  = fn.llvm.extract_value(stype, '%right', 0)
+    data  = fn.llvm.extract_value(stype, '%right', 1)
+    _builder_bytes(module, fn, data, size)
+
+
+@_operator('append', '%str.builder', '%cstr', '%str.builder')
+def builder_append_cstr(module, fn):
+    size = fn.llvm.call('i64', '@strlen', 'i8*', '%right')
+    module.add_external('@strlen', '%i64', [ '%ptr' ])
+    _builder_bytes(module, fn, '%right', size)
+
+
+@_operator('append', '%str.builder', '%i8', '%str.builder')
+def builder_append_i8(module, fn):
+    end = fn.llvm.call('i8*', _require(module, fn, '@str.reserve'), '%str.builder', '%left', 'i64', 1)
+    fn.llvm.store('i8', '%right', 'i8*', end)
+    _builder_grew(fn, end, 1)
+
+
+@_runtime('@str.decimal', '%i64', dst='%ptr', value='%i64')
+def _str_decimal(module, fn):
+    """ Writes value in decimal at dst, without a NUL, and gives the number of bytes """
+    pre  = fn.llvm.next_lbl()
+    loop = fn.llvm.next_lbl()
+    done = fn.llvm.next_lbl()
+
+    digits = fn.llvm.alloca('[ 24 x i8 ]')
+    neg    = fn.llvm.icmp('slt', 'i64', '%value', 0)
+    inv    = fn.llvm.sub('i64', 0, '%value')
+    abs    = fn.llvm.select(neg, 'i64', inv, '%value')
+    fn.llvm.br(pre)
+    fn.llvm.label(pre)
+    fn.llvm.br(loop)
+
+    quot = fn.llvm.next_reg()
+    npos = fn.llvm.next_reg()
+
+    fn.llvm.label(loop)
+    value = fn.llvm.phi('i64', abs, pre, quot, loop)
+    pos   = fn.llvm.phi('i64', 24, pre, npos, loop)
+    fn.llvm.udiv('i64', value, 10, reg=quot)
+    rem   = fn.llvm.urem('i64', value, 10)
+    digit = fn.llvm.trunc('i64', 'i8', rem)
+    char  = fn.llvm.add('i8', digit, 48)   # '0'
+    fn.llvm.sub('i64', pos, 1, reg=npos)
+    dst   = fn.llvm.get_element_ptr('[ 24 x i8 ]', '[ 24 x i8 ]*', digits, 'i64', 0, 'i64', npos)
+    fn.llvm.store('i8', char, 'i8*', dst)
+    more  = fn.llvm.icmp('ne', 'i64', quot, 0)
+    fn.llvm.br_if_else(more, loop, done)
+
+    # The sign goes in front of the digits, and is only copied when negative
+    fn.llvm.label(done)
+    sign  = fn.llvm.sub('i64', npos, 1)
+    ptr   = fn.llvm.get_element_ptr('[ 24 x i8 ]', '[ 24 x i8 ]*', digits, 'i64', 0, 'i64', sign)
+    fn.llvm.store('i8', 45, 'i8*', ptr)   # '-'
+    first = fn.llvm.select(neg, 'i64', sign, npos)
+    src   = fn.llvm.get_element_ptr('[ 24 x i8 ]', '[ 24 x i8 ]*', digits, 'i64', 0, 'i64', first)
+    count = fn.llvm.sub('i64', 24, first)
+    fn.llvm.call('void', '@llvm.memcpy.p0i8.p0i8.i64', 'i8*', '%dst', 'i8*', src, 'i64', count, 'i1', 'false')
+    fn.llvm.ret('i64', count)
+
+    module.add_external('@llvm.memcpy.p0i8.p0i8.i64', '%void', [ '%ptr', '%ptr', '%i64', '%bool' ])
+
+
+def _builder_append_int(module, fn):
+    rtype = fn.args['%right'].type.to_llvm_ir()
+    value = '%right' if rtype == 'i64' else fn.llvm.sext(rtype, 'i64', '%right')
+    end   = fn.llvm.call('i8*', _require(module, fn, '@str.reserve'), '%str.builder', '%left', 'i64', DECIMAL_SIZE)
+    size  = fn.llvm.call('i64', _require(module, fn, '@str.decimal'), 'i8*', end, 'i64', value)
+    _builder_grew(fn, end, size)
+
+
+for _type in [ '%i32', '%i64' ]:
+    _operator('append', '%str.builder', _type, '%str.builder')(_builder_append_int)
+
+
+@_operator('str', rtype='%str.builder', ftype='%str')
+def void_str_builder(module, fn):
+    stype = fn.rtype.to_llvm_ir()
+    size  = fn.llvm.load('i64', 'i64*', _builder_field(fn, '%right', 0))
+    data  = fn.llvm.load('i8*', 'i8**', _builder_field(fn, '%right', 2))
+    text  = fn.llvm.insert_value(stype, 'undef', 'i64', size, 0)
+    text  = fn.llvm.insert_value(stype, text, 'i8*', data, 1)
+    fn.llvm.ret(stype, text)
+
+
+@_operator('clear', rtype='%str.builder', ftype='%str.builder')
+def void_clear_builder(module, fn):
+    """ Empties the builder and keeps its memory """
+    data = fn.llvm.load('i8*', 'i8**', _builder_field(fn, '%right', 2))
+    fn.llvm.store('i8', 0, 'i8*', data)
+    fn.llvm.store('i64', 0, 'i64*', _builder_field(fn, '%right', 0))
+    fn.llvm.ret(fn.rtype.to_llvm_ir(), '%right')
+
+
+@_operator('free', rtype='%str.builder')
+def void_free_builder(module, fn):
+    data = fn.llvm.load('i8*', 'i8**', _builder_field(fn, '%right', 2))
+    fn.llvm.call('void', '@free', 'i8*', data)
+    buf  = fn.llvm.bitcast('%str.buf*', 'i8*', '%right')
+    fn.llvm.call('void', '@free', 'i8*', buf)
+    fn.llvm.ret('void')
+
+    module.add_external('@free', '%void', [ '%ptr' ])
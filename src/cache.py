@@ -0,0 +1,326 @@
+"""
+On-disk cache of generated operators and native objects.
+
+Every top-level operator definition gets a key hashed over its AST, over the
+keys of the operators it names and over the externals it calls, so a change
+reaches everything that depends on it. A definition whose key is cached is
+not generated again: the Functions it produced and what it added to the
+module are put back instead, in the order they were added, so the IR comes
+out as it does without the cache and so does the key of its object.
+Constants are numbered module-wide, so the ones in cached code are renamed
+to their number in the module being built.
+
+Objects are cached for the whole module, keyed by its IR. opt inlines
+operators into each other, so objects per operator would give up most of
+what it does.
+"""
+
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+
+from dataclasses import dataclass
+from functools   import lru_cache
+from pathlib     import Path
+from typing      import Dict, List, Tuple
+
+from src.tokenizer import TokenType
+
+SOURCES = Path(__file__).resolve().parent
+
+@lru_cache(maxsize=None)
+def compiler_version():
+    """ Entries made by another version of the compiler never match """
+    digest = hashlib.sha256()
+    for path in sorted(SOURCES.glob('*.py')):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+def preorder(node):
+    nodes   = []
+    pending = [ node ]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(reversed(node.children))
+    return nodes
+
+def type_names(code):
+    return set(re.findall(r'%[\w.]+', code))
+
+def type_entry(type):
+    fields = None if type.fields is None else [ ftype.name for ftype in type.fields ]
+    return type.repr, type.primitive, fields
+
+@dataclass
+class Entry:
+    name:        str                               # Mangled name of the definition
+    functions:   bytes                             # Pickled user Functions, nested ones first
+    builtins:    List[str]                         # Builtins it instantiated
+    order:       List[str]                         # Every function it added, in order
+    types:       Dict[str, Tuple[str, bool, list]] # Types it uses or adds, in order: repr, primitive, fields
+    constants:   Dict[str, Tuple[str, str]]        # Constants it adds in order, then others in its code: type, value
+    variables:   List[Tuple[str, str, str, bool, bool]] # Other globals it adds: name, type, value, constant, thread_local
+    externals:   list                              # Externals it declared
+    nonnull:     Dict[str, Dict[str, bool]]        # What its calls say about their arguments
+    definitions: List[Tuple[str, int]]             # Evaluator bodies, as preorder indices
+
+class Cache:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.keys = {}
+
+        self.reused        = 0
+        self.generated     = 0
+        self.object_reused = None
+
+    @staticmethod
+    def from_environment():
+        path = os.environ.get('INFIX_CACHE')
+        return Cache(path) if path else None
+
+    def reset(self):
+        self.reused        = 0
+        self.generated     = 0
+        self.object_reused = None
+
+    def summary(self):
+        total = self.reused + self.generated
+        ratio = 100 * self.reused // total if total else 0
+        text  = 'cache: {} of {} definitions reused ({}%)'.format(self.reused, total, ratio)
+        if self.object_reused is not None:
+            text += ', object ' + ('reused' if self.object_reused else 'compiled')
+        return text
+
+    def key(self, module, node):
+        digest = hashlib.sha256(bytes(compiler_version(), 'utf-8'))
+
+        names = set()
+        for sub in preorder(node):
+            digest.update(bytes('{}:{}:{}:{};'.format(
+                sub.expr_type.name, sub.token.kind.name, sub.token.value, len(sub.children)
+            ), 'utf-8'))
+            if sub.token.kind == TokenType.IDENTIFIER:
+                names.add(sub.token.value)
+
+        for name in sorted(names):
+            if name in self.keys:
+                digest.update(bytes('op {} {};'.format(name, self.keys[name]), 'utf-8'))
+
+            external = module.externals.get('@' + name)
+            if external is not None:
+                digest.update(bytes('extern {} {} {};'.format(
+                    name, external.rtype.name, [ arg.name for arg in external.args ]
+                ), 'utf-8'))
+
+        return digest.hexdigest()
+
+    def definition(self, generator, node):
+        """ Generates the operator defined by node, or puts it back from the cache """
+        key   = self.key(generator.module, node)
+        entry = self.load('defs', key)
+
+        if entry is None:
+            entry = self.record(generator, node)
+            self.store('defs', key, entry)
+            self.generated += 1
+        else:
+            self.replay(generator, node, entry)
+            self.reused += 1
+
+        self.publish(node, key)
+        return entry.name
+
+    def declare(self, module, node):
+        """ Generics are not cached, as they have no code, but callers see their key """
+        self.publish(node, self.key(module, node))
+
+    def publish(self, node, key):
+        # Overloads share a name, so they share the key callers see
+        name = node.children[0].token.value
+        self.keys[name] = hashlib.sha256(bytes(self.keys.get(name, '') + key, 'utf-8')).hexdigest()
+
+    def record(self, generator, node):
+        module = generator.module
+
+        types       = set(module.types)
+        variables   = set(module.variables)
+        externals   = set(module.externals)
+        functions   = dict(module.functions)
+        definitions = dict(generator.evaluator.definitions)
+
+        # Callers update the nonnull flags of their callees. Starting them
+        # empty leaves what this definition says on its own
+        nonnull = { name: fn.nonnull for name, fn in functions.items() }
+        for fn in functions.values():
+            fn.nonnull = {}
+
+        try:
+            name = generator.generate_definition(node)
+        finally:
+            calls = {}
+            for fname, fn in functions.items():
+                if fn.nonnull:
+                    calls[fname] = fn.nonnull
+                merged = dict(nonnull[fname])
+                for aname, value in fn.nonnull.items():
+                    merged[aname] = merged.get(aname, True) and value
+                fn.nonnull = merged
+
+        new      = [ fn for fname, fn in module.functions.items() if functions.get(fname) is not fn ]
+        builtins = [ fn.name for fn in new if fn.name in module.builtins ]
+        users    = [ fn for fn in new if fn.name not in module.builtins ]
+
+        for fn in new:
+            if fn.name in module.builtins and fn.nonnull:
+                calls[fn.name] = fn.nonnull
+
+        constants = {}
+        by_name   = { vr.name: vr for vr in module.const_regs.values() }
+        used      = set(tname for tname in module.types if tname not in types)
+        for vr in module.const_regs.values():
+            if vr.name not in variables:
+                constants[vr.name] = (vr.type.name, vr.value)
+        for fn in users:
+            for const in re.findall(r'@const\.\d+', fn.llvm.code):
+                vr = by_name[const]
+                constants[const] = (vr.type.name, vr.value)
+                used.add(vr.type.name)
+
+            used |= type_names(fn.llvm.code) & set(module.types)
+            used |= { vr.type.name for vr in list(fn.args.values()) + list(fn.variables.values()) }
+            used.add(fn.rtype.name)
+
+        globals = [
+            (vr.name, vr.type.name, vr.value, vr.constant, vr.thread_local)
+            for name, vr in module.variables.items()
+            if name not in variables and vr.name not in constants
+        ]
+        used |= { tname for _, tname, _, _, _ in globals }
+
+        # Structs are made again from their fields
+        pending = list(used)
+        while pending:
+            for ftype in module.types[pending.pop()].fields or ():
+                if ftype.name not in used:
+                    used.add(ftype.name)
+                    pending.append(ftype.name)
+
+        preorder_index = { id(sub): index for index, sub in enumerate(preorder(node)) }
+        evaluated      = [
+            (fname, preorder_index[id(body)])
+            for fname, body in generator.evaluator.definitions.items()
+            if definitions.get(fname) is not body and id(body) in preorder_index
+        ]
+
+        return Entry(
+            name        = name,
+            functions   = pickle.dumps(users),
+            builtins    = builtins,
+            order       = [ fn.name for fn in new ],
+            types       = { tname: type_entry(module.types[tname]) for tname in module.types if tname in used },
+            constants   = constants,
+            variables   = globals,
+            externals   = [ ex for ename, ex in module.externals.items() if ename not in externals ],
+            nonnull     = calls,
+            definitions = evaluated,
+        )
+
+    def replay(self, generator, node, entry):
+        module = generator.module
+
+        def restore(tname):
+            repr, primitive, fields = entry.types[tname]
+            if fields is None:
+                return module.type(tname, repr, primitive)
+            return module.types.struct([ restore(fname) for fname in fields ])
+
+        for tname in entry.types:
+            restore(tname)
+
+        for external in entry.externals:
+            if external.name not in module.externals:
+                module.add_external(external.name, external.rtype.name, [ arg.name for arg in external.args ])
+
+        # Constants and globals first, so the builtins made again find them
+        # where generating the definition put them
+        renames = {}
+        for const, (tname, value) in entry.constants.items():
+            renames[const] = module.const(module.types[tname], value).name
+
+        for name, tname, value, constant, thread_local in entry.variables:
+            if name not in module.variables:
+                module.new_global_var(name, module.types[tname], value, constant, thread_local)
+
+        def rename(text):
+            return re.sub(r'@const\.\d+\b', lambda match: renames[match.group(0)], text)
+
+        functions = pickle.loads(entry.functions)
+        for fn in functions:
+            fn.llvm.code   = rename(fn.llvm.code)
+            fn.llvm.loads  = { rename(name) for name in fn.llvm.loads }
+            fn.llvm.stores = { rename(name) for name in fn.llvm.stores }
+
+            fn.rtype = module.types[fn.rtype.name]
+            for vr in list(fn.args.values()) + list(fn.variables.values()):
+                vr.type = module.types[vr.type.name]
+
+        by_name = { fn.name: fn for fn in functions }
+        for name in entry.order:
+            if name in by_name:
+                module.functions[name] = by_name[name]
+            else:
+                module.operation(name)
+
+        # Instances of generics belong to the definition that called them
+        # first, which may not be cached anymore
+        for fn in functions:
+            for callee in sorted(fn.calls):
+                if callee not in module.functions:
+                    module.operation(callee)
+
+        for fname, args in entry.nonnull.items():
+            fn = module.functions[fname]
+            for aname, value in args.items():
+                fn.nonnull[aname] = fn.nonnull.get(aname, True) and value
+
+        nodes = preorder(node)
+        for fname, index in entry.definitions:
+            generator.evaluator.define(fname, nodes[index])
+
+    def object(self, ir_repr, oname):
+        """ Copies the cached object of ir_repr to oname, if there is one """
+        cached = self.path / 'obj' / (self.ir_key(ir_repr) + '.o')
+        self.object_reused = cached.exists()
+        if self.object_reused:
+            shutil.copyfile(cached, oname)
+        return self.object_reused
+
+    def store_object(self, ir_repr, oname):
+        with open(oname, 'rb') as f:
+            self.write('obj', self.ir_key(ir_repr) + '.o', f.read())
+
+    def ir_key(self, ir_repr):
+        return hashlib.sha256(bytes(compiler_version() + ir_repr, 'utf-8')).hexdigest()
+
+    def load(self, kind, key):
+        try:
+            with open(self.path / kind / key, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store(self, kind, key, entry):
+        self.write(kind, key, pickle.dumps(entry))
+
+    def write(self, kind, name, data):
+        # Written aside and renamed, as builds may run side by side
+        directory = self.path / kind
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, directory / name)
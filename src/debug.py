@@ -0,0 +1,112 @@
+"""
+DWARF line tables (-g).
+
+Instructions get the position of the node they were generated for, and every
+operator that has code of its own gets a DISubprogram named as it is written,
+so profilers and debuggers can point at .ifx lines and operators instead of
+mangled names. Only line tables are emitted, there are no variable or type
+descriptions.
+"""
+
+import os
+
+class Debug:
+    def __init__(self, lines):
+        self.lines   = lines    # (file, line) of each line of the compiled text
+        self.program = lines[-1][0] if lines else '<input>'
+
+        self.nodes = []         # Metadata, numbered by position
+        self.known = {}         # Metadata text to its number, to share nodes
+        self.files = {}
+
+        self.unit    = self.reserve()
+        self.routine = self.node('!DISubroutineType(types: {})'.format(self.node('!{}')))
+
+    def reserve(self):
+        self.nodes.append(None)
+        return '!{}'.format(len(self.nodes) - 1)
+
+    def node(self, text):
+        if text not in self.known:
+            self.known[text] = self.reserve()
+            self.nodes[-1]   = text
+        return self.known[text]
+
+    def position(self, token):
+        """ Source file and line of token, None for tokens that were made up """
+        if token is None or token.row <= 0 or token.row > len(self.lines):
+            return None
+        source, line = self.lines[token.row - 1]
+        return source, line, token.col
+
+    def file(self, source):
+        if source not in self.files:
+            path = os.path.abspath(source)
+            self.files[source] = self.node('!DIFile(filename: "{}", directory: "{}")'.format(
+                os.path.basename(path), os.path.dirname(path)
+            ))
+        return self.files[source]
+
+    def subprogram(self, function, source, line):
+        if function.name == '@main':
+            source, line = self.program, 1
+
+        # Named once the function is complete, see to_llvm_ir
+        if function.scope is None:
+            function.scope = self.reserve()
+            self.nodes[int(function.scope[1:])] = (function, self.file(source), line)
+        return function.scope
+
+    def entry(self, function):
+        """ Location of what runs before the first statement of function """
+        scope = self.subprogram(function, self.program, 1)
+        return self.node('!DILocation(line: 1, column: 1, scope: {})'.format(scope))
+
+    def location(self, function, token):
+        position = self.position(token)
+        if position is None:
+            return function.llvm.location
+
+        source, line, col = position
+        scope = self.subprogram(function, source, line)
+
+        # Main starts in the standard library and goes on in the program
+        _, sfile, _ = self.nodes[int(scope[1:])]
+        if self.file(source) != sfile:
+            scope = self.node('!DILexicalBlockFile(scope: {}, file: {}, discriminator: 0)'.format(
+                scope, self.file(source)
+            ))
+
+        return self.node('!DILocation(line: {}, column: {}, scope: {})'.format(line, col, scope))
+
+    def to_llvm_ir(self):
+        code  = '!llvm.dbg.cu = !{{{}}}\n'.format(self.unit)
+        code += '!llvm.module.flags = !{{{}, {}}}\n'.format(
+            self.node('!{i32 2, !"Dwarf Version", i32 4}'),
+            self.node('!{i32 2, !"Debug Info Version", i32 3}'),
+        )
+
+        self.nodes[int(self.unit[1:])] = (
+            'distinct !DICompileUnit(language: DW_LANG_C99, file: {}, producer: "infix", '
+            'isOptimized: true, runtimeVersion: 0, emissionKind: LineTablesOnly)'
+        ).format(self.file(self.program))
+
+        for index, text in enumerate(self.nodes):
+            if isinstance(text, tuple):
+                function, sfile, line = text
+                text = (
+                    'distinct !DISubprogram(name: "{}", linkageName: "{}", scope: {file}, file: {file}, '
+                    'line: {line}, type: {}, scopeLine: {line}, spFlags: DISPFlagDefinition | DISPFlagOptimized, '
+                    'unit: {})'
+                ).format(demangle(function.name), function.name[1:].strip('"'), self.routine, self.unit,
+                         file=sfile, line=line)
+            code += '!{} = {}\n'.format(index, text)
+
+        return code
+
+def demangle(name):
+    """ @"i32;+;i32" is written i32 + i32, @"void;println;i32" println i32 """
+    parts = name[1:].strip('"').split(';')
+    if len(parts) != 3:
+        return parts[0]
+    return ' '.join(part for part in parts if part != 'void')
@@ -0,0 +1,198 @@
+"""
+The steps from a source file to a binary, shared by infix.py and the
+compile server.
+"""
+
+import array
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from functools          import lru_cache
+from pathlib            import Path
+from subprocess         import Popen, PIPE
+
+from src.tokenizer import Tokenizer
+from src.parser    import Parser
+from src.generator import Generator
+from src.cache     import Cache, compiler_version
+
+INCLUDE = Path(__file__).resolve().parent.parent / 'include'
+
+class BuildError(Exception):
+    pass
+
+def include(text, included, source=None, lines=None, first=1, result=None):
+    """
+    Pastes every #include into text. Files already in included (resolved
+    paths, updated as files get pasted) only lose their #include line. When
+    lines is a list, it gets the (file, line) each line of the result comes
+    from, counting the lines of text from first.
+    """
+    top    = result is None
+    result = [] if top else result
+
+    for number, line in enumerate(text.split('\n'), first):
+        match = re.match('\s*#include\s+(.*)', line)
+        if match is None:
+            result.append(line)
+            if lines is not None:
+                lines.append((source, number))
+            continue
+
+        resolved = str((INCLUDE / match.group(1).strip()).resolve())
+        if resolved not in included:
+            included.add(resolved)
+            with open(resolved, 'r') as f:
+                include(f.read(), included, resolved, lines, result=result)
+
+    if top:
+        return '\n'.join(result)
+
+def read_source(fpath, included=None, lines=None):
+    with open(fpath, 'r') as f:
+        text  = '#include std.ifx\n'
+        text += f.read()
+
+    # The first line of the file comes after the one added here
+    return include(text, set() if included is None else included, fpath, lines, first=0)
+
+def parse(text):
+    return Parser(Tokenizer(text)).parse()
+
+def compile_ir(fpath, cache=None):
+    """ IR of the program in fpath, generated by a Generator of its own """
+    return Generator(cache).generate(parse(read_source(fpath)))
+
+def compile_batch(fpaths, workers=None, cache_path=None):
+    """
+    IR of every program in fpaths, in order, generated by a pool of threads.
+    A program that does not compile gets the exception instead
+    """
+    def job(fpath):
+        try:
+            return compile_ir(fpath, None if cache_path is None else Cache(cache_path))
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(job, fpaths))
+
+def program_name(fpath):
+    return fpath.split('/')[-1].replace('.ifx', '')
+
+def run(process, data=b''):
+    with Popen(process, stdin=PIPE, stdout=PIPE, stderr=PIPE) as proc:
+        out, err = proc.communicate(data)
+        if proc.returncode != 0:
+            raise BuildError(str(err, 'utf-8'))
+        return out
+
+@lru_cache(maxsize=None)
+def target_triple():
+    return str(run(['clang', '-dumpmachine']), 'utf-8').strip()
+
+def optimize(ir_repr):
+    # Loop unrolling and vectorization happen on the IR, before llc. They
+    # need to know the target to pick vector widths
+    out = run(['opt-9', '-O2', '-S', '-mtriple=' + target_triple()], bytes(ir_repr, 'utf-8'))
+    return str(out, 'utf-8')
+
+def assemble(ir_repr):
+    return str(run(['llc-9'], bytes(ir_repr, 'utf-8')), 'utf-8')
+
+def build(ir_repr, fpath, cache=None, directory='', tag=None):
+    """
+    Optimizes ir_repr into an object file and a binary named after fpath, and
+    tag when given, in obj/ and bin/ under directory. Both are made aside and
+    renamed, so builds side by side never leave half a file where another
+    one runs it. The object comes from the cache when it has one for the IR
+    """
+    name  = program_name(fpath) if tag is None else program_name(fpath) + '.' + tag
+    oname = os.path.join(directory, 'obj', name + '.o')
+    bname = os.path.join(directory, 'bin', name)
+
+    os.makedirs(os.path.dirname(oname), exist_ok=True)
+    os.makedirs(os.path.dirname(bname), exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(oname)) as aside:
+        otmp = os.path.join(aside, name + '.o')
+        btmp = os.path.join(aside, name)
+
+        if cache is None or not cache.object(ir_repr, otmp):
+            run(['llc-9', '-filetype=obj', '-o', otmp], bytes(optimize(ir_repr), 'utf-8'))
+            if cache is not None:
+                cache.store_object(ir_repr, otmp)
+
+        # % on floats is frem, which llc lowers to fmod/fmodf from libm
+        run(['clang', otmp, '-o', btmp, '-lm', '-lpthread'])
+        os.replace(otmp, oname)
+        os.replace(btmp, bname)
+
+    return oname, bname
+
+def build_lto(ir_repr, fpath):
+    """
+    Like build, but everything but main is internalized before opt, so
+    operators that are fully inlined are dropped, and what ends up unused
+    goes too, down to the sections of the binary
+    """
+    name  = program_name(fpath)
+    cname = 'obj/' + name + '.bc'
+    lname = 'obj/' + name + '.lto.bc'
+    oname = 'obj/' + name + '.o'
+    bname = 'bin/' + name
+
+    os.makedirs('obj', exist_ok=True)
+    os.makedirs('bin', exist_ok=True)
+
+    run(['llvm-as-9', '-o', cname], bytes(ir_repr, 'utf-8'))
+    run(['opt-9', '-internalize', '-internalize-public-api-list=main', '-O2',
+         '-mtriple=' + target_triple(), '-o', lname, cname])
+    run(['llc-9', '-filetype=obj', '-function-sections', '-data-sections', '-o', oname, lname])
+    run(['clang', oname, '-o', bname, '-lm', '-lpthread', '-Wl,--gc-sections'])
+
+    return oname, bname
+
+def profile_paths(fpath):
+    """ Where a training run of fpath leaves its counters, and its profile """
+    name = program_name(fpath)
+    os.makedirs('obj', exist_ok=True)
+    return os.path.abspath('obj/' + name + '.counts'), 'obj/' + name + '.pgo'
+
+def program_hash(text):
+    """ Profiles only apply to the program and compiler they were made with """
+    return hashlib.sha256(bytes(compiler_version() + text, 'utf-8')).hexdigest()
+
+def load_profile(path, program):
+    try:
+        with open(path, 'r') as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return profile if profile.get('program') == program else None
+
+def merge_profile(counts_path, path, program):
+    """
+    Adds the counters a training run left in counts_path to the profile in
+    path, which starts over when it is of another program. Returns the profile
+    """
+    counts = array.array('Q')
+    with open(counts_path, 'rb') as f:
+        counts.frombytes(f.read())
+    os.unlink(counts_path)
+
+    profile = load_profile(path, program)
+    if profile is None or len(profile['counts']) != len(counts):
+        profile = { 'program': program, 'runs': 0, 'counts': [ 0 ] * len(counts) }
+
+    profile['runs']  += 1
+    profile['counts'] = [ a + b for a, b in zip(profile['counts'], counts) ]
+
+    with open(path, 'w') as f:
+        json.dump(profile, f)
+    return profile
@@ -0,0 +1,131 @@
+"""
+Escape analysis of list literals.
+
+A list is its length and a pointer to its elements. The elements of a list
+literal go in a slot of the frame of the operator that makes it, allocated
+once in its entry block, unless the list may outlive that slot:
+
+- it may be returned, with return or as the value of the body,
+- it may be handed to an extern, which may keep it,
+- it is made inside a loop and may be kept in a variable declared outside
+  of it, as the next iteration reuses the slot.
+
+Those lists are put on the heap instead. Values are followed through
+variables and operator calls, whose result may be any list they are given,
+without regard to the order statements run in. Builtin arithmetic,
+comparisons and length give numbers, unless the program defines operators of
+the same name.
+"""
+
+from src.tokenizer import TokenType
+from src.parser    import ExprType
+
+LOOPS  = [ 'repeat', 'parallel', 'parallel+', 'parallel*' ]
+SCALAR = [ '+', '-', '*', '/', '%', '==', '!=', '<', '<=', '>', '>=', 'length' ]
+
+def defined(node):
+    """ Names of the operators defined anywhere in node """
+    names   = set()
+    pending = [ node ]
+    while pending:
+        node = pending.pop()
+        if node.token.value == 'is' and len(node.children) == 2 and len(node.children[1].children) > 0:
+            names.add(node.children[0].token.value)
+        pending.extend(node.children)
+    return names
+
+def escaping(body, returns, operators=()):
+    """
+    ids of the list nodes in body whose lists may outlive the frame. returns
+    is whether body is that of an operator, which returns its value, or main.
+    operators are the names the program defines operators with.
+    """
+    analysis = Analysis(returns, operators)
+    while True:
+        state = analysis.state()
+        lists = analysis.flow(body, 0)
+        if returns:
+            analysis.escaping |= lists
+        if analysis.state() == state:
+            return analysis.escaping
+
+class Analysis:
+    def __init__(self, returns, operators):
+        self.returns   = returns
+        self.operators = operators
+        self.escaping  = set()
+        self.depths    = {}     # Loop depth of every list node
+        self.declared  = {}     # Loop depth of every variable
+        self.values    = {}     # Lists every variable may hold
+
+    def state(self):
+        return len(self.escaping), sum(len(lists) for lists in self.values.values())
+
+    def flow(self, node, depth):
+        """ Lists the value of node may be """
+        if node.expr_type == ExprType.BLOCK:
+            lists = set()
+            for child in node.children:
+                lists = self.flow(child, depth)
+            return lists
+
+        if node.expr_type == ExprType.LIST:
+            self.depths[id(node)] = depth
+            lists = { id(node) }
+            for child in node.children:
+                lists |= self.flow(child, depth)
+            return lists
+
+        if node.token.kind != TokenType.IDENTIFIER:
+            return set()
+
+        name = node.token.value
+        if len(node.children) == 0:
+            return set(self.values.get(name, ()))
+
+        if name == 'is':
+            # Nested operators have frames of their own
+            var, tname = node.children
+            if tname.token.kind == TokenType.IDENTIFIER and len(tname.children) == 0:
+                self.declared.setdefault(var.token.value, depth)
+            return set()
+
+        if name == '=':
+            var   = node.children[0].token.value
+            lists = self.flow(node.children[1], depth)
+            for lst in lists:
+                if self.depths[lst] > self.declared.get(var, 0):
+                    self.escaping.add(lst)
+            self.values.setdefault(var, set()).update(lists)
+            return lists
+
+        if name == 'return':
+            lists = self.flow(node.children[1], depth)
+            if self.returns:
+                self.escaping |= lists
+            return lists
+
+        if name == 'called':
+            for child in node.children[1].children:
+                self.escaping |= self.flow(child, depth)
+            return set()
+
+        if name == 'extern':
+            return set()
+
+        if name == 'ptr-to':
+            return set(self.values.get(node.children[1].token.value, ()))
+
+        if name in LOOPS:
+            for child in node.children:
+                self.flow(child, depth + 1)
+            return set()
+
+        # ? and calls: whatever their operands may be
+        lists = set()
+        for child in node.children:
+            lists |= self.flow(child, depth)
+
+        if name in SCALAR and name not in self.operators:
+            return set()
+        return lists
@@ -1,3 +1,5 @@
+import math
+import operator
 import struct
 
 from dataclasses import dataclass
@@ -5,55 +7,372 @@ from enum        import Enum, auto
 
 from src.tokenizer import TokenType
 from src.parser    import Node, ExprType, print_ast
-from src.llvm      import Module, Type, Variable, ProgramUnknownOperationError
+from src.escape    import escaping, defined
+from src.llvm      import Module, Type, Variable, Generic, ANY, ProgramError, ProgramTypeError, ProgramUnknownOperationError
+
+# Evaluation budget of a single constant expression, in nodes visited, of
+# all of those of a module, and how deep user operators may call each other
+EVAL_STEPS  = 100000
+EVAL_BUDGET = 1000000
+EVAL_DEPTH  = 64
+
+INTEGER_BITS = { '%i8': 8, '%i16': 16, '%i32': 32, '%i64': 64 }
+FLOAT_FORMAT = { '%f32': 'f', '%f64': 'd' }
+
+def float_literal(text):
+    """ Value of a float literal, cut down to f32 the way Module.const_f32 does. """
+    bits = struct.unpack('@Q', struct.pack('@d', float(text)))[0]
+    return struct.unpack('@d', struct.pack('@Q', bits & 0xFFFF_FFFF_E000_0000))[0]
+
+def _div(a, b):
+    return abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+
+def _rem(a, b):
+    return a - b * _div(a, b)
+
+# Same operators as the builtins, with the same semantics as the LLVM
+# instructions they generate. Division by zero is left for runtime
+ARITHMETIC = {
+    '+' : (operator.add, operator.add),
+    '-' : (operator.sub, operator.sub),
+    '*' : (operator.mul, operator.mul),
+    '/' : (_div,         operator.truediv),
+    '%' : (_rem,         math.fmod),
+}
+
+COMPARISON = {
+    '==' : operator.eq,
+    '!=' : operator.ne,
+    '<'  : operator.lt,
+    '<=' : operator.le,
+    '>'  : operator.gt,
+    '>=' : operator.ge,
+}
+
+def generic_params(body):
+    """ Types of left and right of an operator body that declares either as any, else None. """
+    params = { 'left': '%void', 'right': '%void' }
+    for node in body.children if body.expr_type == ExprType.BLOCK else [ body ]:
+        if node.token.value != 'is' or len(node.children) != 2:
+            continue
+
+        name, tname = node.children
+        if name.token.value in params and len(name.children) == 0 \
+        and tname.token.kind == TokenType.IDENTIFIER and len(tname.children) == 0:
+            params[name.token.value] = '%' + tname.token.value
+
+    if ANY not in params.values():
+        return None
+    return params['left'], params['right']
+
+class EvaluationError(Exception):
+    pass
+
+class EvaluationLimit(EvaluationError):
+    pass
+
+class Return(Exception):
+    def __init__(self, value):
+        self.value = value
+
+class Evaluator:
+    """
+    Runs expressions at compile time when all they depend on are literals,
+    builtin arithmetic and user operators that only compute. Values are
+    (type name, python value) pairs. Anything else raises EvaluationError.
+    """
+
+    def __init__(self, module):
+        self.module      = module
+        self.definitions = {}
+        self.results     = {}
+        self.closed      = {}
+        self.budget      = EVAL_BUDGET
+
+    def define(self, name, body):
+        self.definitions[name] = body
+
+    def evaluate(self, node):
+        # Whole expressions are retried as their parts get generated
+        result = self.closed.get(id(node))
+        if isinstance(result, EvaluationError):
+            raise result
+        if result is not None:
+            return result
+
+        # What ran out of steps once is never tried again
+        try:
+            self.steps = EVAL_STEPS
+            self.depth = 0
+            result = self.node(node, None)
+        except RecursionError:
+            result = EvaluationLimit('Too deep')
+            raise result
+        except EvaluationError as error:
+            result = error
+            raise
+        finally:
+            if result is not None:
+                self.closed[id(node)] = result
 
-class Generator:
-    def __init__(self):
-        self.module = Module()
+        return result
 
-    def generate(self, node):
-        self.generate_node(node)
-        return self.module.to_llvm_ir()
+    def step(self):
+        self.steps  -= 1
+        self.budget -= 1
+        if self.steps < 0 or self.budget < 0:
+            raise EvaluationLimit('Out of steps')
+
+    def node(self, node, scope):
+        self.step()
 
-    def generate_node(self, node):
         if node.expr_type == ExprType.BLOCK:
-            return self.generate_block(node)
+            value = ('%void', None)
+            for child in node.children:
+                value = self.node(child, scope)
+            return value
 
         if node.expr_type == ExprType.LIST:
-            return self.generate_list(node)
+            raise EvaluationError('Lists are not evaluated')
+
+        if node.token.kind == TokenType.VOID:
+            return ('%void', None)
+
+        if node.token.kind == TokenType.BOOLEAN:
+            return ('%bool', node.token.value == 'true')
+
+        if node.token.kind == TokenType.INTEGER:
+            return ('%i32', int(node.token.value))
+
+        if node.token.kind == TokenType.FLOAT:
+            return ('%f32', float_literal(node.token.value))
+
+        if node.token.kind == TokenType.STRING:
+            return ('%cstr', node.token.value)
 
         if node.token.kind != TokenType.IDENTIFIER:
-            return self.generate_leaf(node)
-
-        special_cases = {
-            'as'     : self.generate_as,
-            'is'     : self.generate_declare,
-            '='      : self.generate_assign,
-            '?'      : self.generate_if,
-            'repeat' : self.generate_repeat,
-            'return' : self.generate_return,
-            'extern' : self.generate_extern,
-            'called' : self.generate_called,
-            'ptr-to' : self.generate_ptr_to,
-        }
-        
-        if node.token.value in special_cases:
-            return special_cases[node.token.value](node)
+            raise EvaluationError('Not a constant: ' + node.token.value)
 
         if len(node.children) == 0:
-            return self.module.variable('%' + node.token.value)
+            if scope is None or scope.get(node.token.value, (None, None))[1] is None:
+                raise EvaluationError('Unknown value: ' + node.token.value)
+            return scope[node.token.value]
+
+        statement = {
+            'is'     : self.declare,
+            '='      : self.assign,
+            '?'      : self.if_,
+            'repeat' : self.repeat,
+            'return' : self.return_,
+        }.get(node.token.value)
+
+        if statement is not None:
+            if scope is None:
+                raise EvaluationError('Statement outside of an operator')
+            return statement(node, scope)
+
+        left  = self.node(node.children[0], scope)
+        right = self.node(node.children[1], scope)
+        return self.call(node.token.value, left, right)
+
+    def declare(self, node, scope):
+        name, tname = node.children
+        if tname.token.kind != TokenType.IDENTIFIER or len(tname.children) > 0:
+            raise EvaluationError('Nested operators are not evaluated')
+
+        name = name.token.value
+        if name in [ 'left', 'right' ]:
+            return scope[name]
+
+        if name in scope:
+            raise EvaluationError('Duplicated variable: ' + name)
+
+        scope[name] = ('%' + tname.token.value, None)
+        return ('%void', None)
+
+    def assign(self, node, scope):
+        name  = node.children[0].token.value
+        value = self.node(node.children[1], scope)
+        if name in [ 'left', 'right' ] or scope.get(name, (None, None))[0] != value[0]:
+            raise EvaluationError('Cannot assign to ' + name)
+
+        scope[name] = value
+        return value
+
+    def condition(self, node, scope):
+        cond = self.node(node, scope)
+        if cond[0] != '%bool':
+            raise EvaluationError('Condition is not a bool')
+        return cond[1]
+
+    def if_(self, node, scope):
+        cond = self.condition(node.children[0], scope)
+        if cond:
+            self.node(node.children[1], scope)
+        return ('%bool', not cond)
+
+    def repeat(self, node, scope):
+        head = node.children[0]
+        if head.token.value != 'over':
+            while self.condition(head, scope):
+                self.node(node.children[1], scope)
+            return ('%void', None)
+
+        name, bounds = head.children
+        if bounds.expr_type != ExprType.LIST or len(bounds.children) != 2:
+            raise EvaluationError('Invalid range')
+
+        start = self.node(bounds.children[0], scope)
+        end   = self.node(bounds.children[1], scope)
+        if start[0] not in INTEGER_BITS or start[0] != end[0] or name.token.value in scope:
+            raise EvaluationError('Invalid range')
+
+        for index in range(start[1], end[1]):
+            scope[name.token.value] = (start[0], index)
+            self.node(node.children[1], scope)
+        scope.pop(name.token.value, None)
+        return ('%void', None)
+
+    def return_(self, node, scope):
+        raise Return(self.node(node.children[1], scope))
+
+    def call(self, name, left, right):
+        mangled = self.module.mangle_name(name, left[0], right[0])
+
+        if mangled in self.definitions:
+            return self.run(mangled, self.definitions[mangled], left, right)
+
+        # Instances of generics run the body they are made of
+        generic = self.module.template(name, left[0], right[0])
+        if generic is not None and mangled not in self.module.builtins:
+            return self.run(mangled, generic.node.children[1], left, right)
+
+        # Literals know their length
+        if name == 'str' and left[0] == '%void' and right[0] == '%cstr':
+            return ('%str', right[1])
+
+        if left[0] != right[0]:
+            raise EvaluationError('Unknown operation: ' + mangled)
+
+        if name in COMPARISON and (left[0] in INTEGER_BITS or left[0] in FLOAT_FORMAT or left[0] == '%bool'):
+            return ('%bool', COMPARISON[name](left[1], right[1]))
+
+        if name in ARITHMETIC and left[0] in INTEGER_BITS:
+            return (left[0], self.wrap(left[0], name, left[1], right[1]))
+
+        if name in ARITHMETIC and left[0] in FLOAT_FORMAT:
+            if name in [ '/', '%' ] and right[1] == 0:
+                raise EvaluationError('Division by zero')
+            value = ARITHMETIC[name][1](left[1], right[1])
+            return (left[0], self.round(left[0], value))
+
+        raise EvaluationError('Unknown operation: ' + mangled)
+
+    def run(self, name, body, left, right):
+        key = (name, left, right)
+        if key in self.results:
+            if self.results[key] is None:
+                raise EvaluationError('Not a constant: ' + name)
+            return self.results[key]
+
+        if self.depth >= EVAL_DEPTH:
+            raise EvaluationLimit('Too deep')
+
+        scope = { 'left': left, 'right': right }
+        self.depth += 1
+        try:
+            value = self.node(body, scope)
+        except Return as ret:
+            value = ret.value
+        except EvaluationError:
+            # Not a constant, or too costly to find out
+            self.results[key] = None
+            raise
+        finally:
+            self.depth -= 1
 
-        results = []
-        for child in node.children:
-            results.append(self.generate_node(child))
+        self.results[key] = value
+        return value
 
+    def wrap(self, tname, name, left, right):
+        bits = INTEGER_BITS[tname]
+        if name in [ '/', '%' ] and (right == 0 or (left == -2 ** (bits - 1) and right == -1)):
+            raise EvaluationError('Division traps')
+
+        value = ARITHMETIC[name][0](left, right) % 2 ** bits
+        return value - 2 ** bits if value >= 2 ** (bits - 1) else value
+
+    def round(self, tname, value):
         try:
-            return self.module.call(node.token.value, results[0], results[1])
-        except ProgramUnknownOperationError:
-            raise
-            
-        # Normally, unreacheable
-        return self.generate_unimpl(node)
+            fmt = FLOAT_FORMAT[tname]
+            return struct.unpack(fmt, struct.pack(fmt, value))[0]
+        except OverflowError:
+            raise EvaluationError('Overflow')
+
+
+class Generator:
+    def __init__(self, cache=None, debug=None, profile=None, pgo=None):
+        self.module    = Module(debug=debug, profile=profile, pgo=pgo)
+        self.evaluator = Evaluator(self.module)
+        self.cache     = cache
+        self.bound     = {}     # Types of left and right in the generic being instantiated
+        self.escaping  = set()  # List nodes of the body being generated that go on the heap
+        self.operators = set()  # Names of the operators the program defines
+
+        self.special_cases = {
+            'as'        : self.generate_as,
+            'is'        : self.generate_declare,
+            '='         : self.generate_assign,
+            '?'         : self.generate_if,
+            'repeat'    : self.generate_repeat,
+            'parallel'  : self.generate_parallel,
+            'parallel+' : self.generate_parallel,
+            'parallel*' : self.generate_parallel,
+            'return'    : self.generate_return,
+            'extern'    : self.generate_extern,
+            'called'    : self.generate_called,
+            'ptr-to'    : self.generate_ptr_to,
+        }
+
+    def generate(self, node):
+        self.operators = defined(node)
+        self.escaping  = escaping(node, False, self.operators)
+        self.generate_node(node)
+        return self.module.to_llvm_ir()
+
+    def generate_node(self, node):
+        with self.module.located(node.token):
+            if node.expr_type == ExprType.BLOCK:
+                return self.generate_block(node)
+
+            if node.expr_type == ExprType.LIST:
+                return self.generate_list(node)
+
+            if node.token.kind != TokenType.IDENTIFIER:
+                return self.generate_leaf(node)
+
+            if node.token.value in self.special_cases:
+                return self.special_cases[node.token.value](node)
+
+            if len(node.children) == 0:
+                return self.module.variable('%' + node.token.value)
+
+            constant = self.generate_constant(node)
+            if constant is not None:
+                return constant
+
+            left = self.generate_node(node.children[0])
+            if node.token.value == '@' and left.type.fields is not None:
+                return self.generate_field(node, left)
+
+            right = self.generate_node(node.children[1])
+            try:
+                return self.module.call(node.token.value, left, right)
+            except ProgramUnknownOperationError:
+                raise
+
+            # Normally, unreacheable
+            return self.generate_unimpl(node)
 
     def generate_unimpl(self, node):
         for child in node.children:
@@ -61,6 +380,56 @@ class Generator:
         self.module.current.llvm.comment('Unimplemented node: ' + node.token.value)
         return Variable(type=self.module.type('%void'))
 
+    def generate_tail(self, node):
+        """ Generates the value about to be returned: a call becomes a tail call. """
+        if node.expr_type == ExprType.BLOCK and len(node.children) > 0:
+            for child in node.children[:-1]:
+                self.generate_node(child)
+            return self.generate_tail(node.children[-1])
+
+        if node.expr_type == ExprType.LIST               \
+        or node.token.kind != TokenType.IDENTIFIER       \
+        or node.token.value in self.special_cases        \
+        or len(node.children) == 0:
+            return self.generate_node(node)
+
+        constant = self.generate_constant(node)
+        if constant is not None:
+            return constant
+
+        left = self.generate_node(node.children[0])
+        if node.token.value == '@' and left.type.fields is not None:
+            with self.module.located(node.token):
+                return self.generate_field(node, left)
+
+        right = self.generate_node(node.children[1])
+        with self.module.located(node.token):
+            return self.module.call(node.token.value, left, right, tail=True)
+
+    def generate_constant(self, node):
+        """ Generates the result of a call evaluated at compile time, if it can be. """
+        try:
+            tname, value = self.evaluator.evaluate(node)
+        except EvaluationError:
+            return None
+
+        if tname == '%void':
+            return Variable(type=self.module.type('%void'))
+
+        if tname == '%bool':
+            return self.module.const_bool('true' if value else 'false')
+
+        if tname == '%i32':
+            return self.module.const_i32(str(value))
+
+        if tname == '%f32':
+            return self.module.const_f32(repr(value))
+
+        if tname == '%str':
+            return self.module.const_str(value)
+
+        return None
+
     def generate_block(self, node):
         for child in node.children:
             ret = self.generate_node(child)
@@ -73,17 +442,53 @@ class Generator:
         if len(node.children[1].children) > 0:
             return self.generate_op_declare(node)
 
-        rname = '%' + node.children[0].token.value
-        rtype = self.module.type('%' + node.children[1].token.value)
-        return self.module.new_variable(rname, rtype)
+        name  = node.children[0].token.value
+        tname = '%' + node.children[1].token.value
+        if tname == ANY and name in self.bound:
+            return self.module.new_variable('%' + name, self.bound[name])
+
+        return self.module.new_variable('%' + name, self.module.type(tname))
 
     def generate_op_declare(self, node):
-        with self.module.function('@' + node.children[0].token.value):
-            ret = self.generate_node(node.children[1])
-            self.module.ret(ret)
-            fn = self.module.current
+        # Generics have no code until they are called
+        params = generic_params(node.children[1])
+        if params is not None:
+            return self.generate_generic(node, params)
+
+        # Cached code has no debug locations, counters nor weights
+        if self.cache is not None and self.module.debug is None and self.module.profile is None \
+        and self.module.pgo is None and self.module.current.name == '@main':
+            return self.cache.definition(self, node)
+        return self.generate_definition(node)
+
+    def generate_definition(self, node):
+        outer, self.escaping = self.escaping, escaping(node.children[1], True, self.operators)
+        try:
+            with self.module.function('@' + node.children[0].token.value), self.module.located(node.token):
+                ret = self.generate_tail(node.children[1])
+                self.module.ret(ret)
+                fn = self.module.current
+        finally:
+            self.escaping = outer
+        self.evaluator.define(fn.name, node.children[1])
         return fn.name
 
+    def generate_generic(self, node, params):
+        name = node.children[0].token.value
+        self.module.generic(Generic(name, *params, node, self.generate_instance))
+        if self.cache is not None:
+            self.cache.declare(self.module, node)
+        return '@' + name
+
+    def generate_instance(self, generic, ltype, rtype):
+        """ Generates the definition of generic with any bound to the types of a call """
+        bound, self.bound = self.bound, { 'left': ltype, 'right': rtype }
+        try:
+            name = self.generate_definition(generic.node)
+        finally:
+            self.bound = bound
+        return self.module.functions[name]
+
     def generate_extern(self, node):
         name  = '@' + node.children[0].token.value
         rtype = '%' + node.children[1].children[0].token.value
@@ -105,7 +510,7 @@ class Generator:
         return self.module.cast(name, type)
 
     def generate_return(self, node):
-        ret = self.generate_node(node.children[1])
+        ret = self.generate_tail(node.children[1])
         self.module.ret(ret)
         return ret
 
@@ -119,19 +524,154 @@ class Generator:
         return self.module.ptr_to(pname)
 
     def generate_if(self, node):
+        chain = self.switch_chain(node)
+        if chain is not None:
+            subject, ctype, cases, default = chain
+            if self.module.variable_type('%' + subject).name == ctype:
+                value = self.module.variable('%' + subject)
+                return self.generate_switch(value, cases, default)
+
         cond = self.generate_node(node.children[0])
         with self.module.if_then(cond):
             self.generate_node(node.children[1])
         return self.module.negate(cond)
 
+    def generate_switch(self, value, cases, default):
+        constants = []
+        bodies    = []
+        for constant, body in cases:
+            if constant not in constants: # The first test wins
+                constants.append(constant)
+                bodies.append(body)
+
+        with self.module.switch(value, constants) as switch:
+            for index, body in enumerate(bodies):
+                with switch.case(index):
+                    self.generate_node(body)
+
+            if default is not None:
+                with switch.default():
+                    self.generate_node(default)
+
+        # Like the chain of ?, whether the first test held
+        llvm = self.module.current.llvm
+        reg  = llvm.icmp('eq', value.type.to_llvm_ir(), value.name, constants[0])
+        return Variable(name=reg, type=self.module.type('%bool'))
+
+    def switch_chain(self, node):
+        """
+        Matches ((x == a) ? A) ? { ((x == b) ? B) ? { ... } } where x is a
+        variable and a, b... are integer literals or characters ("c" @ 0).
+        Returns the variable name, the type of the constants, the (constant,
+        body) cases and the innermost else body, or None.
+        """
+        cases   = []
+        default = None
+        subject = None
+        ctype   = None
+
+        while node is not None:
+            node = self.unwrap(node)
+            if node.token.value != '?':
+                default = node
+                break
+
+            test = self.unwrap(node.children[0])
+            if test.token.value == '?':
+                test, body = test.children
+                node       = node.children[1]
+            else:
+                body = node.children[1]
+                node = None
+
+            case = self.switch_case(self.unwrap(test))
+            if case is None or (subject, ctype) not in [ (None, None), case[:2] ]:
+                return None
+
+            subject, ctype, constant = case
+            cases.append((constant, body))
+
+        if len(cases) < 2:
+            return None
+
+        return subject, ctype, cases, default
+
+    def switch_case(self, test):
+        """ Matches x == constant, returning x, the constant type and value. """
+        if test.token.value != '==' or len(test.children) != 2:
+            return None
+
+        subject, constant = test.children
+        if subject.token.kind != TokenType.IDENTIFIER or len(subject.children) > 0:
+            return None
+
+        constant = self.unwrap(constant)
+        if constant.token.kind == TokenType.INTEGER:
+            return subject.token.value, '%i32', int(constant.token.value)
+
+        if constant.token.value != '@' or len(constant.children) != 2:
+            return None
+
+        string, index = [ self.unwrap(child) for child in constant.children ]
+        if string.token.kind != TokenType.STRING or index.token.kind != TokenType.INTEGER:
+            return None
+
+        data  = string.token.value.encode('utf-8')
+        index = int(index.token.value)
+        if index < 0 or index >= len(data):
+            return None
+
+        return subject.token.value, '%i8', struct.unpack('b', data[index:index + 1])[0]
+
+    def unwrap(self, node):
+        while node.expr_type == ExprType.BLOCK and len(node.children) == 1:
+            node = node.children[0]
+        return node
+
     def generate_repeat(self, node):
-        with self.module.loop() as loop:
+        if node.children[0].token.value == 'over':
+            return self.generate_over(node)
+
+        with self.module.loop(node.token) as loop:
             cond  = self.generate_node(node.children[0])
             ncond = self.module.negate(cond)
             with self.module.if_then(ncond):
                 loop.end()
             self.generate_node(node.children[1])
 
+    def generate_over(self, node):
+        name, bounds = node.children[0].children
+        if name.token.kind != TokenType.IDENTIFIER or len(name.children) > 0 \
+        or bounds.expr_type != ExprType.LIST or len(bounds.children) != 2:
+            raise ProgramError('Expected (name over (start, end)) repeat body')
+
+        start = self.generate_node(bounds.children[0])
+        end   = self.generate_node(bounds.children[1])
+        with self.module.counted_loop('%' + name.token.value, start, end, node.token):
+            self.generate_node(node.children[1])
+
+    def generate_parallel(self, node):
+        """ (i over (start, end[, chunk])) parallel body, parallel+ and parallel* reduce """
+        head, body = node.children
+        if head.token.value != 'over':
+            raise ProgramError('Expected (name over (start, end)) {} body'.format(node.token.value))
+
+        name, bounds = head.children
+        if name.token.kind != TokenType.IDENTIFIER or len(name.children) > 0 \
+        or bounds.expr_type != ExprType.LIST or len(bounds.children) not in [ 2, 3 ]:
+            raise ProgramError('Expected (name over (start, end[, chunk])) {} body'.format(node.token.value))
+
+        start = self.generate_node(bounds.children[0])
+        end   = self.generate_node(bounds.children[1])
+        chunk = self.generate_node(bounds.children[2]) if len(bounds.children) == 3 else None
+
+        reduce = node.token.value[len('parallel'):] or None
+        with self.module.parallel('%' + name.token.value, start, end, chunk, reduce, node.token) as loop:
+            value = self.generate_node(body)
+            if reduce is not None:
+                loop.reduce(value)
+        return loop.result
+
     def generate_list(self, node):
         children = []
         for child in node.children:
@@ -142,13 +682,27 @@ class Generator:
         if len(children) > 0:
             c0_type = children[0].type
 
-        if all(c0_type == child.type for child in children):
-            reg = self.module.new_list(children)
+        if any(child.type is self.module.types['%void'] for child in children):
+            raise ProgramTypeError('Lists cannot hold void')
+
+        if all(child.type is c0_type for child in children):
+            reg = self.module.new_list(children, stack=id(node) not in self.escaping)
         else:
             reg = self.module.new_struct(children)
 
         return reg
 
+    def generate_field(self, node, struct):
+        """ struct @ index, where index is known while compiling """
+        try:
+            tname, index = self.evaluator.evaluate(node.children[1])
+        except EvaluationError:
+            tname = None
+
+        if tname not in [ '%i32', '%i64' ]:
+            raise ProgramTypeError('Fields of {} are read with a constant index'.format(struct.type.name[1:]))
+        return self.module.field(struct, index)
+
     def generate_leaf(self, leaf):
         llvm = self.module.current.llvm
 
@@ -0,0 +1,1080 @@
+"""
+Runs programs straight from their AST, without LLVM.
+
+Nodes are compiled once into Python closures that take the frame of the
+operator they run in, with every overload resolved up front the same way
+the generator resolves it. Whatever C gets to see (strings, variables behind
+ptr-to, argv, the input buffer, mappings) is real memory handled through
+ctypes, and externs like printf or scanf are called in the C library.
+"""
+
+import ctypes
+import math
+import struct
+
+from fractions  import Fraction
+
+from src.tokenizer import TokenType
+from src.parser    import ExprType
+from src.llvm      import mangle_name, Types, Generic, ANY, ProgramError, ProgramTypeError, ProgramUnknownOperationError
+from src.generator import ARITHMETIC, COMPARISON, INTEGER_BITS, float_literal, generic_params
+from src.builtin   import OUT_BUFFER_SIZE, IN_BUFFER_SIZE, MAP_TYPES
+
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+LIBC.fwrite.argtypes  = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_size_t, ctypes.c_void_p ]
+LIBC.read.argtypes    = [ ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t ]
+LIBC.read.restype     = ctypes.c_ssize_t
+LIBC.strtod.argtypes  = [ ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p) ]
+LIBC.strtod.restype   = ctypes.c_double
+LIBC.open.argtypes    = [ ctypes.c_void_p, ctypes.c_int ]
+LIBC.lseek.argtypes   = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int ]
+LIBC.lseek.restype    = ctypes.c_int64
+LIBC.mmap.argtypes    = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int64 ]
+LIBC.mmap.restype     = ctypes.c_void_p
+LIBC.munmap.argtypes  = [ ctypes.c_void_p, ctypes.c_size_t ]
+LIBC.fflush.argtypes  = [ ctypes.c_void_p ]
+
+STDOUT = ctypes.c_void_p.in_dll(LIBC, 'stdout')
+
+FLOAT_FORMAT = { '%f16': 'e', '%f32': 'f', '%f64': 'd' }
+
+class ListI8(ctypes.Structure):
+    _fields_ = [ ('length', ctypes.c_int64), ('data', ctypes.c_void_p) ]
+
+# Memory layout of the types variables behind a ptr-to can have
+CELLS = {
+    '%bool'    : ctypes.c_bool,
+    '%i8'      : ctypes.c_int8,
+    '%i16'     : ctypes.c_int16,
+    '%i32'     : ctypes.c_int32,
+    '%i64'     : ctypes.c_int64,
+    '%f32'     : ctypes.c_float,
+    '%f64'     : ctypes.c_double,
+    '%list.i8' : ListI8,
+}
+
+def is_pointer(tname):
+    return tname in [ '%ptr', '%cstr' ] or tname.endswith('.ptr')
+
+def cell_type(tname):
+    if is_pointer(tname):
+        return ctypes.c_void_p
+
+    try:
+        return CELLS[tname]
+    except KeyError:
+        raise ProgramTypeError('Cannot take the address of a ' + tname)
+
+def wrap(bits, value):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+def round_float(fmt, value):
+    try:
+        return struct.unpack(fmt, struct.pack(fmt, value))[0]
+    except OverflowError:
+        return math.copysign(math.inf, value)
+
+def fdiv(a, b):
+    if b != 0:
+        return a / b
+    if a == 0 or math.isnan(a):
+        return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+def frem(a, b):
+    try:
+        return math.fmod(a, b)
+    except ValueError:
+        return math.nan
+
+
+class Return(Exception):
+    def __init__(self, value):
+        self.value = value
+
+class TailCall:
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left, right):
+        self.left  = left
+        self.right = right
+
+
+class Operator:
+    """ A user operator: a compiled body run on a fresh frame per call. """
+
+    def __init__(self, name):
+        self.name  = name
+        self.rtype = '%void'
+        self.body  = None
+        self.size  = 2
+
+    def __call__(self, left, right):
+        while True:
+            frame    = [ None ] * self.size
+            frame[0] = left
+            frame[1] = right
+            try:
+                value = self.body(frame)
+            except Return as ret:
+                value = ret.value
+
+            # Self-recursion in tail position loops instead of nesting
+            if value.__class__ is TailCall:
+                left, right = value.left, value.right
+                continue
+
+            return value
+
+
+class Scope:
+    """ Where the variables of the operator being compiled live in its frame. """
+
+    def __init__(self, operator):
+        self.operator  = operator
+        self.args      = {}
+        self.variables = {}
+        self.addressed = set()
+
+    def slot(self):
+        self.operator.size += 1
+        return self.operator.size - 1
+
+    def signature(self):
+        ltype = self.args['left'][1] if 'left' in self.args else '%void'
+        rtype = self.args['right'][1] if 'right' in self.args else '%void'
+        return mangle_name(self.operator.name, ltype, rtype)
+
+
+# Builtins, keyed by mangled name like src/builtin.py. Each one is a
+# function of the interpreter and both arguments, plus its return type.
+
+BUILTINS = {}
+
+def _builtin(name, ltype='%void', rtype='%void', ftype='%void'):
+    def register(fn):
+        BUILTINS[mangle_name(name, ltype, rtype)] = (fn, ftype)
+        return fn
+    return register
+
+
+def _integer(bits, op):
+    return lambda rt, a, b: wrap(bits, op(a, b))
+
+def _float(fmt, op):
+    return lambda rt, a, b: round_float(fmt, op(a, b))
+
+for _op, (_int, _flt) in ARITHMETIC.items():
+    _flt = { '/': fdiv, '%': frem }.get(_op, _flt)
+    for _type, _bits in INTEGER_BITS.items():
+        _builtin(_op, _type, _type, _type)(_integer(_bits, _int))
+    for _type, _fmt in FLOAT_FORMAT.items():
+        _builtin(_op, _type, _type, _type)(_float(_fmt, _flt))
+
+def _compare(op):
+    return lambda rt, a, b: op(a, b)
+
+# bool compares unsigned, false before true
+for _op, _cmp in COMPARISON.items():
+    for _type in list(INTEGER_BITS) + [ '%bool', '%ptr' ] + list(FLOAT_FORMAT):
+        _builtin(_op, _type, _type, '%bool')(_compare(_cmp))
+
+
+@_builtin('@', '%cstr.ptr', '%i32', '%cstr')
+def cstrptr_at_i32(rt, left, right):
+    return ctypes.c_void_p.from_address(left + 8 * right).value or 0
+
+@_builtin('@', '%cstr', '%i32', '%i8')
+def cstr_at_i32(rt, left, right):
+    return ctypes.c_int8.from_address(left + right).value
+
+@_builtin('@', '%list.i8', '%i32', '%i8')
+@_builtin('@', '%list.i8', '%i64', '%i8')
+def listi8_at(rt, left, right):
+    return ctypes.c_int8.from_address(left[1] + right).value
+
+
+@_builtin('flush')
+def void_flush_void(rt, left, right):
+    rt.flush()
+
+@_builtin('write', rtype='%cstr')
+def void_write_cstr(rt, left, right):
+    rt.write(ctypes.string_at(right))
+
+@_builtin('write', rtype='%str')
+def void_write_str(rt, left, right):
+    rt.write(ctypes.string_at(right[1], right[0]))
+
+@_builtin('write', rtype='%bool')
+def void_write_bool(rt, left, right):
+    rt.write(b'true' if right else b'false')
+
+@_builtin('write', rtype='%ptr')
+def void_write_ptr(rt, left, right):
+    rt.write(b'0x%x' % right if right else b'null')
+
+@_builtin('write', rtype='%i8')
+@_builtin('write', rtype='%i16')
+@_builtin('write', rtype='%i32')
+@_builtin('write', rtype='%i64')
+def void_write_int(rt, left, right):
+    rt.write(b'%d' % right)
+
+@_builtin('write', rtype='%f16')
+@_builtin('write', rtype='%f32')
+@_builtin('write', rtype='%f64')
+def void_write_float(rt, left, right):
+    # Same steps as the generated code, which only calls snprintf for the
+    # values it cannot print as integers, rounding half to even like it
+    if abs(right) < 1.0e9:
+        fixed = round(Fraction(abs(right)) * 1000000)
+        sign  = b'-' if math.copysign(1.0, right) < 0 else b''
+        rt.write(b'%s%d.%06d' % (sign, fixed // 1000000, fixed % 1000000))
+    else:
+        text = ctypes.create_string_buffer(320)
+        size = LIBC.snprintf(text, 320, b'%f', ctypes.c_double(right))
+        rt.write(text.raw[:size])
+
+
+def _read_int(bits):
+    def read(rt, left, right):
+        text = rt.token()
+        if text == 0:
+            return False
+
+        data  = ctypes.string_at(text)
+        first = 1 if data[:1] in [ b'-', b'+' ] else 0
+        at    = first
+        value = 0
+        while at < len(data) and 48 <= data[at] <= 57:
+            value = value * 10 + data[at] - 48
+            at   += 1
+
+        value = -value if data[:1] == b'-' else value
+        CELLS['%i{}'.format(bits)].from_address(right).value = wrap(bits, value)
+        return at > first
+    return read
+
+for _type, _bits in INTEGER_BITS.items():
+    _builtin('read', rtype=_type + '.ptr', ftype='%bool')(_read_int(_bits))
+
+def _read_float(ctype):
+    def read(rt, left, right):
+        text = rt.token()
+        if text == 0:
+            return False
+
+        end = ctypes.c_void_p()
+        ctype.from_address(right).value = LIBC.strtod(text, ctypes.byref(end))
+        return end.value != text
+    return read
+
+_builtin('read', rtype='%f32.ptr', ftype='%bool')(_read_float(ctypes.c_float))
+_builtin('read', rtype='%f64.ptr', ftype='%bool')(_read_float(ctypes.c_double))
+
+@_builtin('read', rtype='%cstr.ptr', ftype='%bool')
+def void_read_cstrptr(rt, left, right):
+    text = rt.token()
+    ctypes.c_void_p.from_address(right).value = text
+    return text != 0
+
+@_builtin('read_line', rtype='%cstr.ptr', ftype='%bool')
+def void_readline_cstrptr(rt, left, right):
+    text = rt.until(True)
+    ctypes.c_void_p.from_address(right).value = text
+    return text != 0
+
+
+@_builtin('mmap', rtype='%cstr', ftype='%list.i8')
+def void_mmap_cstr(rt, left, right):
+    fd = LIBC.open(right, 0)   # O_RDONLY
+    if fd < 0:
+        return (0, 0)
+
+    length = LIBC.lseek(fd, 0, 2)   # SEEK_END
+    if length <= 0:
+        LIBC.close(fd)
+        return (0, 0)
+
+    data = LIBC.mmap(None, length, 1, 2, fd, 0)   # PROT_READ, MAP_PRIVATE
+    LIBC.close(fd)
+    if data is None or data == ctypes.c_void_p(-1).value:
+        return (0, 0)
+    return (length, data)
+
+@_builtin('unmap', rtype='%list.i8', ftype='%bool')
+def void_unmap_listi8(rt, left, right):
+    return LIBC.munmap(right[1], right[0]) == 0
+
+@_builtin('length', rtype='%list.i8', ftype='%i64')
+def void_length_listi8(rt, left, right):
+    return right[0]
+
+@_builtin('data', rtype='%list.i8', ftype='%cstr')
+def void_data_listi8(rt, left, right):
+    return right[1]
+
+
+def _ptr_set(tname):
+    def set(rt, left, right):
+        CELLS[tname].from_address(left).value = right
+        return right
+    return set
+
+for _type in [ '%bool' ] + list(INTEGER_BITS) + list(FLOAT_FORMAT):
+    _builtin('set', _type + '.ptr', _type, _type)(_ptr_set(_type))
+
+
+# Maps are dicts of their keys to the cells of their values, so put can hand
+# out real addresses. String keys are kept by their bytes
+
+def _map_key(ktype):
+    if ktype == '%cstr':
+        return ctypes.string_at
+    return lambda key: key
+
+def _map_put(key, cell):
+    def put(rt, left, right):
+        right = key(right)
+        if right not in left:
+            left[right] = cell()
+        return ctypes.addressof(left[right])
+    return put
+
+def _map_get(key):
+    def get(rt, left, right):
+        value = left.get(key(right))
+        return 0 if value is None else value.value
+    return get
+
+def _map_has(key):
+    return lambda rt, left, right: key(right) in left
+
+def _map_remove(key):
+    return lambda rt, left, right: left.pop(key(right), None) is not None
+
+for _map, (_key, _value) in MAP_TYPES.items():
+    _builtin(_map[1:], rtype='%i32', ftype=_map)(lambda rt, left, right: {})
+    _builtin('put',    _map, _key, _value + '.ptr')(_map_put(_map_key(_key), CELLS[_value]))
+    _builtin('@',      _map, _key, _value)(_map_get(_map_key(_key)))
+    _builtin('has',    _map, _key, '%bool')(_map_has(_map_key(_key)))
+    _builtin('remove', _map, _key, '%bool')(_map_remove(_map_key(_key)))
+    _builtin('length', rtype=_map, ftype='%i64')(lambda rt, left, right: len(right))
+    _builtin('free',   rtype=_map)(lambda rt, left, right: right.clear())
+
+
+# A str is (length, address) as in compiled code. Builders keep their bytes
+# in Python, and a C copy of them for the last str taken
+
+class Builder:
+    def __init__(self):
+        self.data = bytearray()
+        self.view = None
+
+@_builtin('str', rtype='%cstr', ftype='%str')
+def void_str_cstr(rt, left, right):
+    return (len(ctypes.string_at(right)), right)
+
+@_builtin('cstr', rtype='%str', ftype='%cstr')
+def void_cstr_str(rt, left, right):
+    return right[1]
+
+@_builtin('length', rtype='%str', ftype='%i64')
+def void_length_str(rt, left, right):
+    return right[0]
+
+@_builtin('@', '%str', '%i32', '%i8')
+@_builtin('@', '%str', '%i64', '%i8')
+def str_at(rt, left, right):
+    return ctypes.c_int8.from_address(left[1] + right).value
+
+@_builtin('==', '%str', '%str', '%bool')
+def str_eq_str(rt, left, right):
+    return ctypes.string_at(left[1], left[0]) == ctypes.string_at(right[1], right[0])
+
+@_builtin('!=', '%str', '%str', '%bool')
+def str_ne_str(rt, left, right):
+    return not str_eq_str(rt, left, right)
+
+@_builtin('str.builder', rtype='%i32', ftype='%str.builder')
+def void_builder_i32(rt, left, right):
+    return Builder()
+
+def _append(convert):
+    def append(rt, left, right):
+        left.data += convert(right)
+        return left
+    return append
+
+_builtin('append', '%str.builder', '%str',  '%str.builder')(_append(lambda text: ctypes.string_at(text[1], text[0])))
+_builtin('append', '%str.builder', '%cstr', '%str.builder')(_append(ctypes.string_at))
+_builtin('append', '%str.builder', '%i8',   '%str.builder')(_append(lambda char: bytes([ char & 0xFF ])))
+_builtin('append', '%str.builder', '%i32',  '%str.builder')(_append(lambda value: b'%d' % value))
+_builtin('append', '%str.builder', '%i64',  '%str.builder')(_append(lambda value: b'%d' % value))
+
+@_builtin('str', rtype='%str.builder', ftype='%str')
+def void_str_builder(rt, left, right):
+    right.view = ctypes.create_string_buffer(bytes(right.data))
+    return (len(right.data), ctypes.addressof(right.view))
+
+@_builtin('clear', rtype='%str.builder', ftype='%str.builder')
+def void_clear_builder(rt, left, right):
+    right.data.clear()
+    return right
+
+@_builtin('free', rtype='%str.builder')
+def void_free_builder(rt, left, right):
+    right.data = bytearray()
+    right.view = None
+
+
+# Lists are tuples of their elements, except list.i8, which is its length and
+# the address of its bytes, as mmap gives it. Structs are tuples of their
+# fields in the order written. Both are typed by name, as src/llvm.py names
+# them, so the types of elements and fields are read back from their names.
+
+TYPES = Types()
+for _type in [ '%bool', '%ptr', '%cstr', '%str', '%str.builder' ] + list(INTEGER_BITS) + list(FLOAT_FORMAT) + list(MAP_TYPES):
+    TYPES.intern(_type, _type)
+
+def type_of(tname):
+    type = TYPES[tname] if tname in TYPES else TYPES.named(tname)
+    if type is None:
+        raise ProgramTypeError('Undeclared type: ' + tname)
+    return type
+
+# Builtins on every type of a family, like src/builtin.py: functions of the
+# type that give the builtin, and the type of their result
+
+FAMILIES = {}
+
+def _family(name, prefix, others=[ '%void' ], ftype=None):
+    def register(fn):
+        FAMILIES.setdefault(name, []).append((prefix, others, fn, ftype))
+        return fn
+    return register
+
+def builtin(name, ltype, rtype):
+    """ The builtin for a call and its return type, or None """
+    mangled = mangle_name(name, ltype, rtype)
+    if mangled in BUILTINS:
+        return BUILTINS[mangled]
+
+    type, other = (rtype, ltype) if ltype == '%void' else (ltype, rtype)
+    for prefix, others, fn, ftype in FAMILIES.get(name, []):
+        if type.startswith(prefix) and other in others:
+            return fn(type), '%void' if ftype is None else ftype(type)
+    return None
+
+def _writer(tname):
+    write = builtin('write', '%void', tname)
+    if write is None:
+        raise ProgramUnknownOperationError('Unknown operation: {}'.format(mangle_name('write', '%void', tname)))
+    return write[0]
+
+def _write_items(rt, write, items):
+    rt.write(b'[')
+    for index, item in enumerate(items):
+        if index > 0:
+            rt.write(b', ')
+        write(rt, None, item)
+    rt.write(b']')
+
+@_family('write', '%list.')
+def _list_write(type):
+    write = _writer('%' + type[len('%list.'):])
+    if type == '%list.i8':
+        return lambda rt, left, right: _write_items(rt, write, (ctypes.c_int8 * right[0]).from_address(right[1]) if right[0] else ())
+    return lambda rt, left, right: _write_items(rt, write, right)
+
+@_family('length', '%list.', ftype=lambda type: '%i64')
+def _list_length(type):
+    return lambda rt, left, right: len(right)
+
+@_family('@', '%list.', [ '%i32', '%i64' ], ftype=lambda type: '%' + type[len('%list.'):])
+def _list_at(type):
+    return lambda rt, left, right: left[right]
+
+@_family('write', '%struct.')
+def _struct_write(type):
+    writes = [ _writer(field.name) for field in type_of(type).fields ]
+    def write(rt, left, right):
+        rt.write(b'[')
+        for index, (field, value) in enumerate(zip(writes, right)):
+            if index > 0:
+                rt.write(b', ')
+            field(rt, None, value)
+        rt.write(b']')
+    return write
+
+
+# Argument types of externs, as C gets them
+
+def _c_arg(tname, vararg):
+    if is_pointer(tname):
+        return ctypes.c_void_p
+    if tname in FLOAT_FORMAT:
+        return ctypes.c_double if vararg else CELLS.get(tname, ctypes.c_double)
+    if tname == '%i64':
+        return ctypes.c_int64
+    if tname == '%list.i8':
+        return ListI8
+    return ctypes.c_int if vararg else CELLS[tname]
+
+
+class Interpreter:
+    def __init__(self, argv):
+        self.argv      = argv
+        self.functions = {}
+        self.generics  = {}
+        self.externals = {}
+        self.strings   = {}
+        self.buffers   = []     # Bytes of list.i8 literals
+        self.scope     = None
+        self.bound     = {}
+
+        self.out = bytearray()
+
+        self.in_buf  = ctypes.create_string_buffer(IN_BUFFER_SIZE + 1)
+        self.in_addr = ctypes.addressof(self.in_buf)
+        self.in_view = (ctypes.c_ubyte * (IN_BUFFER_SIZE + 1)).from_buffer(self.in_buf)
+        self.in_pos  = 0
+        self.in_len  = 0
+
+        self.special_cases = {
+            'as'        : self.compile_as,
+            'is'        : self.compile_declare,
+            '='         : self.compile_assign,
+            '?'         : self.compile_if,
+            'repeat'    : self.compile_repeat,
+            'parallel'  : self.compile_parallel,
+            'parallel+' : self.compile_parallel,
+            'parallel*' : self.compile_parallel,
+            'return'    : self.compile_return,
+            'extern'    : self.compile_extern,
+            'called'    : self.compile_called,
+            'ptr-to'    : self.compile_ptr_to,
+        }
+
+    def run(self, node):
+        main       = Operator('@main')
+        self.scope = Scope(main)
+        self.scope.args['argc'] = (0, '%i32')
+        self.scope.args['argv'] = (1, '%cstr.ptr')
+        self.address_taken(node)
+        main.body, _ = self.compile(node)
+
+        args = [ arg.encode('utf-8') for arg in self.argv ]
+        argv = (ctypes.c_char_p * (len(args) + 1))(*args, None)
+
+        try:
+            main(len(args), ctypes.addressof(argv))
+        finally:
+            self.flush()
+            LIBC.fflush(None)
+        return 0
+
+    # Output, buffered the same way as the generated code
+
+    def write(self, data):
+        if len(data) > OUT_BUFFER_SIZE - len(self.out):
+            self.flush()
+            if len(data) > OUT_BUFFER_SIZE:
+                LIBC.fwrite(data, 1, len(data), STDOUT)
+                return
+        self.out += data
+
+    def flush(self):
+        if len(self.out) > 0:
+            LIBC.fwrite(bytes(self.out), 1, len(self.out), STDOUT)
+            self.out.clear()
+
+    # Input, with the same steps as the generated code
+
+    def fill(self):
+        left = self.in_len - self.in_pos
+        ctypes.memmove(self.in_addr, self.in_addr + self.in_pos, left)
+        self.in_pos = 0
+
+        got = LIBC.read(0, self.in_addr + left, IN_BUFFER_SIZE - left)
+        self.in_len = left + max(got, 0)
+        return got > 0
+
+    def until(self, lines):
+        at = self.in_pos
+        while True:
+            if at == self.in_len:
+                left = self.in_len - self.in_pos
+                if left == IN_BUFFER_SIZE or not self.fill():
+                    if left != IN_BUFFER_SIZE:
+                        at = left
+                    break
+                at = left
+                continue
+
+            char = self.in_view[at]
+            if (char == 10) if lines else (char <= 32):
+                break
+            at += 1
+
+        if at == self.in_pos and at == self.in_len:
+            return 0
+
+        text = self.in_addr + self.in_pos
+        self.in_view[at] = 0
+        self.in_pos = at if at == self.in_len else at + 1
+        return text
+
+    def token(self):
+        while True:
+            if self.in_pos == self.in_len:
+                if not self.fill():
+                    return 0
+                continue
+
+            if self.in_view[self.in_pos] > 32:
+                return self.until(False)
+            self.in_pos += 1
+
+    # Compilation of nodes into closures, returning them with their type
+
+    def address_taken(self, node):
+        """ Variables behind a ptr-to live in C memory, the rest in the frame. """
+        if node.token.value == 'ptr-to' and len(node.children) == 2:
+            self.scope.addressed.add(node.children[1].token.value)
+
+        # Nested operators have scopes of their own
+        if node.token.value == 'is' and len(node.children) == 2 and len(node.children[1].children) > 0:
+            return
+
+        for child in node.children:
+            self.address_taken(child)
+
+    def compile(self, node):
+        if node.expr_type == ExprType.BLOCK:
+            return self.compile_block(node)
+
+        if node.expr_type == ExprType.LIST:
+            return self.compile_list(node)
+
+        if node.token.kind != TokenType.IDENTIFIER:
+            return self.compile_leaf(node)
+
+        if node.token.value in self.special_cases:
+            return self.special_cases[node.token.value](node)
+
+        if len(node.children) == 0:
+            return self.compile_variable(node.token.value)
+
+        left = self.compile(node.children[0])
+        if node.token.value == '@' and left[1].startswith('%struct.'):
+            return self.compile_field(node, left)
+
+        right = self.compile(node.children[1])
+        return self.compile_call(node.token.value, left, right)
+
+    def compile_tail(self, node):
+        """ Like Generator.generate_tail: calls to the operator itself loop. """
+        if node.expr_type == ExprType.BLOCK and len(node.children) > 0:
+            steps      = [ self.compile(child)[0] for child in node.children[:-1] ]
+            last, type = self.compile_tail(node.children[-1])
+            def block(f):
+                for step in steps:
+                    step(f)
+                return last(f)
+            return block, type
+
+        if node.expr_type == ExprType.LIST               \
+        or node.token.kind != TokenType.IDENTIFIER       \
+        or node.token.value in self.special_cases        \
+        or len(node.children) == 0:
+            return self.compile(node)
+
+        left = self.compile(node.children[0])
+        if node.token.value == '@' and left[1].startswith('%struct.'):
+            return self.compile_field(node, left)
+
+        right = self.compile(node.children[1])
+        name  = mangle_name(node.token.value, left[1], right[1])
+        if name != self.scope.signature() or is_pointer(left[1]) or is_pointer(right[1]):
+            return self.compile_call(node.token.value, left, right)
+
+        (lfn, _), (rfn, _) = left, right
+        return (lambda f: TailCall(lfn(f), rfn(f))), self.scope.operator.rtype
+
+    def compile_call(self, fname, left, right):
+        (lfn, ltype), (rfn, rtype) = left, right
+        name = mangle_name(fname, ltype, rtype)
+
+        if name == self.scope.signature():
+            target = self.scope.operator
+            ftype  = target.rtype
+        elif name in self.functions:
+            target = self.functions[name]
+            ftype  = target.rtype
+        elif builtin(fname, ltype, rtype) is not None:
+            call, ftype = builtin(fname, ltype, rtype)
+            return (lambda f: call(self, lfn(f), rfn(f))), ftype
+        else:
+            target = self.instance(name, ltype, rtype)
+            ftype  = target.rtype
+
+        return (lambda f: target(lfn(f), rfn(f))), ftype
+
+    def compile_block(self, node):
+        steps = [ self.compile(child) for child in node.children ]
+        if len(steps) == 0:
+            return (lambda f: None), '%void'
+
+        *steps, (last, type) = steps
+        steps = [ step for step, _ in steps ]
+        def block(f):
+            for step in steps:
+                step(f)
+            return last(f)
+        return block, type
+
+    def compile_list(self, node):
+        """ Like Generator.generate_list: a list if all elements have one type, else a struct """
+        items  = [ self.compile(child) for child in node.children ]
+        values = [ value for value, _ in items ]
+        types  = [ type for _, type in items ]
+        if '%void' in types:
+            raise ProgramTypeError('Lists cannot hold void')
+
+        if len(set(types)) > 1:
+            type = TYPES.struct([ type_of(type) for type in types ]).name
+            return (lambda f: tuple(value(f) for value in values)), type
+
+        if len(types) > 0 and types[0] != '%i8':
+            return (lambda f: tuple(value(f) for value in values)), '%list.' + types[0][1:]
+
+        # Bytes stay alive for the rest of the program, as in a frame or on the heap
+        buffers = self.buffers
+        def list_i8(f):
+            if len(values) == 0:
+                return 0, 0
+            data = (ctypes.c_int8 * len(values))(*[ value(f) for value in values ])
+            buffers.append(data)
+            return len(values), ctypes.addressof(data)
+        return list_i8, '%list.i8'
+
+    def compile_field(self, node, struct):
+        """ struct @ index, where index is an integer literal """
+        index = node.children[1]
+        while index.expr_type == ExprType.BLOCK and len(index.children) == 1:
+            index = index.children[0]
+        if index.token.kind != TokenType.INTEGER:
+            raise ProgramTypeError('Fields of {} are read with a constant index'.format(struct[1][1:]))
+
+        value, tname = struct
+        fields = type_of(tname).fields
+        index  = int(index.token.value)
+        if not 0 <= index < len(fields):
+            raise ProgramTypeError('No field {} in {}'.format(index, tname[1:]))
+        return (lambda f: value(f)[index]), fields[index].name
+
+    def compile_leaf(self, leaf):
+        kind = leaf.token.kind
+
+        if kind == TokenType.VOID:
+            return (lambda f: None), '%void'
+
+        if kind == TokenType.NULL:
+            return (lambda f: 0), '%ptr'
+
+        if kind == TokenType.BOOLEAN:
+            value = leaf.token.value == 'true'
+            return (lambda f: value), '%bool'
+
+        if kind == TokenType.INTEGER:
+            value = wrap(32, int(leaf.token.value))
+            return (lambda f: value), '%i32'
+
+        if kind == TokenType.FLOAT:
+            value = float_literal(leaf.token.value)
+            return (lambda f: value), '%f32'
+
+        if kind == TokenType.STRING:
+            if leaf.token.value not in self.strings:
+                self.strings[leaf.token.value] = ctypes.create_string_buffer(leaf.token.value.encode('utf-8'))
+            value = ctypes.addressof(self.strings[leaf.token.value])
+            return (lambda f: value), '%cstr'
+
+        raise Exception('Unknown type: ' + kind.name)
+
+    def compile_variable(self, name):
+        if name in self.scope.variables:
+            slot, type, cell = self.scope.variables[name]
+            if cell is None:
+                return (lambda f: f[slot]), type
+            if cell is ListI8:
+                return (lambda f: (f[slot].length, f[slot].data or 0)), type
+            if cell is ctypes.c_void_p:
+                return (lambda f: f[slot].value or 0), type
+            return (lambda f: f[slot].value), type
+
+        if name in self.scope.args:
+            slot, type = self.scope.args[name]
+            return (lambda f: f[slot]), type
+
+        raise ProgramError('Undeclared variable: %' + name)
+
+    def compile_declare(self, node):
+        name, tnode = node.children
+        if tnode.token.kind != TokenType.IDENTIFIER or len(tnode.children) > 0:
+            return self.compile_op_declare(node)
+
+        name = name.token.value
+        type = '%' + tnode.token.value
+        if type == ANY and name in self.bound:
+            type = self.bound[name]
+        if name in self.scope.args or name in self.scope.variables:
+            raise ProgramTypeError('Duplicated variable: %' + name)
+
+        if name in [ 'left', 'right' ]:
+            self.scope.args[name] = (0 if name == 'left' else 1, type)
+            return (lambda f: None), type
+
+        slot = self.scope.slot()
+        if name not in self.scope.addressed:
+            self.scope.variables[name] = (slot, type, None)
+            def declare(f):
+                f[slot] = 0
+            return declare, type
+
+        cell = cell_type(type)
+        self.scope.variables[name] = (slot, type, cell)
+        def declare(f):
+            f[slot] = cell()
+        return declare, type
+
+    def compile_op_declare(self, node):
+        # Generics are compiled for the types of each call, see instance
+        params = generic_params(node.children[1])
+        if params is not None:
+            name = node.children[0].token.value
+            self.generics.setdefault(name, []).append(Generic(name, *params, node))
+            return (lambda f: None), '%void'
+
+        self.compile_operator(node)
+        return (lambda f: None), '%void'
+
+    def compile_operator(self, node):
+        operator = Operator('@' + node.children[0].token.value)
+
+        scope, self.scope = self.scope, Scope(operator)
+        try:
+            self.address_taken(node.children[1])
+            operator.body, operator.rtype = self.compile_tail(node.children[1])
+            name = self.scope.signature()
+        finally:
+            self.scope = scope
+
+        operator.name = name
+        self.functions[name] = operator
+        return operator
+
+    def instance(self, name, ltype, rtype):
+        """ Like Module.operation, compiles the generic defined last that accepts a call """
+        fname = name[2:-1].split(';')[1]
+        for generic in reversed(self.generics.get(fname, [])):
+            if generic.accepts(ltype, rtype):
+                bound, self.bound = self.bound, { 'left': ltype, 'right': rtype }
+                try:
+                    return self.compile_operator(generic.node)
+                finally:
+                    self.bound = bound
+
+        raise ProgramUnknownOperationError('Unknown operation: {}'.format(name))
+
+    def compile_assign(self, node):
+        name       = node.children[0].token.value
+        value, vtype = self.compile(node.children[1])
+
+        if name in self.scope.args:
+            raise ProgramTypeError('Read-only variable: %' + name)
+
+        try:
+            slot, type, cell = self.scope.variables[name]
+        except KeyError:
+            raise ProgramError('Undeclared variable: %' + name)
+
+        if cell is None:
+            def assign(f):
+                f[slot] = result = value(f)
+                return result
+        elif cell is ListI8:
+            def assign(f):
+                result = value(f)
+                f[slot].length, f[slot].data = result
+                return result
+        else:
+            def assign(f):
+                f[slot].value = result = value(f)
+                return result
+        return assign, vtype
+
+    def compile_as(self, node):
+        value, type = self.compile_variable(node.children[0].token.value)
+        if type not in FLOAT_FORMAT:
+            raise Exception('Unsupported cast {} to {}'.format(type, '%f64'))
+        return value, '%f64'
+
+    def compile_ptr_to(self, node):
+        name = node.children[1].token.value
+        try:
+            slot, type, _ = self.scope.variables[name]
+        except KeyError:
+            raise ProgramError('Undeclared variable: %' + name)
+        return (lambda f: ctypes.addressof(f[slot])), type + '.ptr'
+
+    def compile_if(self, node):
+        cond, _ = self.compile(node.children[0])
+        body, _ = self.compile(node.children[1])
+        def if_then(f):
+            if cond(f):
+                body(f)
+                return False
+            return True
+        return if_then, '%bool'
+
+    def compile_repeat(self, node):
+        if node.children[0].token.value == 'over':
+            return self.compile_over(node)
+
+        cond, _ = self.compile(node.children[0])
+        body, _ = self.compile(node.children[1])
+        def repeat(f):
+            while cond(f):
+                body(f)
+        return repeat, '%void'
+
+    def compile_over(self, node):
+        name, bounds = node.children[0].children
+        if name.token.kind != TokenType.IDENTIFIER or len(name.children) > 0 \
+        or bounds.expr_type != ExprType.LIST or len(bounds.children) != 2:
+            raise ProgramError('Expected (name over (start, end)) repeat body')
+
+        name = name.token.value
+        start, stype = self.compile(bounds.children[0])
+        end,   etype = self.compile(bounds.children[1])
+        if name in self.scope.args or name in self.scope.variables:
+            raise ProgramTypeError('Duplicated variable: %' + name)
+        if stype not in INTEGER_BITS or stype != etype:
+            raise ProgramTypeError('Unsupported range {} to {}'.format(stype, etype))
+
+        slot = self.scope.slot()
+        self.scope.args[name] = (slot, stype)
+        try:
+            body, _ = self.compile(node.children[1])
+        finally:
+            del self.scope.args[name]
+
+        def over(f):
+            for index in range(start(f), end(f)):
+                f[slot] = index
+                body(f)
+        return over, '%void'
+
+    def compile_parallel(self, node):
+        """ Parallel loops run their iterations in order, on the one thread """
+        head, body = node.children
+        token      = node.token.value
+        if head.token.value != 'over':
+            raise ProgramError('Expected (name over (start, end)) {} body'.format(token))
+
+        name, bounds = head.children
+        if name.token.kind != TokenType.IDENTIFIER or len(name.children) > 0 \
+        or bounds.expr_type != ExprType.LIST or len(bounds.children) not in [ 2, 3 ]:
+            raise ProgramError('Expected (name over (start, end[, chunk])) {} body'.format(token))
+
+        name = name.token.value
+        start, stype = self.compile(bounds.children[0])
+        end,   etype = self.compile(bounds.children[1])
+        if len(bounds.children) == 3:
+            _, ctype = self.compile(bounds.children[2])
+        else:
+            ctype = stype
+        if name in self.scope.args or name in self.scope.variables:
+            raise ProgramTypeError('Duplicated variable: %' + name)
+        if stype not in INTEGER_BITS or stype != etype or stype != ctype:
+            raise ProgramTypeError('Unsupported range {} to {}'.format(stype, etype))
+
+        slot = self.scope.slot()
+        self.scope.args[name] = (slot, stype)
+        try:
+            body, btype = self.compile(body)
+        finally:
+            del self.scope.args[name]
+
+        op = token[len('parallel'):]
+        if not op:
+            def parallel(f):
+                for index in range(start(f), end(f)):
+                    f[slot] = index
+                    body(f)
+            return parallel, '%void'
+
+        if op not in [ '+', '*' ]:
+            raise ProgramTypeError('Unsupported reduction: ' + op)
+        if btype not in INTEGER_BITS and btype not in FLOAT_FORMAT:
+            raise ProgramTypeError('Cannot reduce {} with {}'.format(btype, op))
+
+        combine, _ = BUILTINS[mangle_name(op, btype, btype)]
+        identity   = 1 if op == '*' else 0
+        if btype in FLOAT_FORMAT:
+            identity = float(identity)
+
+        def reduce(f):
+            acc = identity
+            for index in range(start(f), end(f)):
+                f[slot] = index
+                acc = combine(self, acc, body(f))
+            return acc
+        return reduce, btype
+
+    def compile_return(self, node):
+        value, type = self.compile_tail(node.children[1])
+        self.scope.operator.rtype = type
+        def return_(f):
+            raise Return(value(f))
+        return return_, type
+
+    def compile_extern(self, node):
+        name  = node.children[0].token.value
+        types = [ '%' + child.token.value for child in node.children[1].children ]
+        if name not in self.externals:
+            self.externals[name] = (types[0], types[1:])
+        return (lambda f: None), '%void'
+
+    def compile_called(self, node):
+        name = node.children[0].token.value
+        if name not in self.externals:
+            raise ProgramUnknownOperationError('Unknown external')
+
+        rtype, params = self.externals[name]
+        args  = [ self.compile(child) for child in node.children[1].children ]
+        fixed = [ param for param in params if param != '%vararg' ]
+
+        ctypes_args = []
+        for index, (_, type) in enumerate(args):
+            vararg = index >= len(fixed)
+            ctypes_args.append(_c_arg(fixed[index] if not vararg else type, vararg))
+
+        function = getattr(LIBC, name)
+        if rtype != '%void':
+            function.restype = _c_arg(rtype, False)
+        else:
+            function.restype = None
+
+        values = [ value for value, _ in args ]
+        converters = [ (lambda v, t=ctype: t(*v)) if ctype is ListI8 else ctype for ctype in ctypes_args ]
+        flush = self.flush
+        def called(f):
+            flush()
+            return function(*[ convert(value(f)) for convert, value in zip(converters, values) ])
+        return called, rtype
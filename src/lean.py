@@ -0,0 +1,41 @@
+"""
+Lean IR (--lean).
+
+The IR the generator emits is meant to be read: every helper leaves a
+comment and a blank line, instructions are indented, and operators are named
+by their mangled signature, such as @"cstr;printf;i32". None of it matters
+to llc, which still has to parse it. A lean build drops comments, blank
+lines and indentation, and renames every mangled symbol to a short one
+(@op.1, @op.2, ...) in the order they first appear. The names are written to
+a side table next to the object file, so symbols in perf, gdb or nm can be
+looked up.
+"""
+
+import re
+
+from src.debug import demangle
+
+# Mangled names are the only quoted symbols, string constants escape quotes
+MANGLED = re.compile(r'@"[^"]*"')
+
+def lean(ir_repr):
+    """ ir_repr without what only helps a reader, and {short: mangled} """
+    lines   = (line.strip() for line in ir_repr.split('\n'))
+    code    = '\n'.join(line for line in lines if line and line[0] != ';') + '\n'
+    symbols = {}
+    short   = {}
+
+    def rename(match):
+        name = match.group(0)
+        if name not in short:
+            short[name] = '@op.{}'.format(len(short) + 1)
+            symbols[short[name]] = name
+        return short[name]
+
+    return MANGLED.sub(rename, code), symbols
+
+def write_symbols(path, symbols):
+    """ One symbol per line: short name, mangled name, operator as written """
+    with open(path, 'w') as f:
+        for name, mangled in symbols.items():
+            f.write('{}\t{}\t{}\n'.format(name[1:], mangled[1:].strip('"'), demangle(mangled)))
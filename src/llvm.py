@@ -2,8 +2,16 @@ from __future__  import annotations
 
 import struct
 
-from dataclasses import dataclass
-from inspect     import getmembers, isfunction
+from contextlib  import contextmanager
+from dataclasses import dataclass, field
+
+# Instructions in a function body below which it is always inlined, or
+# suggested for inlining
+INLINE_ALWAYS = 8
+INLINE_HINT   = 32
+
+# Alignment of the types that are not 8 bytes wide, for struct layouts
+ALIGNMENTS = { '%bool': 1, '%i8': 1, '%i16': 2, '%f16': 2, '%i32': 4, '%f32': 4 }
 
 class LLVMError(Exception):
     pass
@@ -24,23 +32,29 @@ class CommentContext:
         self.llvm.line('')
 
 class DefineContext:
-    def __init__(self, llvm, internal, rtype, name, *args, **kwargs):
-        self.llvm     = llvm
-        self.rtype    = rtype
-        self.name     = name
-        self.internal = internal
-        self.args     = args
+    def __init__(self, llvm, internal, rtype, name, *args, attributes=(), scope=None, count=None):
+        self.llvm       = llvm
+        self.rtype      = rtype
+        self.name       = name
+        self.internal   = internal
+        self.args       = args
+        self.attributes = attributes
+        self.scope      = scope
+        self.count      = count
 
 
     def __enter__(self):
         args = ''
         for i in range(0, len(self.args), 2):
             args += self.args[i] + ' ' + self.args[i+1] + ', '
-        self.llvm.line('define {} {} {}({})', 
+        self.llvm.line('define {} {} {}({}){}{}{}', 
             'internal' if self.internal else 'external',
             self.rtype,
             self.name,
-            args[:-2]
+            args[:-2],
+            ''.join(' ' + attribute for attribute in self.attributes),
+            '' if self.scope is None else ' !dbg ' + self.scope,
+            '' if self.count is None else ' !prof !{{!"function_entry_count", i64 {}}}'.format(self.count)
         )
         self.llvm.line('{')
 
@@ -53,6 +67,15 @@ class LLVM:
         self.last_lbl = 0
         self.code     = ''
 
+        # What the code touches, for attribute inference
+        self.locals   = set()
+        self.loads    = set()
+        self.stores   = set()
+        self.callees  = set()
+
+        # Debug location instructions are tagged with (-g)
+        self.location = None
+
     def line(self, line, *args):
         if len(args) > 0:
             self.code += line.format(*args) + '\n'
@@ -75,20 +98,25 @@ class LLVM:
     def type(self, name, llvm_type):
         self.line('{} = type {}', name, llvm_type)
 
-    def global_variable(self, name, vtype, value=None):
+    def global_variable(self, name, vtype, value=None, constant=True, thread_local=False):
+        kind = 'constant' if constant else 'global'
+        if thread_local:
+            kind = 'thread_local ' + kind
         if value is None:
-            self.line('{} = constant {}', name, vtype)
+            self.line('{} = external {} {}', name, kind, vtype)
         else:
-            self.line('{} = constant {} {}', name, vtype, value)
+            self.line('{} = internal {} {} {}', name, kind, vtype, value)
 
     def declare(self, name, rtype, *args):
         argptrn = ', '.join([ '{}' for _ in args ])
         self.line('declare {} {}(' + argptrn + ')', rtype, name, *args)
 
-    def define(self, internal, name, rtype, *args):
-        return DefineContext(self, internal, rtype, name, *args)
+    def define(self, internal, name, rtype, *args, attributes=(), scope=None, count=None):
+        return DefineContext(self, internal, rtype, name, *args, attributes=attributes, scope=scope, count=count)
 
     def instr(self, instruction, *args):
+        if self.location is not None:
+            instruction += ', !dbg ' + self.location
         self.line(4 * ' ' + instruction, *args)
 
     def next_reg(self):
@@ -99,18 +127,25 @@ class LLVM:
         if reg is None:
             reg = self.next_reg()
         self.instr('{} = alloca {}', reg, type)
+        self.locals.add(reg)
         return reg
 
-    def malloc(self, type, elems=None):
+    def entry_alloca(self, type, elems=1):
+        """ alloca at the top of the entry block, so a loop reuses the same slot """
         reg = self.next_reg()
-        if elems is None:
-            self.instr('{} = malloc {}', reg, type)
-        else:
-            self.instr('{} = malloc {}, i64 {}', reg, type, elems)
+        self.code = '    {} = alloca {}, i64 {}\n'.format(reg, type, elems) + self.code
+        self.locals.add(reg)
         return reg
 
+    def malloc(self, type, elems=1):
+        """ Room for elems values of type, from @malloc, which must be declared """
+        size = 'ptrtoint ({t}* getelementptr ({t}, {t}* null, i64 {}) to i64)'.format(elems, t=type)
+        raw  = self.call('i8*', '@malloc', 'i64', size)
+        return self.bitcast('i8*', type + '*', raw)
+
     def free(self, type, reg):
-        self.instr('free {} {}', type, reg)
+        raw = self.bitcast(type + '*', 'i8*', reg)
+        self.call('void', '@free', 'i8*', raw)
         return reg
 
     def get_element_ptr(self, rtype, ptype, pname, *args):
@@ -119,29 +154,101 @@ class LLVM:
         self.instr(instr, reg, rtype, ptype, pname, *args)
         return reg
 
+    def extract_value(self, stype, value, index):
+        reg = self.next_reg()
+        self.instr('{} = extractvalue {} {}, {}', reg, stype, value, index)
+        return reg
+
+    def insert_value(self, stype, value, etype, element, index):
+        reg = self.next_reg()
+        self.instr('{} = insertvalue {} {}, {} {}, {}', reg, stype, value, etype, element, index)
+        return reg
+
     def load(self, store_type, value_type, value):
         reg = self.next_reg()
         self.instr('{} = load {}, {} {}', reg, store_type, value_type, value)
+        self.loads.add(value)
         return reg
 
     def store(self, rtype, rname, ptype, pname):
         self.instr('store {} {}, {} {}', rtype, rname, ptype, pname)
+        self.stores.add(pname)
 
     def fpext(self, from_type, to_type, value):
         reg = self.next_reg()
         self.instr('{} = fpext {} {} to {}', reg, from_type, value, to_type)
         return reg
 
-    def call(self, ftype, fname, *args):
+    def fptrunc(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = fptrunc {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def sext(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = sext {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def zext(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = zext {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def trunc(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = trunc {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def ptrtoint(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = ptrtoint {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def inttoptr(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = inttoptr {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def bitcast(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = bitcast {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def fptoui(self, from_type, to_type, value):
+        reg = self.next_reg()
+        self.instr('{} = fptoui {} {} to {}', reg, from_type, value, to_type)
+        return reg
+
+    def atomic_add(self, rtype, ptr, value):
+        reg = self.next_reg()
+        self.instr('{} = atomicrmw add {}* {}, {} {} seq_cst', reg, rtype, ptr, rtype, value)
+        self.stores.add(ptr)
+        return reg
+
+    def select(self, cdreg, rtype, a, b):
+        reg = self.next_reg()
+        self.instr('{} = select i1 {}, {} {}, {} {}', reg, cdreg, rtype, a, rtype, b)
+        return reg
+
+    def phi(self, rtype, *incoming, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        pairs = ', '.join([ '[ {}, %{} ]' for _ in range(0, len(incoming), 2) ])
+        self.instr('{} = phi {} ' + pairs, reg, rtype, *incoming)
+        return reg
+
+    def call(self, ftype, fname, *args, tail=None):
         argptrn = ', '.join([ '{} {}' for _ in range(0, len(args), 2) ])
+        call    = 'call' if tail is None else tail + ' call'
+        self.callees.add(fname)
 
         if ftype != 'void':
             reg     = self.next_reg()
-            instr   = '{} = call {} {}(' + argptrn + ')'
+            instr   = '{} = ' + call + ' {} {}(' + argptrn + ')'
             self.instr(instr, reg, ftype, fname, *args)
             return reg
         else:
-            instr   = 'call {} {}(' + argptrn + ')'
+            instr   = call + ' {} {}(' + argptrn + ')'
             self.instr(instr, ftype, fname, *args)
             return None
 
@@ -151,8 +258,11 @@ class LLVM:
         else:
             self.instr('ret {} {}'.format(type, reg))
 
-    def br_if_else(self, cdreg, tlabel, flabel):
-        self.instr('br i1 {}, label %{}, label %{}', cdreg, tlabel, flabel)
+    def br_if_else(self, cdreg, tlabel, flabel, weights=None):
+        if weights is None:
+            self.instr('br i1 {}, label %{}, label %{}', cdreg, tlabel, flabel)
+        else:
+            self.instr('br i1 {}, label %{}, label %{}, !prof {}', cdreg, tlabel, flabel, weights)
 
     def br(self, label):
         self.instr('br label %{}', label)
@@ -160,77 +270,159 @@ class LLVM:
     def label(self, name):
         self.line(name + ':')
 
+    def switch(self, rtype, value, default, *cases, weights=None):
+        args = []
+        for index in range(0, len(cases), 2):
+            args += [ rtype, cases[index], cases[index + 1] ]
+
+        pairs = ' '.join([ '{} {}, label %{}' for _ in range(0, len(cases), 2) ])
+        if weights is None:
+            self.instr('switch {} {}, label %{} [ ' + pairs + ' ]', rtype, value, default, *args)
+        else:
+            self.instr('switch {} {}, label %{} [ ' + pairs + ' ], !prof {}', rtype, value, default, *args, weights)
+
     def icmp(self, op, rtype, a, b):
         reg = self.next_reg()
         self.instr('{} = icmp {} {} {}, {}', reg, op, rtype, a, b)
         return reg
 
-    def add(self, rtype, a, b):
+    def fcmp(self, op, rtype, a, b):
         reg = self.next_reg()
+        self.instr('{} = fcmp {} {} {}, {}', reg, op, rtype, a, b)
+        return reg
+
+    def add(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = add {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def fadd(self, rtype, a, b):
-        reg = self.next_reg()
+    def fadd(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = fadd {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def sub(self, rtype, a, b):
-        reg = self.next_reg()
+    def sub(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = sub {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def fsub(self, rtype, a, b):
-        reg = self.next_reg()
+    def fsub(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = fsub {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def mul(self, rtype, a, b):
-        reg = self.next_reg()
+    def mul(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = mul {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def fmul(self, rtype, a, b):
-        reg = self.next_reg()
+    def fmul(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = fmul {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def sdiv(self, rtype, a, b):
-        reg = self.next_reg()
+    def sdiv(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = sdiv {} {}, {}', reg, rtype, a, b)
         return reg
 
-    def fdiv(self, rtype, a, b):
-        reg = self.next_reg()
+    def fdiv(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
         self.instr('{} = fdiv {} {}, {}', reg, rtype, a, b)
         return reg
 
+    def udiv(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = udiv {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def or_(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = or {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def and_(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = and {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def xor(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = xor {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def lshr(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = lshr {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def srem(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = srem {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def frem(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = frem {} {}, {}', reg, rtype, a, b)
+        return reg
+
+    def urem(self, rtype, a, b, reg=None):
+        if reg is None:
+            reg = self.next_reg()
+        self.instr('{} = urem {} {}, {}', reg, rtype, a, b)
+        return reg
+
 
 class ProgramError(Exception):
     pass
 
+def mangle_name(fname, ltype, rtype):
+    if len(fname) > 1:
+        fname = fname.replace('"', '\\"').replace('%', '').replace('@', '')
+    ltype = ltype.replace('"', '\\"').replace('%', '').replace('@', '')
+    rtype = rtype.replace('"', '\\"').replace('%', '').replace('@', '')
+    return '@"{};{};{}"'.format(ltype, fname, rtype)
+
 class ProgramTypeError(ProgramError):
     pass
 
 class ProgramUnknownOperationError(ProgramError):
     pass
 
-@dataclass
+# Compared by identity: a module has one Type per name, see Types
+@dataclass(eq=False)
 class Type:
     name:      str
     repr:      str
-    primitive: bool = False
+    primitive: bool  = False
+    derived:   dict  = field(default_factory=dict, repr=False) # Types built from this one
+    fields:    tuple = field(default=None, repr=False)         # Of a struct, in the order written
+    layout:    tuple = field(default=None, repr=False)         # LLVM index of each field
 
     def __post_init__(self):
         if self.name[0] != '%':
             raise LLVMTypeError('Type names MUST start with %')
 
-    def ptr(self):
-        return Type(
-            self.name + '.ptr',
-            self.repr + '*',
-            primitive=True
-        )
+    def __getstate__(self):
+        # Derived types belong to the module, and are found again by name
+        state = dict(self.__dict__)
+        state['derived'] = {}
+        return state
 
     def to_llvm_ir(self):
         if self.primitive:
@@ -239,12 +431,113 @@ class Type:
             return self.name
 
 
+class Types(dict):
+    """
+    The types of a module by name. Each name is made into a Type once, and
+    the pointer, list and array types built from a type are remembered on it,
+    so checks compare Types with is instead of their names or fields. Structs
+    are named after the types of their fields and how many there are.
+    """
+    def intern(self, name, repr, primitive=False):
+        try:
+            if self[name].repr != repr:
+                raise ProgramTypeError('Two types named {}: {} and {}'.format(name[1:], self[name].repr, repr))
+            return self[name]
+        except KeyError:
+            self[name] = Type(name=name, repr=repr, primitive=primitive)
+            return self[name]
+
+    def derive(self, base, key, name, repr, primitive=False):
+        try:
+            return base.derived[key]
+        except KeyError:
+            base.derived[key] = self.intern(name, repr, primitive)
+            return base.derived[key]
+
+    def ptr(self, type):
+        # Named struct types differ from their layout, so those are pointed to by name
+        repr = type.to_llvm_ir() if type.repr.startswith('{') else type.repr
+        return self.derive(type, 'ptr', type.name + '.ptr', repr + '*', primitive=True)
+
+    def list(self, type):
+        # Length and elements
+        return self.derive(type, 'list', '%list.' + type.name[1:], '{{ i64, {}* }}'.format(type.to_llvm_ir()))
+
+    def struct(self, fields):
+        # Fields by decreasing alignment, which leaves padding only at the end
+        name  = '%struct.{}.{}'.format('.'.join(ftype.name[1:] for ftype in fields), len(fields))
+        order = sorted(range(len(fields)), key=lambda index: -self.align(fields[index]))
+        stype = self.intern(name, '{{ {} }}'.format(', '.join(fields[index].to_llvm_ir() for index in order)))
+        if stype.fields is None:
+            stype.fields = tuple(fields)
+            stype.layout = tuple(order.index(index) for index in range(len(fields)))
+        return stype
+
+    def named(self, name):
+        """ The struct, list or pointer type written as name, made from the types it names """
+        for shape, rest in self.shapes(name[1:]):
+            if rest is None:
+                return self.build(shape)
+        return None
+
+    def shapes(self, text):
+        """ Every way to read a type from the start of text, and what follows its dot """
+        def after(length):
+            return None if length == len(text) else text[length + 1:]
+
+        found = []
+        for name in self:
+            if not name.startswith('%struct.') and (text == name[1:] or text.startswith(name[1:] + '.')):
+                found.append((name, after(len(name) - 1)))
+
+        if text.startswith('list.'):
+            found += [ (('list', shape), rest) for shape, rest in self.shapes(text[5:]) ]
+
+        # The number of fields closes a struct
+        fields = [ ([], text[7:]) ] if text.startswith('struct.') else []
+        while fields:
+            fields = [ (shapes + [ shape ], rest) for shapes, text in fields if text is not None
+                                                  for shape, rest in self.shapes(text) ]
+            for shapes, rest in fields:
+                count = str(len(shapes))
+                if rest == count or (rest or '').startswith(count + '.'):
+                    found.append((('struct', shapes), None if rest == count else rest[len(count) + 1:]))
+
+        # Pointers follow what they point to
+        for shape, rest in list(found):
+            if rest is not None and (rest == 'ptr' or rest.startswith('ptr.')):
+                found.append((('ptr', shape), None if rest == 'ptr' else rest[4:]))
+        return found
+
+    def build(self, shape):
+        if isinstance(shape, str):
+            return self[shape]
+        if shape[0] == 'list':
+            return self.list(self.build(shape[1]))
+        if shape[0] == 'ptr':
+            return self.ptr(self.build(shape[1]))
+        return self.struct([ self.build(field) for field in shape[1] ])
+
+    def align(self, type):
+        if type.fields is not None:
+            return max(self.align(ftype) for ftype in type.fields)
+        return ALIGNMENTS.get(type.name, 8)
+
+    def array(self, type, size):
+        # Arrays of i8 hold the data of cstr constants
+        name = '%cstr.{}'.format(size) if type.name == '%i8' else '{}.{}'.format(type.name, size)
+        return self.derive(type, ('array', size), name, '[ {} x {} ]'.format(size, type.to_llvm_ir()))
+
+
 @dataclass
 class Variable:
     name:     str  = None
     type:     Type = None
     value:    str  = None
     implicit: bool = False
+    constant: bool = True
+    nonnull:  bool = False
+    thread_local: bool = False
 
     def __post_init__(self):
         if type is None:
@@ -276,6 +569,11 @@ class Function:
     variables: Dict[Variable] = None
     internal:  bool           = False
     used:      bool           = False
+    calls:     Set[str]       = None
+    nonnull:   Dict[bool]     = None
+    scope:     str            = None  # DISubprogram, with -g
+    count:     int            = None  # Calls in the training runs, with --pgo-use
+    outlined:  int            = 0     # Parallel loop bodies taken out of it
 
     def __post_init__(self):
         if self.name[0] != '@':
@@ -290,6 +588,12 @@ class Function:
         if self.variables is None:
             self.variables = {}
 
+        if self.calls is None:
+            self.calls = set()
+
+        if self.nonnull is None:
+            self.nonnull = {}
+
     def __str__(self):
         return repr(self)
 
@@ -297,6 +601,26 @@ class Function:
         return self.name + ' -> ' + self.rtype.name
 
 
+# Argument type of generic operators, which match any type but void
+ANY = '%any'
+
+@dataclass
+class Generic:
+    """
+    An operator whose left or right is any. It is generated again for the
+    types of each call, the first time it is called with them, see
+    Module.operation
+    """
+    name:        str            # As written, without @
+    left:        str            # Type name, ANY, or %void without left
+    right:       str
+    node:        object = None  # The definition, name is body
+    instantiate: object = None  # (generic, ltype, rtype) to the generated Function
+
+    def accepts(self, ltype, rtype):
+        return all(param == atype or (param == ANY and atype != '%void')
+                   for param, atype in [ (self.left, ltype), (self.right, rtype) ])
+
 @dataclass
 class External:
     name:  str
@@ -310,16 +634,21 @@ class External:
 @dataclass
 class Module:
     llvm:      LLVM           = None
-    types:     Dict[Type]     = None
+    types:     Types          = None
     variables: Dict[Variable] = None
     externals: Dict[External] = None
     functions: Dict[Function] = None
-
-    current = None
+    debug:     Debug          = None
+    profile:   Profile        = None
+    pgo:       Sites          = None
 
     def __post_init__(self):
+        # The function code is being generated into. Everything a compilation
+        # touches hangs off its Module, so modules can be built side by side
+        self.current = None
+
         if self.llvm      is None: self.llvm      = LLVM()
-        if self.types     is None: self.types     = {}
+        if self.types     is None: self.types     = Types()
         if self.variables is None: self.variables = {}
         if self.externals is None: self.externals = {}
         if self.functions is None: self.functions = {}
@@ -346,8 +675,15 @@ class Module:
         self.new_type('%vararg', '...',  primitive=True) # vararg for externs
         self.new_type('%cstr',     'i8*')
         self.new_type('%cstr.ptr', 'i8**')
-        self.new_type('%list.i8',  '{ i64, i8* }')
-        self.new_type('%list.i32',  '{ i64, i8* }')
+        for name in [ 'bool', 'i8', 'i16', 'i32', 'i64', 'f16', 'f32', 'f64' ]:
+            self.types.ptr(self.types['%' + name])
+        self.types.list(self.types['%i8'])
+        self.new_type('%str',      '{ i64, i8* }')           # length, NUL terminated data
+        self.new_type('%str.buf',  '{ i64, i64, i8* }')      # length, capacity, data
+        self.new_type('%str.builder', '%str.buf*')
+        self.new_type('%map.head', '{ i64, i64, i64, i8* }') # live keys, used slots, mask, slots
+        for key in [ 'i32', 'i64', 'cstr' ]:
+            self.new_type('%map.' + key, '%map.head*')
 
     def default_variables(self):
         self.const_cstr('%s\n')
@@ -355,11 +691,10 @@ class Module:
     def default_operations(self):
         import src.builtin # to avoid circular import
 
-        for name, fn in getmembers(src.builtin, isfunction):
-            if name[0] == '_':
-                continue
-            fn_def = fn(self)
-            self.functions[fn_def.name] = fn_def
+        # Generated the first time they are called, see operation()
+        self.builtins = src.builtin.BUILTINS
+        self.family   = src.builtin.family
+        self.generics = {}
 
         self.functions['@main'] = Function(
             name = '@main',
@@ -372,25 +707,38 @@ class Module:
         )
 
         self.current = self.functions['@main']
+        self.flush_at_exit()
+
+    def flush_at_exit(self):
+        """ Buffered output is flushed at exit, however main ends """
+        main = self.current
+        if self.debug is not None:
+            main.llvm.location = self.debug.entry(main)
+
+        self.add_external('@atexit', '%i32', [ '%ptr' ])
+        main.calls.add(self.operation('@out.flush').name)
+        main.llvm.call('i32', '@atexit', 'i8*', 'bitcast (void ()* @out.flush to i8*)')
+        main.llvm.location = None
 
     def new_type(self, name, repr, primitive=False):
-        if name not in self.types:
-            self.types[name] = Type(name=name, repr=repr, primitive=primitive)
-        else:
+        if name in self.types:
             raise ProgramTypeError('Duplicated type: ' + name)
-        return self.types[name]
+        return self.types.intern(name, repr, primitive)
 
     def type(self, name, repr=None, primitive=False):
         try:
             return self.types[name]
         except KeyError:
+            named = self.types.named(name) if repr is None else None
+            if named is not None:
+                return named
             if repr is None:
                 raise ProgramTypeError('Undeclared type: ' + name)
             return self.new_type(name, repr, primitive)
 
-    def new_global_var(self, name, type, value):
+    def new_global_var(self, name, type, value, constant=True, thread_local=False):
         if name not in self.variables:
-            self.variables[name] = Variable(name=name, type=type, value=value)
+            self.variables[name] = Variable(name=name, type=type, value=value, constant=constant, thread_local=thread_local)
         else:
             raise ProgramTypeError('Duplicated variable: ' + name)
         return self.variables[name]
@@ -419,7 +767,7 @@ class Module:
             # Try to find a local-scope variable
             try:                            
                 reg = self.current.variables[name]
-                return Variable(reg.name, reg.type.ptr())
+                return Variable(reg.name, self.types.ptr(reg.type), nonnull=True)
             except KeyError:
                 raise
 
@@ -446,6 +794,13 @@ class Module:
             # Finally, try a global-scope variable or fail
             return self.global_var(name)
 
+    def variable_type(self, name):
+        """ Type of what variable(name) gives, without loading it """
+        for scope in [ self.current.variables, self.current.args ]:
+            if name in scope:
+                return scope[name].type
+        return self.global_var(name).type
+
     def add_external(self, name, rtype, args):
         if name in self.externals:
             return
@@ -470,6 +825,11 @@ class Module:
         if any(arg.name == '%vararg' for arg in external.args):
             extype += '(' + ', '.join(arg.to_llvm_ir() for arg in external.args) + ')'
 
+        # Buffered output goes out first, so it comes before what the C library writes
+        self.operation('@out.flush')
+        self.current.calls.add('@out.flush')
+        self.current.llvm.call('void', '@out.flush')
+
         ret = self.current.llvm.call(extype, name, *a)
         return Variable(ret, external.rtype)
 
@@ -510,6 +870,9 @@ class Module:
 
     def assign(self, pname, reg):
         with self.current.llvm.commented_block('{} = {}', pname, reg):
+            if pname in self.current.args:
+                raise ProgramTypeError('Read-only variable: ' + pname)
+
             self.current.llvm.store(
                 reg.type.to_llvm_ir(),       reg.name,
                 reg.type.to_llvm_ir() + '*', pname,
@@ -561,11 +924,10 @@ class Module:
 
     def const_cstr(self, value):
         size  = len(value) + 1 # + \0
-        value = value.replace('\n', '\\0A')
+        value = value.replace('\\', '\\5C').replace('"', '\\22').replace('\n', '\\0A')
 
         with self.current.llvm.commented_block('string "{}"', value):
-            tname = '%cstr.{}'.format(size)
-            stype = self.type(tname, '[ {} x i8 ]'.format(size))
+            stype = self.types.array(self.types['%i8'], size)
 
             ptr = self.const(stype, 'c"{}\\00"'.format(value))
             reg = self.current.llvm.get_element_ptr(
@@ -574,57 +936,197 @@ class Module:
                 ptr.name,
                 'i64', 0, 'i64', 0
             )
-            return Variable(name=reg, type=self.type('%cstr'))
-
-    def new_list(self, values):
-        type = values[0].type if len(values) > 0 else self.type('%i8')
-
-        with self.current.llvm.commented_block('list of {} {}s', len(values), type.name):
-            tname = '%list.{}'.format(type.name.replace('%', ''))
-            stype = self.type(tname, '[ i64, i64, {}* ]'.format(type.to_llvm_ir()))
-
-            lst = self.const(stype, '[ i64 {len}, i64 {len}, {type}* null ]'.format(len=len(values), type=type.to_llvm_ir()))
-            ptr = self.current.llvm.malloc(type.to_llvm_ir, len(values))
-            return lst
-
-    def new_struct(self, value):
-        return Variable(type=self.type('%void'))
+            return Variable(name=reg, type=self.type('%cstr'), nonnull=True)
+
+    def const_str(self, value):
+        """ str of a literal, whose length is known here """
+        data = self.const_cstr(value)
+        with self.current.llvm.commented_block('str of {}', data.name):
+            stype = self.type('%str').to_llvm_ir()
+            reg   = self.current.llvm.insert_value(stype, 'undef', 'i64', len(value), 0)
+            reg   = self.current.llvm.insert_value(stype, reg, 'i8*', data.name, 1)
+            return Variable(name=reg, type=self.type('%str'))
+
+    def new_list(self, values, stack=False):
+        """ List of values, in the frame of the current function with stack, else on the heap """
+        type  = values[0].type if len(values) > 0 else self.types['%i8']
+        ltype = self.types.list(type)
+        llvm  = self.current.llvm
+
+        with llvm.commented_block('list of {} {}s', len(values), type.name):
+            etype = type.to_llvm_ir()
+            data  = 'null'
+            if len(values) > 0 and stack:
+                data = llvm.entry_alloca(etype, len(values))
+            elif len(values) > 0:
+                self.add_external('@malloc', '%ptr', [ '%i64' ])
+                data = llvm.malloc(etype, len(values))
+
+            for index, value in enumerate(values):
+                ptr = llvm.get_element_ptr(etype, etype + '*', data, 'i64', index)
+                if stack:
+                    llvm.locals.add(ptr)
+                llvm.store(etype, value.name, etype + '*', ptr)
+
+            reg = llvm.insert_value(ltype.to_llvm_ir(), 'undef', 'i64', len(values), 0)
+            reg = llvm.insert_value(ltype.to_llvm_ir(), reg, etype + '*', data, 1)
+            return Variable(name=reg, type=ltype)
+
+    def new_struct(self, values):
+        """ Struct of values, held by value like scalars """
+        stype = self.types.struct([ value.type for value in values ])
+        llvm  = self.current.llvm
+
+        with llvm.commented_block('struct of {} fields', len(values)):
+            reg = 'undef'
+            for index, value in enumerate(values):
+                reg = llvm.insert_value(stype.to_llvm_ir(), reg, value.type.to_llvm_ir(), value.name, stype.layout[index])
+            return Variable(name=reg, type=stype)
+
+    def field(self, value, index):
+        """ Field index of the struct in value, counted in the order written """
+        stype = value.type
+        if not 0 <= index < len(stype.fields):
+            raise ProgramTypeError('No field {} in {}'.format(index, stype.name[1:]))
+
+        reg = self.current.llvm.extract_value(stype.to_llvm_ir(), value.name, stype.layout[index])
+        return Variable(name=reg, type=stype.fields[index])
 
     def mangle_name(self, fname, ltype, rtype):
-        if len(fname) > 1:
-            fname = fname.replace('"', '\\"').replace('%', '').replace('@', '')
-        ltype = ltype.replace('"', '\\"').replace('%', '').replace('@', '')
-        rtype = rtype.replace('"', '\\"').replace('%', '').replace('@', '')
-        return '@"{};{};{}"'.format(ltype, fname, rtype)
+        return mangle_name(fname, ltype, rtype)
 
-    def call(self, fname, larg=None, rarg=None):
+    def call(self, fname, larg=None, rarg=None, tail=False):
         args  = []
+        void  = self.types['%void']
         ltype = '%void'
-        if larg is not None and larg.type.name != '%void':
+        if larg is not None and larg.type is not void:
             ltype = larg.type.name
             args.append(larg.type.to_llvm_ir())
             args.append(larg.name)
 
         rtype = '%void'
-        if rarg is not None and rarg.type.name != '%void':
+        if rarg is not None and rarg.type is not void:
             rtype = rarg.type.name
             args.append(rarg.type.to_llvm_ir())
             args.append(rarg.name)
 
         call_name = self.mangle_name(fname, ltype, rtype)
 
-        try:
-            func = self.functions[call_name]
-            func.used = True
-        except:
-            raise ProgramUnknownOperationError('Unknown operation: {}'.format(call_name))
+        # Recursion into the operator being defined, which is only
+        # registered once it is complete
+        if self.current.name not in self.functions and self.signature(self.current) == call_name:
+            func = self.current
+        else:
+            func = self.operation(call_name)
+
+        self.current.calls.add(call_name)
+
+        # Pointer arguments are nonnull if they are at every call
+        for aname, arg in [ ('%left', larg), ('%right', rarg) ]:
+            if aname in func.args:
+                func.nonnull[aname] = func.nonnull.get(aname, True) and arg.nonnull
+
+        # Tail calls must not see the caller's stack, so nothing that may
+        # point into it can be passed along
+        kind = None
+        if tail and not any(self.may_point_to_frame(arg.type) for arg in [ larg, rarg ] if arg is not None):
+            kind = 'musttail' if func is self.current else 'tail'
+            if self.profile is not None:
+                self.profile.tail(self, self.current)
 
         with self.current.llvm.commented_block(call_name):
-            reg = self.current.llvm.call(func.rtype.to_llvm_ir(), call_name, *args)
+            reg = self.current.llvm.call(func.rtype.to_llvm_ir(), call_name, *args, tail=kind)
             return Variable(name=reg, type=func.rtype)
 
+    def may_point_to_frame(self, type):
+        """ Pointers to variables and lists, whose elements may be on the stack """
+        if type.fields is not None:
+            return any(self.may_point_to_frame(ftype) for ftype in type.fields)
+        return type.name.endswith('.ptr') or type.name.startswith('%list.')
+
+    def signature(self, function, name=None):
+        try:
+            ltype = function.args['%left'].type.name
+        except KeyError:
+            ltype = '%void'
+
+        try:
+            rtype = function.args['%right'].type.name
+        except KeyError:
+            rtype = '%void'
+
+        return self.mangle_name(name or function.name, ltype, rtype)
+
+    def operation(self, name):
+        try:
+            return self.functions[name]
+        except KeyError:
+            pass
+
+        try:
+            factory = self.builtins[name]
+        except KeyError:
+            factory = self.family(self, name)
+        if factory is None:
+            return self.instance(name)
+
+        self.functions[name] = factory(self)
+        return self.functions[name]
+
+    def generic(self, generic):
+        self.generics.setdefault(generic.name, []).append(generic)
+
+    def template(self, fname, ltype, rtype):
+        """ The generic fname defined last that accepts the types of a call """
+        for generic in reversed(self.generics.get(fname, [])):
+            if generic.accepts(ltype, rtype):
+                return generic
+        return None
+
+    def instance(self, name):
+        """ Generates the generic operator a mangled name asks for """
+        parts = name[2:-1].split(';') if name.startswith('@"') else []
+        if len(parts) == 3:
+            ltype, fname, rtype = '%' + parts[0], parts[1], '%' + parts[2]
+            generic = self.template(fname, ltype, rtype)
+            if generic is not None and ltype in self.types and rtype in self.types:
+                self.functions[name] = generic.instantiate(generic, self.types[ltype], self.types[rtype])
+                return self.functions[name]
+
+        raise ProgramUnknownOperationError('Unknown operation: {}'.format(name))
+
+    @contextmanager
+    def located(self, token):
+        """ Tags what the block generates with the position of token, with -g """
+        if self.debug is None:
+            yield
+            return
+
+        function = self.current
+        previous = function.llvm.location
+        function.llvm.location = self.debug.location(function, token)
+        try:
+            yield
+        finally:
+            function.llvm.location = previous
+
+    @contextmanager
+    def within(self, function):
+        """ Generates into function until the block ends, however it ends """
+        previous, self.current = self.current, function
+        try:
+            yield function
+        finally:
+            self.current = previous
+
     def ret(self, reg):
-        if reg.type.name == '%void':
+        if self.signature(self.current) in self.current.calls and reg.type is not self.current.rtype:
+            raise ProgramTypeError('Recursive operation {} must return its base case first'.format(self.current.name))
+
+        if self.profile is not None:
+            self.profile.leave(self, self.current)
+
+        if reg.type is self.types['%void']:
             self.current.rtype = reg.type
             self.current.llvm.ret(reg.type.to_llvm_ir())
         else:
@@ -646,23 +1148,15 @@ class Module:
             def __enter__(self):
                 self.previous       = self.module.current
                 self.module.current = self.function
+                if self.module.profile is not None:
+                    self.module.profile.enter(self.module, self.function)
+                if self.module.pgo is not None:
+                    self.module.pgo.entry(self.module, self.function)
                 return self
 
             def __exit__(self, *_):
-                try:
-                    left = self.function.args['%left']
-                except KeyError: 
-                    left = Variable(type=self.module.type('%void'))
-
-                try:
-                    right = self.function.args['%right']
-                except KeyError: 
-                    right = Variable(type=self.module.type('%void'))
-
-                self.function.name = self.module.mangle_name(
-                    self.name, left.type.name, right.type.name
-                )
-    
+                self.function.name = self.module.signature(self.function, self.name)
+
                 self.module.functions[self.function.name] = self.function
                 self.module.current = self.previous
 
@@ -670,15 +1164,19 @@ class Module:
 
     def if_then(self, cond):
         class IfThen:
-            def __init__(self, llvm, cond):
-                self.llvm = llvm
-                self.cond = cond
-                self.tlbl = llvm.next_lbl()
-                self.flbl = llvm.next_lbl()
+            def __init__(self, module, cond):
+                self.module = module
+                self.llvm   = module.current.llvm
+                self.cond   = cond
+                self.tlbl   = self.llvm.next_lbl()
+                self.flbl   = self.llvm.next_lbl()
 
             def __enter__(self):
                 self.llvm.comment('if')
-                self.llvm.br_if_else(self.cond.name, self.tlbl, self.flbl)
+                weights = None
+                if self.module.pgo is not None:
+                    weights = self.module.pgo.branch(self.module, self.cond.name)
+                self.llvm.br_if_else(self.cond.name, self.tlbl, self.flbl, weights)
                 self.llvm.label(self.tlbl)
                 return self
 
@@ -687,19 +1185,23 @@ class Module:
                 self.llvm.label(self.flbl)
                 self.llvm.line('')
 
-        return IfThen(self.current.llvm, cond)
+        return IfThen(self, cond)
 
-    def loop(self):
+    def loop(self, token=None):
         class Loop:
-            def __init__(self, llvm):
-                self.llvm = llvm
-                self.slbl = llvm.next_lbl()
-                self.elbl = llvm.next_lbl()
+            def __init__(self, module, token):
+                self.module = module
+                self.token  = token
+                self.llvm   = module.current.llvm
+                self.slbl   = self.llvm.next_lbl()
+                self.elbl   = self.llvm.next_lbl()
 
             def __enter__(self):
                 self.llvm.comment('repeat')
                 self.llvm.br(self.slbl)
                 self.llvm.label(self.slbl)
+                if self.module.profile is not None:
+                    self.module.profile.loop(self.module, self.token)
                 return self
 
             def __exit__(self, *_):
@@ -710,13 +1212,434 @@ class Module:
             def end(self):
                 self.llvm.br(self.elbl)
 
-        return Loop(self.current.llvm)
+        return Loop(self, token)
+
+    def switch(self, value, constants):
+        class Switch:
+            def __init__(self, module, value, constants):
+                self.module    = module
+                self.llvm      = module.current.llvm
+                self.value     = value
+                self.constants = constants
+                self.clbls     = [ self.llvm.next_lbl() for _ in constants ]
+                self.dlbl      = self.llvm.next_lbl()
+                self.elbl      = self.llvm.next_lbl()
+                self.defaulted = False
+
+            def __enter__(self):
+                cases = []
+                for constant, label in zip(self.constants, self.clbls):
+                    cases += [ constant, label ]
+
+                # Counters of the default, then of every case
+                self.first, weights = None, None
+                if self.module.pgo is not None:
+                    self.first, weights = self.module.pgo.switch(self.module, len(self.constants))
+
+                self.llvm.comment('switch')
+                self.llvm.switch(self.value.type.to_llvm_ir(), self.value.name, self.dlbl, *cases, weights=weights)
+                return self
+
+            def __exit__(self, *_):
+                if not self.defaulted:
+                    with self.default():
+                        pass
+                self.llvm.label(self.elbl)
+                self.llvm.line('')
+
+            def case(self, index):
+                return self.Branch(self, self.clbls[index], self.elbl, index + 1)
+
+            def default(self):
+                self.defaulted = True
+                return self.Branch(self, self.dlbl, self.elbl, 0)
+
+            class Branch:
+                def __init__(self, switch, label, end, counter):
+                    self.switch  = switch
+                    self.llvm    = switch.llvm
+                    self.label   = label
+                    self.end     = end
+                    self.counter = counter
+
+                def __enter__(self):
+                    self.llvm.label(self.label)
+                    if self.switch.first is not None:
+                        self.switch.module.pgo.case(self.switch.module, self.switch.first + self.counter)
+                    return self
+
+                def __exit__(self, *_):
+                    self.llvm.br(self.end)
+
+        return Switch(self, value, constants)
+
+    def counted_loop(self, name, start, end, token=None):
+        class CountedLoop:
+            def __init__(self, module, name, start, end, token):
+                self.module   = module
+                self.token    = token
+                self.function = module.current
+                self.llvm     = module.current.llvm
+                self.name     = name
+                self.start    = start
+                self.end      = end
+                self.plbl     = self.llvm.next_lbl()
+                self.hlbl     = self.llvm.next_lbl()
+                self.blbl     = self.llvm.next_lbl()
+                self.llbl     = self.llvm.next_lbl()
+                self.elbl     = self.llvm.next_lbl()
+
+            def __enter__(self):
+                if self.name in self.function.args or self.name in self.function.variables:
+                    raise ProgramTypeError('Duplicated variable: ' + self.name)
+
+                if self.start.type.name not in [ '%i8', '%i16', '%i32', '%i64' ] \
+                or self.start.type is not self.end.type:
+                    raise ProgramTypeError('Unsupported range {} to {}'.format(
+                        self.start.type.name, self.end.type.name
+                    ))
+
+                # The induction variable lives in a phi, never in memory, so
+                # LLVM sees a canonical loop it can unroll and vectorize
+                rtype = self.start.type.to_llvm_ir()
+                self.llvm.comment('over')
+                self.llvm.br(self.plbl)
+                self.llvm.label(self.plbl)
+                self.llvm.br(self.hlbl)
+                self.llvm.label(self.hlbl)
+
+                self.next = self.llvm.next_reg()
+                index = self.llvm.phi(rtype, self.start.name, self.plbl, self.next, self.llbl)
+                if self.module.profile is not None:
+                    self.module.profile.loop(self.module, self.token)
+                cond  = self.llvm.icmp('slt', rtype, index, self.end.name)
+                weights = None
+                if self.module.pgo is not None:
+                    weights = self.module.pgo.branch(self.module, cond)
+                self.llvm.br_if_else(cond, self.blbl, self.elbl, weights)
+                self.llvm.label(self.blbl)
+
+                self.function.args[self.name] = Variable(name=index, type=self.start.type)
+                return self
+
+            def __exit__(self, *_):
+                index = self.function.args.pop(self.name)
+
+                self.llvm.br(self.llbl)
+                self.llvm.label(self.llbl)
+                self.llvm.add(index.type.to_llvm_ir(), index.name, '1', reg=self.next)
+                self.llvm.br(self.hlbl)
+                self.llvm.label(self.elbl)
+                self.llvm.line('')
+
+        return CountedLoop(self, name, start, end, token)
+
+    def parallel(self, name, start, end, chunk=None, reduce=None, token=None):
+        """
+        Outlines the body of a counted loop into a function that every thread
+        of the pool runs (see @par.run). The arguments and variables in scope
+        are copied into an environment, so they are read-only in the body.
+        Each thread takes one contiguous block of iterations, or chunks of
+        chunk iterations until none are left. With reduce, '+' or '*', the
+        values of the body are combined into the result of the loop.
+        """
+        class Parallel:
+            def __init__(self, module, name, start, end, chunk, reduce, token):
+                self.module = module
+                self.caller = module.current
+                self.name   = name
+                self.start  = start
+                self.end    = end
+                self.chunk  = chunk
+                self.op     = reduce
+                self.token  = token
+                self.rtype  = None
+
+            def field(self, index):
+                return self.llvm.get_element_ptr(self.etype, self.etype + '*', self.env, 'i32', 0, 'i32', index)
+
+            def __enter__(self):
+                module = self.module
+                caller = self.caller
+
+                if self.name in caller.args or self.name in caller.variables:
+                    raise ProgramTypeError('Duplicated variable: ' + self.name)
+
+                itype = self.start.type.name
+                if itype not in [ '%i8', '%i16', '%i32', '%i64' ] or self.end.type is not self.start.type \
+                or (self.chunk is not None and self.chunk.type is not self.start.type):
+                    raise ProgramTypeError('Unsupported range {} to {}'.format(itype, self.end.type.name))
+
+                if self.op not in [ None, '+', '*' ]:
+                    raise ProgramTypeError('Unsupported reduction: ' + self.op)
+
+                # start, end, next chunk, result, chunk size, then what is in scope
+                self.captured = [ (vname, var.type) for vname, var in list(caller.args.items()) + list(caller.variables.items()) ]
+                self.etype    = '{{ {}, {}, i64, i8*, i64{} }}'.format(
+                    self.start.type.to_llvm_ir(), self.end.type.to_llvm_ir(),
+                    ''.join(', ' + vtype.to_llvm_ir() for _, vtype in self.captured)
+                )
+
+                base = caller.name if caller.name in module.functions or caller.name[1] == '"' else module.signature(caller)
+                self.index    = caller.outlined
+                self.function = Function(
+                    name     = '@"{}.parallel.{}"'.format(base[1:].strip('"'), self.index),
+                    args     = {
+                        '%par.env'     : Variable(name='%par.env',     type=module.type('%ptr')),
+                        '%par.worker'  : Variable(name='%par.worker',  type=module.type('%i32')),
+                        '%par.workers' : Variable(name='%par.workers', type=module.type('%i32')),
+                    },
+                    rtype    = module.type('%void'),
+                    internal = True,
+                )
+                caller.outlined += 1
+                module.operation('@par.run')
+
+                self.scope = module.within(self.function)
+                self.scope.__enter__()
+                self.llvm = self.function.llvm
+                llvm      = self.llvm
+
+                self.env = llvm.bitcast('i8*', self.etype + '*', '%par.env')
+                for index, (vname, vtype) in enumerate(self.captured):
+                    value = llvm.load(vtype.to_llvm_ir(), vtype.to_llvm_ir() + '*', self.field(5 + index))
+                    self.function.args[vname] = Variable(name=value, type=vtype)
+
+                rtype = self.start.type.to_llvm_ir()
+                first = llvm.load(rtype, rtype + '*', self.field(0))
+                last  = llvm.load(rtype, rtype + '*', self.field(1))
+                if rtype != 'i64':
+                    first = llvm.sext(rtype, 'i64', first)
+                    last  = llvm.sext(rtype, 'i64', last)
+
+                if self.chunk is None:
+                    workers = llvm.zext('i32', 'i64', '%par.workers')
+                    worker  = llvm.zext('i32', 'i64', '%par.worker')
+                    count   = llvm.sub('i64', last, first)
+                    count   = llvm.add('i64', count, workers)
+                    count   = llvm.sub('i64', count, 1)
+                    block   = llvm.sdiv('i64', count, workers)
+                    begin   = llvm.mul('i64', worker, block)
+                    begin   = llvm.add('i64', first, begin)
+                    # Threads past the end get an empty range, which fits the counter type
+                    past    = llvm.icmp('slt', 'i64', last, begin)
+                    begin   = llvm.select(past, 'i64', last, begin)
+                else:
+                    self.grab = llvm.next_lbl()
+                    self.work = llvm.next_lbl()
+                    self.done = llvm.next_lbl()
+                    block     = llvm.load('i64', 'i64*', self.field(4))
+                    llvm.br(self.grab)
+
+                    llvm.label(self.grab)
+                    begin = llvm.atomic_add('i64', self.field(2), block)
+                    more  = llvm.icmp('slt', 'i64', begin, last)
+                    llvm.br_if_else(more, self.work, self.done)
+                    llvm.label(self.work)
+
+                stop = llvm.add('i64', begin, block)
+                over = llvm.icmp('slt', 'i64', last, stop)
+                stop = llvm.select(over, 'i64', last, stop)
+                if rtype != 'i64':
+                    begin = llvm.trunc('i64', rtype, begin)
+                    stop  = llvm.trunc('i64', rtype, stop)
+
+                self.loop = module.counted_loop(
+                    self.name, Variable(name=begin, type=self.start.type), Variable(name=stop, type=self.start.type), self.token
+                )
+                self.loop.__enter__()
+                return self
+
+            def reduce(self, value):
+                """ Combines value, from one iteration, into the share of this thread """
+                if value.type.name in [ '%i8', '%i16', '%i32', '%i64' ]:
+                    instr = { '+': 'add', '*': 'mul' }[self.op]
+                elif value.type.name in [ '%f16', '%f32', '%f64' ]:
+                    instr = { '+': 'fadd', '*': 'fmul' }[self.op]
+                else:
+                    raise ProgramTypeError('Cannot reduce {} with {}'.format(value.type.name, self.op))
+
+                if self.rtype is not None and self.rtype is not value.type:
+                    raise ProgramTypeError('Reduction of both {} and {}'.format(self.rtype.name, value.type.name))
+                self.rtype = value.type
+                self.instr = instr
+
+                vtype = value.type.to_llvm_ir()
+                acc   = self.llvm.load(vtype, vtype + '*', '%par.acc')
+                acc   = getattr(self.llvm, instr)(vtype, acc, value.name)
+                self.llvm.store(vtype, acc, vtype + '*', '%par.acc')
+
+            def identity(self):
+                one = self.op == '*'
+                if self.instr[0] == 'f':
+                    return '1.0' if one else '0.0'
+                return '1' if one else '0'
+
+            def __exit__(self, *exception):
+                if exception[0] is not None:
+                    self.scope.__exit__(*exception)
+                    return
+
+                module = self.module
+                llvm   = self.llvm
+                self.loop.__exit__()
+
+                if self.chunk is not None:
+                    llvm.br(self.grab)
+                    llvm.label(self.done)
+
+                # Every thread adds its share once, under the lock of the pool
+                if self.rtype is not None:
+                    vtype = self.rtype.to_llvm_ir()
+                    llvm.code = '    %par.acc = alloca {t}\n    store {t} {}, {t}* %par.acc\n'.format(self.identity(), t=vtype) + llvm.code
+                    llvm.locals.add('%par.acc')
+
+                    lock   = llvm.bitcast('%par.pthread*', 'i8*', '@par.lock')
+                    llvm.call('i32', '@pthread_mutex_lock', 'i8*', lock)
+                    result = llvm.load('i8*', 'i8**', self.field(3))
+                    result = llvm.bitcast('i8*', vtype + '*', result)
+                    share  = llvm.load(vtype, vtype + '*', '%par.acc')
+                    total  = llvm.load(vtype, vtype + '*', result)
+                    total  = getattr(llvm, self.instr)(vtype, total, share)
+                    llvm.store(vtype, total, vtype + '*', result)
+                    llvm.call('i32', '@pthread_mutex_unlock', 'i8*', lock)
+
+                llvm.ret('void')
+
+                for vname, _ in self.captured:
+                    self.function.args.pop(vname)
+                module.functions[self.function.name] = self.function
+                self.scope.__exit__(None, None, None)
+
+                # The environment lives in the frame of the caller, which
+                # waits for the loop to end
+                caller = self.caller
+                llvm   = caller.llvm
+                env    = '%par.env.{}'.format(self.index)
+                slot   = '%par.result.{}'.format(self.index)
+                allocas = '    {} = alloca {}\n'.format(env, self.etype)
+                if self.rtype is not None:
+                    allocas += '    {} = alloca {}\n'.format(slot, self.rtype.to_llvm_ir())
+                    llvm.locals.add(slot)
+                llvm.code = allocas + llvm.code
+                llvm.locals.add(env)
+
+                self.llvm, self.env = llvm, env
+                rtype = self.start.type.to_llvm_ir()
+                llvm.store(rtype, self.start.name, rtype + '*', self.field(0))
+                llvm.store(rtype, self.end.name,   rtype + '*', self.field(1))
+
+                first = self.start.name if rtype == 'i64' else llvm.sext(rtype, 'i64', self.start.name)
+                llvm.store('i64', first, 'i64*', self.field(2))
+
+                result = 'null'
+                if self.rtype is not None:
+                    vtype  = self.rtype.to_llvm_ir()
+                    llvm.store(vtype, self.identity(), vtype + '*', slot)
+                    result = llvm.bitcast(vtype + '*', 'i8*', slot)
+                llvm.store('i8*', result, 'i8**', self.field(3))
+
+                block = '0'
+                if self.chunk is not None:
+                    block = self.chunk.name if rtype == 'i64' else llvm.sext(rtype, 'i64', self.chunk.name)
+                    small = llvm.icmp('slt', 'i64', block, 1)
+                    block = llvm.select(small, 'i64', 1, block)
+                llvm.store('i64', block, 'i64*', self.field(4))
+
+                for index, (vname, vtype) in enumerate(self.captured):
+                    value = module.variable(vname)
+                    llvm.store(vtype.to_llvm_ir(), value.name, vtype.to_llvm_ir() + '*', self.field(5 + index))
+
+                data = llvm.bitcast(self.etype + '*', 'i8*', env)
+                job  = 'bitcast (void (i8*, i32, i32)* {} to i8*)'.format(self.function.name)
+                llvm.call('void', '@par.run', 'i8*', job, 'i8*', data)
+                caller.calls.add('@par.run')
+                caller.calls.add(self.function.name)
+
+                if self.rtype is None:
+                    self.result = Variable(type=module.type('%void'))
+                else:
+                    value = llvm.load(self.rtype.to_llvm_ir(), self.rtype.to_llvm_ir() + '*', slot)
+                    self.result = Variable(name=value, type=self.rtype)
+
+        return Parallel(self, name, start, end, chunk, reduce, token)
 
     def negate(self, value):
         reg = self.current.llvm.icmp('eq', 'i1', value.name, '0')
         return Variable(name=reg, type=self.type('%bool'))
 
+    def infer_attributes(self):
+        """
+        Function attributes of every used function: whether it touches memory
+        other than its own stack, whether it can recurse and whether it is
+        worth inlining. Nothing unwinds, as the language has no exceptions.
+        """
+        functions = { name: fn for name, fn in self.functions.items() if fn.used }
+        constants = { name for name, vr in self.variables.items() if vr.constant }
+
+        effects = {}
+        for name, fn in functions.items():
+            effects[name] = set()
+            if fn.llvm.loads - fn.llvm.locals - constants:
+                effects[name].add('read')
+            if fn.llvm.stores - fn.llvm.locals:
+                effects[name].add('write')
+
+        attributes = {}
+        for name, fn in functions.items():
+            reaches = set()
+            pending = list(fn.llvm.callees)
+            while pending:
+                callee = pending.pop()
+                if callee not in reaches:
+                    reaches.add(callee)
+                    if callee in functions:
+                        pending.extend(functions[callee].llvm.callees)
+
+            # Calls through a pointer (parallel loops) may come back
+            attributes[name] = [ 'nounwind' ]
+            if name not in reaches and not any(callee[0] == '%' for callee in reaches):
+                attributes[name].append('norecurse')
+
+            # Main also registers the flush of the output
+            if name == '@main':
+                continue
+
+            # Externals may do anything
+            touched = set(effects[name])
+            for callee in reaches:
+                touched |= effects.get(callee, { 'read', 'write' })
+
+            if len(touched) == 0:
+                attributes[name].append('readnone')
+            elif touched == { 'read' }:
+                attributes[name].append('readonly')
+
+            size = sum(1 for line in fn.llvm.code.splitlines() if line.startswith('    ') and line[4] != ';')
+            if name in reaches:
+                pass
+            elif size <= INLINE_ALWAYS:
+                attributes[name].append('alwaysinline')
+            elif size <= INLINE_HINT:
+                attributes[name].append('inlinehint')
+
+        return attributes
+
     def to_llvm_ir(self):
+        if self.profile is not None:
+            self.profile.finish(self)
+        if self.pgo is not None:
+            self.pgo.finish(self)
+
+        # Only what main reaches ends up in the output
+        pending = [ fn for fn in self.functions.values() if fn.used ]
+        while pending:
+            for name in pending.pop().calls:
+                callee = self.functions.get(name)
+                if callee is not None and not callee.used:
+                    callee.used = True
+                    pending.append(callee)
+
         with self.llvm.commented_block('Declared types:'):
             for _, ty in self.types.items():
                 if ty.primitive:
@@ -725,7 +1648,7 @@ class Module:
 
         with self.llvm.commented_block('Globals and constants:'):
             for _, vr in self.variables.items():
-                self.llvm.global_variable(vr.name, vr.type.to_llvm_ir(), vr.value)
+                self.llvm.global_variable(vr.name, vr.type.to_llvm_ir(), vr.value, vr.constant, vr.thread_local)
 
         with self.llvm.commented_block('Externals'):
             for _, ex in self.externals.items():
@@ -733,20 +1656,32 @@ class Module:
                     arg.to_llvm_ir() for arg in ex.args
                 ])
 
+        attributes = self.infer_attributes()
+
         with self.llvm.commented_block('Functions:'):
             for _, fn in self.functions.items():
                 if not fn.used:
                     continue
                 args = []
-                for _, arg in fn.args.items():
-                    args.append(arg.type.to_llvm_ir())
+                for name, arg in fn.args.items():
+                    atype = arg.type.to_llvm_ir()
+                    # Builtins are also called directly, not only through call
+                    if not fn.internal and arg.type.repr[-1] == '*' and fn.nonnull.get(name, False):
+                        atype += ' nonnull'
+                    args.append(atype)
                     args.append(arg.name)
-                with self.llvm.define(fn.internal, fn.name, fn.rtype.to_llvm_ir(), *args):
+                with self.llvm.define(fn.internal, fn.name, fn.rtype.to_llvm_ir(), *args,
+                                      attributes=attributes[fn.name], scope=fn.scope, count=fn.count):
                     self.llvm.code += fn.llvm.code
                     if fn.name == '@main':
                         self.llvm.ret(self.type('%i32').to_llvm_ir(), '0')
                 self.llvm.line('')
 
+        if self.debug is not None:
+            self.llvm.code += self.debug.to_llvm_ir()
+        if self.pgo is not None:
+            self.llvm.code += self.pgo.to_llvm_ir()
+
         return self.llvm.code
 
 
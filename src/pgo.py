@@ -0,0 +1,177 @@
+"""
+Profile-guided optimization (--pgo-gen, --pgo-use).
+
+A --pgo-gen build counts how often every operator is entered, every ? and
+loop test goes each way and every switch case is taken, and writes the
+counters to a file when the program exits. The driver adds them up into the
+profile of the program, one training run after the other. A --pgo-use build
+of the same program, by the same compiler, numbers the same places in the same
+order and turns their counts into branch_weights and function_entry_count
+metadata, with a ProfileSummary, so opt lays out blocks and inlines calls by
+how the training runs went.
+"""
+
+from src.llvm import Function
+
+# Detailed summary cutoffs, in millionths of all counts, as llvm-profdata
+CUTOFFS = [ 10000, 100000, 200000, 300000, 400000, 500000, 600000, 700000, 800000, 900000,
+            950000, 990000, 999000, 999900, 999990, 999999 ]
+
+class Sites:
+    """
+    Numbers the counters of a program in the order they are generated, so
+    both builds agree on them: one per operator, two per branch (times
+    taken, times run) and one per switch destination, default first.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def reserve(self, size):
+        first       = self.count
+        self.count += size
+        return first
+
+    def entry(self, module, function):
+        self.reserve(1)
+
+    def branch(self, module, cond):
+        """ Weights of the br on cond, about to be generated """
+        self.reserve(2)
+        return None
+
+    def switch(self, module, size):
+        """ First counter and weights of a switch of size cases """
+        return self.reserve(size + 1), None
+
+    def case(self, module, counter):
+        pass
+
+    def finish(self, module):
+        pass
+
+    def to_llvm_ir(self):
+        return ''
+
+class Training(Sites):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path    # Where the binary leaves its counters
+
+    def add(self, llvm, counter, value='1'):
+        ptr = llvm.get_element_ptr('%pgo.counts', '%pgo.counts*', '@pgo.counts', 'i64', 0, 'i64', counter)
+        old = llvm.load('i64', 'i64*', ptr)
+        new = llvm.add('i64', old, value)
+        llvm.store('i64', new, 'i64*', ptr)
+
+    def entry(self, module, function):
+        self.add(function.llvm, self.reserve(1))
+
+    def branch(self, module, cond):
+        first = self.reserve(2)
+        llvm  = module.current.llvm
+        self.add(llvm, first, llvm.zext('i1', 'i64', cond))
+        self.add(llvm, first + 1)
+        return None
+
+    def case(self, module, counter):
+        self.add(module.current.llvm, counter)
+
+    def finish(self, module):
+        """ Adds the counters and their dump, registered with atexit by main """
+        module.type('%pgo.counts', '[ {} x i64 ]'.format(self.count))
+        module.new_global_var('@pgo.counts', module.type('%pgo.counts'), 'zeroinitializer', constant=False)
+
+        module.add_external('@atexit', '%i32', [ '%ptr' ])
+        module.add_external('@fopen',  '%ptr', [ '%ptr', '%ptr' ])
+        module.add_external('@fwrite', '%i64', [ '%ptr', '%i64', '%i64', '%ptr' ])
+        module.add_external('@fclose', '%i32', [ '%ptr' ])
+
+        dump = Function(name='@pgo.dump', rtype=module.type('%void'), internal=True)
+        with module.within(dump):
+            llvm = dump.llvm
+            path = module.const_cstr(self.path).name
+            mode = module.const_cstr('wb').name
+            file = llvm.call('i8*', '@fopen', 'i8*', path, 'i8*', mode)
+            none = llvm.icmp('eq', 'i8*', file, 'null')
+            done = llvm.next_lbl()
+            save = llvm.next_lbl()
+            llvm.br_if_else(none, done, save)
+
+            llvm.label(save)
+            data = llvm.bitcast('%pgo.counts*', 'i8*', '@pgo.counts')
+            llvm.call('i64', '@fwrite', 'i8*', data, 'i64', 8, 'i64', self.count, 'i8*', file)
+            llvm.call('i32', '@fclose', 'i8*', file)
+            llvm.br(done)
+
+            llvm.label(done)
+            llvm.ret('void')
+        module.functions[dump.name] = dump
+
+        main = module.functions['@main']
+        main.calls.add(dump.name)
+        main.llvm.callees.add('@atexit')
+        main.llvm.code = '    %pgo.atexit = call i32 @atexit(i8* bitcast (void ()* @pgo.dump to i8*))\n' + main.llvm.code
+
+class Weights(Sites):
+    def __init__(self, counts, runs=1):
+        super().__init__()
+        self.counts = counts    # Summed over the training runs
+        self.runs   = runs
+        self.calls  = []        # Entry counts of the operators
+
+    def entry(self, module, function):
+        function.count = self.counts[self.reserve(1)]
+        self.calls.append(function.count)
+
+    def branch(self, module, cond):
+        first        = self.reserve(2)
+        taken, total = self.counts[first:first + 2]
+        return self.weights([ taken, total - taken ])
+
+    def switch(self, module, size):
+        first = self.reserve(size + 1)
+        return first, self.weights(self.counts[first:first + size + 1])
+
+    def finish(self, module):
+        # Calls are only hot in functions with an entry count
+        module.functions['@main'].count = self.runs
+
+    def weights(self, counts):
+        # Nothing is known of what never ran, so it is left to opt
+        if not any(counts):
+            return None
+
+        # Weights are i32, only their ratios matter
+        scale = -(-max(counts) // 0xFFFFFFFF)
+        return '!{{!"branch_weights", {}}}'.format(', '.join('i32 {}'.format(count // scale) for count in counts))
+
+    def to_llvm_ir(self):
+        """ ProfileSummary, which tells opt what counts as hot or cold """
+        counts = sorted((count for count in self.counts if count > 0), reverse=True)
+        total  = sum(counts)
+        if total == 0:
+            return ''
+
+        detailed = []
+        seen     = 0
+        index    = 0
+        for cutoff in CUTOFFS:
+            while index < len(counts) and seen * 1000000 < cutoff * total:
+                seen  += counts[index]
+                index += 1
+            detailed.append('!{{i32 {}, i64 {}, i32 {}}}'.format(cutoff, counts[index - 1], index))
+
+        fields = [
+            '!{!"ProfileFormat", !"InstrProf"}',
+            '!{{!"TotalCount", i64 {}}}'.format(total),
+            '!{{!"MaxCount", i64 {}}}'.format(counts[0]),
+            '!{{!"MaxInternalCount", i64 {}}}'.format(counts[0]),
+            '!{{!"MaxFunctionCount", i64 {}}}'.format(max(self.calls, default=0)),
+            '!{{!"NumCounts", i64 {}}}'.format(len(self.counts)),
+            '!{{!"NumFunctions", i64 {}}}'.format(len(self.calls)),
+            '!{{!"DetailedSummary", !{{{}}}}}'.format(', '.join(detailed)),
+        ]
+
+        code  = '!llvm.module.flags = !{!0}\n'
+        code += '!0 = !{{i32 1, !"ProfileSummary", !{{{}}}}}\n'.format(', '.join(fields))
+        return code
@@ -0,0 +1,228 @@
+"""
+Instrumented builds (--instrument).
+
+Every user operator counts its calls and the cycles spent in it, read from
+llvm.readcyclecounter (rdtsc on x86), both in total and without the
+operators it calls. Every repeat counts how many times its header runs,
+which is once per iteration plus the last test. At exit the counts go to
+stderr: operators by self cycles, then loops by count. Calls evaluated at
+compile time never run, so they are not counted.
+
+Cycles go from the entry of an operator to its return. A tail call returns
+first, so the operator it calls is accounted to the caller's caller, as if
+it had been called from there, and recursion through tail calls still
+runs in constant stack space.
+"""
+
+from src.llvm import Function, Variable
+
+# calls, total cycles, self cycles, name
+SITE = '{ i64, i64, i64, i8* }'
+
+class Profile:
+    def __init__(self, lines=None):
+        self.lines     = lines or []   # (file, line) of each line of the compiled text
+        self.operators = []            # (function, site)
+        self.loops     = []            # (function, where, site)
+        self.entered   = {}            # id(function) to (site, start, saved)
+        self.left      = None          # Function that accounted for itself before a tail call
+
+    def site(self, module):
+        if '@prof.child' not in module.variables:
+            module.type('%prof.site', SITE)
+            module.new_global_var('@prof.child', module.type('%i64'), '0', constant=False)
+
+        # Named in finish(), once the function names are known
+        name = '@prof.site.{}'.format(len(self.operators) + len(self.loops))
+        module.new_global_var(name, module.type('%prof.site'), None, constant=False)
+        return name
+
+    def add(self, llvm, site, field, value):
+        ptr = llvm.get_element_ptr('%prof.site', '%prof.site*', site, 'i32', 0, 'i32', field)
+        old = llvm.load('i64', 'i64*', ptr)
+        new = llvm.add('i64', old, value)
+        llvm.store('i64', new, 'i64*', ptr)
+
+    def enter(self, module, function):
+        """ Counts a call of function, at the top of its body """
+        site = self.site(module)
+        self.operators.append((function, site))
+
+        # Cycles of the operators this one calls add up in @prof.child
+        llvm  = function.llvm
+        start = llvm.call('i64', '@llvm.readcyclecounter')
+        saved = llvm.load('i64', 'i64*', '@prof.child')
+        llvm.store('i64', '0', 'i64*', '@prof.child')
+        self.add(llvm, site, 0, '1')
+
+        self.entered[id(function)] = (site, start, saved)
+
+    def leave(self, module, function):
+        """ Adds the cycles since the entry of function, right before it returns """
+        if self.left is function:
+            self.left = None
+            return
+
+        if id(function) not in self.entered:
+            return
+
+        site, start, saved = self.entered[id(function)]
+
+        llvm    = function.llvm
+        now     = llvm.call('i64', '@llvm.readcyclecounter')
+        elapsed = llvm.sub('i64', now, start)
+        child   = llvm.load('i64', 'i64*', '@prof.child')
+        own     = llvm.sub('i64', elapsed, child)
+        self.add(llvm, site, 1, elapsed)
+        self.add(llvm, site, 2, own)
+
+        parent = llvm.add('i64', saved, elapsed)
+        llvm.store('i64', parent, 'i64*', '@prof.child')
+
+    def tail(self, module, function):
+        """ Leaves function before the tail call that ends it """
+        self.leave(module, function)
+        self.left = function
+
+    def loop(self, module, token):
+        """ Counts a run of the loop header being generated """
+        where = ''
+        if token is not None and 0 < token.row <= len(self.lines):
+            where = ' at {}:{}'.format(*self.lines[token.row - 1])
+
+        site = self.site(module)
+        self.loops.append((module.current, where, site))
+        self.add(module.current.llvm, site, 0, '1')
+
+    def finish(self, module):
+        """ Names the sites and adds the report, registered with atexit by main """
+        if not self.operators and not self.loops:
+            return
+
+        sites = [ (fn.name[1:].strip('"'), site) for fn, site in self.operators ] \
+              + [ (fn.name[1:].strip('"') + ' repeat' + where, site) for fn, where, site in self.loops ]
+
+        for name, site in sites:
+            size  = len(name) + 1
+            value = name.replace('\\', '\\5C').replace('"', '\\22').replace('\n', '\\0A')
+            ctype = module.types.array(module.types['%i8'], size)
+            const = module.const(ctype, 'c"{}\\00"'.format(value))
+            module.variables[site].value = '{{ i64 0, i64 0, i64 0, i8* getelementptr ({ct}, {ct}* {}, i64 0, i64 0) }}'.format(
+                const.name, ct=ctype.to_llvm_ir()
+            )
+
+        if '@stderr' not in module.variables:
+            module.new_global_var('@stderr', module.type('%ptr'), None, constant=False)
+
+        module.add_external('@llvm.readcyclecounter', '%i64', [])
+        module.add_external('@atexit',  '%i32',  [ '%ptr' ])
+        module.add_external('@qsort',   '%void', [ '%ptr', '%i64', '%i64', '%ptr' ])
+        module.add_external('@fprintf', '%i32',  [ '%ptr', '%ptr', '%vararg' ])
+
+        report = Function(name='@prof.report', rtype=module.type('%void'), internal=True)
+        with module.within(report):
+            stderr = report.llvm.load('i8*', 'i8**', '@stderr')
+            self.section(module, report, stderr, 'operators', [ site for _, site in self.operators ], 2,
+                         '\n       calls     total cycles      self cycles  operator\n',
+                         '%12lu %16lu %16lu  %s\n')
+            self.section(module, report, stderr, 'loops', [ site for _, _, site in self.loops ], 0,
+                         '\n        runs  loop\n',
+                         '%12lu  %s\n')
+            report.llvm.ret('void')
+        module.functions[report.name] = report
+
+        main = module.functions['@main']
+        main.calls.add(report.name)
+        main.llvm.callees.add('@atexit')
+        main.llvm.code = '    %prof.atexit = call i32 @atexit(i8* bitcast (void ()* @prof.report to i8*))\n' + main.llvm.code
+
+    def section(self, module, report, stderr, name, sites, key, header, row):
+        """ Prints the sites sorted by the given field, skipping those that never ran """
+        if not sites:
+            return
+
+        ttype = module.type('%prof.{}'.format(name), '[ {} x %prof.site* ]'.format(len(sites)))
+        table = '@prof.{}'.format(name)
+        module.new_global_var(table, ttype, '[ ' + ', '.join('%prof.site* ' + site for site in sites) + ' ]', constant=False)
+
+        compare = self.comparator(module, key)
+        report.calls.add(compare)
+
+        llvm = report.llvm
+        llvm.call('i32(i8*, i8*, ...)', '@fprintf', 'i8*', stderr, 'i8*', module.const_cstr(header).name)
+
+        data = llvm.bitcast(ttype.to_llvm_ir() + '*', 'i8*', table)
+        llvm.call('void', '@qsort', 'i8*', data, 'i64', len(sites), 'i64', 8,
+                  'i8*', 'bitcast (i32 (i8*, i8*)* {} to i8*)'.format(compare))
+
+        fmt  = module.const_cstr(row).name
+        pre  = llvm.next_lbl()
+        head = llvm.next_lbl()
+        body = llvm.next_lbl()
+        show = llvm.next_lbl()
+        step = llvm.next_lbl()
+        done = llvm.next_lbl()
+
+        llvm.br(pre)
+        llvm.label(pre)
+        llvm.br(head)
+        llvm.label(head)
+        after = llvm.next_reg()
+        index = llvm.phi('i64', 0, pre, after, step)
+        more  = llvm.icmp('slt', 'i64', index, len(sites))
+        llvm.br_if_else(more, body, done)
+
+        llvm.label(body)
+        slot   = llvm.get_element_ptr(ttype.to_llvm_ir(), ttype.to_llvm_ir() + '*', table, 'i64', 0, 'i64', index)
+        site   = llvm.load('%prof.site*', '%prof.site**', slot)
+        fields = []
+        for field, ftype in enumerate([ 'i64', 'i64', 'i64', 'i8*' ]):
+            ptr = llvm.get_element_ptr('%prof.site', '%prof.site*', site, 'i32', 0, 'i32', field)
+            fields.append(llvm.load(ftype, ftype + '*', ptr))
+        never = llvm.icmp('eq', 'i64', fields[0], 0)
+        llvm.br_if_else(never, step, show)
+
+        llvm.label(show)
+        if key == 0:
+            llvm.call('i32(i8*, i8*, ...)', '@fprintf', 'i8*', stderr, 'i8*', fmt, 'i64', fields[0], 'i8*', fields[3])
+        else:
+            llvm.call('i32(i8*, i8*, ...)', '@fprintf', 'i8*', stderr, 'i8*', fmt,
+                      'i64', fields[0], 'i64', fields[1], 'i64', fields[2], 'i8*', fields[3])
+        llvm.br(step)
+
+        llvm.label(step)
+        llvm.add('i64', index, 1, reg=after)
+        llvm.br(head)
+        llvm.label(done)
+
+    def comparator(self, module, key):
+        """ qsort comparator of site pointers, greatest field first """
+        name = '@prof.by.{}'.format(key)
+        if name in module.functions:
+            return name
+
+        fn = Function(
+            name     = name,
+            args     = {
+                '%a' : Variable(name='%a', type=module.type('%ptr')),
+                '%b' : Variable(name='%b', type=module.type('%ptr')),
+            },
+            rtype    = module.type('%i32'),
+            internal = True,
+        )
+
+        values = []
+        for arg in [ '%a', '%b' ]:
+            slot = fn.llvm.bitcast('i8*', '%prof.site**', arg)
+            site = fn.llvm.load('%prof.site*', '%prof.site**', slot)
+            ptr  = fn.llvm.get_element_ptr('%prof.site', '%prof.site*', site, 'i32', 0, 'i32', key)
+            values.append(fn.llvm.load('i64', 'i64*', ptr))
+
+        above  = fn.llvm.icmp('ugt', 'i64', values[0], values[1])
+        below  = fn.llvm.icmp('ult', 'i64', values[0], values[1])
+        result = fn.llvm.select(above, 'i32', -1, 0)
+        result = fn.llvm.select(below, 'i32', 1, result)
+        fn.llvm.ret('i32', result)
+
+        module.functions[name] = fn
+        return name
@@ -0,0 +1,98 @@
+"""
+Long-running compile server.
+
+The standard library goes through the generator once, at start-up, and every
+request works on a deep copy of that warmed Generator, so a build only pays
+for its own file. Requests come in over a Unix socket, one JSON line each:
+
+    {"file": "/abs/path.ifx", "option": null | "--code-gen" | "-o" | "--asm" | "--build-only",
+     "directory": "/where/the/client/runs"}
+
+and get one JSON line back: {"ir": ...}, {"asm": ...}, {"object": ...,
+"binary": ...} (with the "cache" summary when $INFIX_CACHE is set) or
+{"error": ...}. Objects and binaries go to obj/ and bin/ under the directory
+of the request, the one of the file by default, named after the file and a
+hash of its path, so requests for files with the same name never share
+them. Connections are handed to a pool of worker threads;
+generation holds the GIL, but opt, llc and clang of different requests run
+side by side.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import socket
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src           import driver
+from src.cache     import Cache
+from src.generator import Generator
+
+SOCKET  = os.environ.get('INFIX_SOCKET', '/tmp/infix-{}.sock'.format(os.getuid()))
+WORKERS = os.cpu_count() or 4
+
+class Server:
+    def __init__(self, path=SOCKET, workers=WORKERS):
+        self.path    = path
+        self.workers = workers
+
+        self.included = set()
+        self.template = Generator(Cache.from_environment())
+        self.template.generate_node(driver.parse(driver.include('#include std.ifx\n', self.included)))
+
+    def compile(self, request):
+        fpath  = request['file']
+        option = request.get('option')
+
+        generator = copy.deepcopy(self.template)
+        cache     = generator.cache
+        if cache is not None:
+            cache.reset()
+
+        ir_repr = generator.generate(driver.parse(driver.read_source(fpath, set(self.included))))
+
+        if option == '--code-gen':
+            return { 'ir': ir_repr }
+
+        if option == '-o':
+            return { 'ir': driver.optimize(ir_repr) }
+
+        if option == '--asm':
+            return { 'asm': driver.assemble(driver.optimize(ir_repr)) }
+
+        directory    = request.get('directory', os.path.dirname(fpath))
+        tag          = hashlib.sha256(bytes(fpath, 'utf-8')).hexdigest()[:12]
+        oname, bname = driver.build(ir_repr, fpath, cache, directory, tag)
+        response     = { 'object': os.path.abspath(oname), 'binary': os.path.abspath(bname) }
+        if cache is not None:
+            response['cache'] = cache.summary()
+        return response
+
+    def handle(self, conn):
+        with conn, conn.makefile('rwb') as stream:
+            try:
+                response = self.compile(json.loads(stream.readline()))
+            except driver.BuildError as e:
+                response = { 'error': str(e) }
+            except Exception:
+                response = { 'error': traceback.format_exc() }
+
+            stream.write(bytes(json.dumps(response) + '\n', 'utf-8'))
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock, \
+             ThreadPoolExecutor(self.workers) as pool:
+            sock.bind(self.path)
+            sock.listen()
+            try:
+                while True:
+                    conn, _ = sock.accept()
+                    pool.submit(self.handle, conn)
+            finally:
+                os.unlink(self.path)
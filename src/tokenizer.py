@@ -3,6 +3,11 @@ from enum import Enum, auto
 
 from src.util import can_convert_to
 
+ESCAPES = {
+    'n' : '\n',
+    't' : '\t',
+}
+
 class TokenType(Enum):
     UNKNOWN    = auto()
     IDENTIFIER = auto()
@@ -46,8 +51,20 @@ class Tokenizer:
         token       = ''
         token_row   = 1
         token_col   = 1
+        escaped     = False
 
         for c in self.source:
+            if escaped:
+                token    += ESCAPES.get(c, c)
+                escaped   = False
+                self.col += 1
+                continue
+
+            if c == '\\' and parsing and ptype == 1:
+                escaped   = True
+                self.col += 1
+                continue
+
             if c == '\n':
                 self.row += 1
                 self.col  = 0
@@ -2,19 +2,33 @@
 
 import sys
 import os
+import re
 import subprocess
 
-def run_test(test_name, max_file_name, output=False):
+# Run through the interpreter instead of compiling (--interpret), or build
+# from lean IR (--lean), with line tables (-g) or as one LTO unit (--lto)
+MODE = ''
+
+def test_command(test_name, mode=None):
     try:
         with open('tests/{}.args'.format(test_name), 'r') as args_file:
             args = args_file.read()
     except:
         args = ''
-    
+
+    if os.path.exists('tests/{}.in'.format(test_name)):
+        args += ' < tests/{}.in'.format(test_name)
+    return './infix.py {}tests/{}.ifx {}'.format(MODE if mode is None else mode, test_name, args.strip())
+
+def sorted_output(test_name, output):
+    # Output of parallel loops comes in any order, so these compare their lines sorted
+    if os.path.exists('tests/{}.sorted'.format(test_name)):
+        return ''.join(sorted(output.splitlines(True)))
+    return output
+
+def run_test(test_name, max_file_name, output=False):
     try:
-        if os.path.exists('tests/{}.in'.format(test_name)):
-            args += ' < tests/{}.in'.format(test_name)
-        process_out = subprocess.check_output('./infix.py tests/{}.ifx {}'.format(test_name, args.strip()), stderr=None, shell=True)
+        process_out = subprocess.check_output(test_command(test_name), stderr=None, shell=True)
         process_out = process_out.decode('UTF-8')
     except Exception as e:
         if output:
@@ -29,12 +43,219 @@ def run_test(test_name, max_file_name, output=False):
         print('{fname:{fill}} [FAILURE] Missing expected output file'.format(fname=test_name + ':', fill=max_file_name))
         return
 
-    if process_out != expected_out:
+    if sorted_output(test_name, process_out) != sorted_output(test_name, expected_out):
         print('{fname:{fill}} [FAILURE] Process output does not match expected output'.format(fname=test_name + ':', fill=max_file_name))
     else:
         print('{fname:{fill}} [SUCCESS]'.format(fname=test_name + ':', fill=max_file_name))
 
+def run_concurrent(copies=8):
+    from src import driver
+
+    test_names = sorted(f[:-4] for f in os.listdir('tests/') if f[-3:] == 'ifx')
+    fpaths     = [ 'tests/{}.ifx'.format(test_name) for test_name in test_names ]
+
+    # Every copy must come out as it does when compiled alone
+    expected = driver.compile_batch(fpaths, workers=1)
+    results  = driver.compile_batch(fpaths * copies, workers=2 * (os.cpu_count() or 4))
+
+    max_file_name = 1 + max(len(test_name) for test_name in test_names)
+    for index, test_name in enumerate(test_names):
+        outputs = [ repr(result) if isinstance(result, Exception) else result for result in results[index::len(fpaths)] ]
+        alone   = repr(expected[index]) if isinstance(expected[index], Exception) else expected[index]
+        if any(output != alone for output in outputs):
+            print('{fname:{fill}} [FAILURE] Concurrent compilation does not match'.format(fname=test_name + ':', fill=max_file_name))
+        else:
+            print('{fname:{fill}} [SUCCESS]'.format(fname=test_name + ':', fill=max_file_name))
+
+# A program whose callee gets edited between builds
+CACHED_PROGRAM = '''
+f is {{
+    right is i32;
+    void return right + {};
+}};
+
+g is {{
+    right is i32;
+    void return (void f right) * 2;
+}};
+
+h is {{
+    right is i32;
+    void return right - 1;
+}};
+
+void println void g 0;
+void println void h 0;
+'''
+
+def cached_build(command, cache):
+    process = subprocess.run(command, shell=True, env=dict(os.environ, INFIX_CACHE=cache),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    summary = [ line for line in process.stderr.splitlines() if line.startswith('cache: ') ]
+    return process.stdout, summary[-1] if summary else process.stderr
+
+def run_cache():
+    import tempfile
+
+    test_names    = sorted(f[:-4] for f in os.listdir('tests/') if f[-3:] == 'ifx')
+    max_file_name = 1 + max(len(test_name) for test_name in test_names + [ 'edited_callee' ])
+
+    def report(name, failure):
+        if failure:
+            print('{fname:{fill}} [FAILURE] {}'.format(failure, fname=name + ':', fill=max_file_name))
+        else:
+            print('{fname:{fill}} [SUCCESS]'.format(fname=name + ':', fill=max_file_name))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, 'cache')
+
+        # Cached code must come out as it does without the cache, or builds
+        # would not find the objects of the ones before
+        for test_name in test_names:
+            with open('tests/{}.out'.format(test_name), 'r') as expected_file:
+                expected_out = sorted_output(test_name, expected_file.read())
+
+            generate       = './infix.py --code-gen tests/{}.ifx'.format(test_name)
+            uncached       = subprocess.check_output(generate, shell=True, universal_newlines=True)
+            recorded, _    = cached_build(generate, cache)
+            replayed, _    = cached_build(generate, cache)
+            first, _       = cached_build(test_command(test_name), cache)
+            second, reused = cached_build(test_command(test_name), cache)
+            if recorded != uncached or replayed != uncached:
+                report(test_name, 'Cached IR does not match uncached IR')
+            elif sorted_output(test_name, first) != expected_out or sorted_output(test_name, second) != expected_out:
+                report(test_name, 'Cached build output does not match expected output')
+            elif not re.match(r'cache: (\d+) of \1 definitions reused \(\d+%\), object reused$', reused):
+                report(test_name, 'Second build did not reuse everything: ' + reused)
+            else:
+                report(test_name, None)
+
+        # Editing f must build g again, which calls it, and nothing else: not h
+        # nor the two of the standard library
+        source = os.path.join(tmp, 'edited_callee.ifx')
+        builds = []
+        for step in [ 1, 1, 50 ]:
+            with open(source, 'w') as f:
+                f.write(CACHED_PROGRAM.format(step))
+            builds.append(cached_build('./infix.py ' + source, os.path.join(tmp, 'edited')))
+
+        expected = [
+            ('2\n-1\n',   'cache: 0 of 5 definitions reused (0%), object compiled'),
+            ('2\n-1\n',   'cache: 5 of 5 definitions reused (100%), object reused'),
+            ('100\n-1\n', 'cache: 3 of 5 definitions reused (60%), object compiled'),
+        ]
+        report('edited_callee', None if builds == expected else 'Got {}'.format(builds))
+
+# Counts --instrument reports for some tests, which do not depend on timing
+INSTRUMENTED = {
+    'tail_recursion' : {
+        'i32;count;i32'    : 5000001,
+        'i32;sum;i32'      : 100001,
+        'void;println;i32' : 2,
+    },
+    'counted_loops' : {
+        'void;find;i32'                                       : 2,
+        'void;find;i32 repeat at tests/counted_loops.ifx:31'  : 184,
+        'void;find;i32 repeat at tests/counted_loops.ifx:30'  : 18,
+        'main repeat at tests/counted_loops.ifx:20'           : 4,
+    },
+}
+
+def instrument_report(report):
+    """ Calls of every operator and runs of every loop in a report, or None when malformed """
+    counts = {}
+    for line in report.splitlines():
+        operator = re.match(r'\s*(\d+)\s+(\d+)\s+(\d+)  (.+)$', line)
+        loop     = re.match(r'\s*(\d+)  (.+)$', line)
+        if operator is not None:
+            calls, total, own, name = operator.groups()
+            if int(own) > int(total):
+                return None
+            counts[name] = int(calls)
+        elif loop is not None:
+            counts[loop.group(2)] = int(loop.group(1))
+        elif line.split() not in [ [], [ 'calls', 'total', 'cycles', 'self', 'cycles', 'operator' ], [ 'runs', 'loop' ] ]:
+            return None
+    return counts
+
+def run_instrument():
+    """ Builds every test with --instrument and reads the report it leaves on stderr """
+    test_names    = sorted(f[:-4] for f in os.listdir('tests/') if f[-3:] == 'ifx')
+    max_file_name = 1 + max(len(test_name) for test_name in test_names)
+
+    for test_name in test_names:
+        with open('tests/{}.out'.format(test_name), 'r') as expected_file:
+            expected_out = sorted_output(test_name, expected_file.read())
+
+        process = subprocess.run(test_command(test_name, '--instrument '), shell=True, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        counts  = instrument_report(process.stderr)
+        if sorted_output(test_name, process.stdout) != expected_out:
+            failure = 'Process output does not match expected output'
+        elif counts is None:
+            failure = 'Malformed report: ' + repr(process.stderr)
+        elif any(counts.get(name) != count for name, count in INSTRUMENTED.get(test_name, {}).items()):
+            failure = 'Report does not count what ran: ' + repr(process.stderr)
+        else:
+            failure = None
+
+        if failure:
+            print('{fname:{fill}} [FAILURE] {}'.format(failure, fname=test_name + ':', fill=max_file_name))
+        else:
+            print('{fname:{fill}} [SUCCESS]'.format(fname=test_name + ':', fill=max_file_name))
+
+def run_pgo():
+    """ Trains every test twice with --pgo-gen, then builds it with the profile """
+    test_names    = sorted(f[:-4] for f in os.listdir('tests/') if f[-3:] == 'ifx')
+    max_file_name = 1 + max(len(test_name) for test_name in test_names)
+
+    for test_name in test_names:
+        with open('tests/{}.out'.format(test_name), 'r') as expected_file:
+            expected_out = sorted_output(test_name, expected_file.read())
+
+        profile = 'obj/{}.pgo'.format(test_name)
+        if os.path.exists(profile):
+            os.unlink(profile)
+
+        runs = []
+        for mode in [ '--pgo-gen ', '--pgo-gen ', '--pgo-use ' ]:
+            process = subprocess.run(test_command(test_name, mode), shell=True, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, universal_newlines=True)
+            runs.append((sorted_output(test_name, process.stdout), process.stderr))
+
+        trained = [ 'pgo: 1 training run in {}\n'.format(profile), 'pgo: 2 training runs in {}\n'.format(profile) ]
+        if any(output != expected_out for output, _ in runs):
+            failure = 'Process output does not match expected output'
+        elif [ stderr for _, stderr in runs ] != trained + [ '' ]:
+            failure = 'Training runs were not merged into {}: {}'.format(profile, [ stderr for _, stderr in runs ])
+        else:
+            failure = None
+
+        if failure:
+            print('{fname:{fill}} [FAILURE] {}'.format(failure, fname=test_name + ':', fill=max_file_name))
+        else:
+            print('{fname:{fill}} [SUCCESS]'.format(fname=test_name + ':', fill=max_file_name))
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--concurrent':
+        run_concurrent()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--cache':
+        run_cache()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--pgo':
+        run_pgo()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--instrument':
+        run_instrument()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] in [ '--interpret', '--lean', '-g', '--lto' ]:
+        MODE = sys.argv.pop(1) + ' '
+
     if len(sys.argv) > 1:
         run_test(sys.argv[1], len(sys.argv[1]) + 1, output=True)
     else: